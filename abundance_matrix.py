@@ -0,0 +1,387 @@
+"""
+Sparse k-mer abundance matrix for KMC Batch Processing
+Per-file k-mer counts as a CSR matrix (files x k-mers) in .npy files
+
+binary_existence keeps the number of files that contain each k-mer; the
+abundance matrix keeps how often each file contains it, as counted by
+KMC. Row i is the i-th file of samples.json, column j the k-mer on line
+j + 1 of binary_existence.txt (after the header line), so the columns
+are the sorted k-mers that survived --min-files/--max-files.
+
+Folder layout:
+
+  kmers.npy     the column k-mers, sorted: uint64 with 2 bits per base
+                (A=0, C=1, G=2, T=3, first base in the high bits) for
+                k <= 32, fixed-width bytes (S<k>) above
+  indptr.npy    n_files + 1 offsets into indices and data
+  indices.npy   column ids, ascending within each row
+  data.npy      the counts, in the smallest unsigned dtype that holds them
+  samples.json  row names, k, shape and dtypes
+
+indptr and indices are int32, or int64 once the matrix has 2^31 entries
+or columns. The matrix is written one file at a time and each file is
+read in batches of about batch_bytes, looking the k-mers up in a memory
+map of kmers.npy, so memory use does not grow with the number of files
+or k-mers. AbundanceMatrix opens the components as read-only memory maps
+that nothing is read from until rows are used.
+"""
+
+import json
+import os
+import shutil
+import struct
+from pathlib import Path
+
+from kmc_db import KMCDatabase, int_to_kmer
+from kmer_numpy import HAVE_NUMPY, MAX_PACKED_K, np, pack_kmers, unpack_kmers
+
+ABUNDANCE_NAME = "abundance_matrix"
+KMERS_NAME = "kmers.npy"
+INDPTR_NAME = "indptr.npy"
+INDICES_NAME = "indices.npy"
+DATA_NAME = "data.npy"
+SAMPLES_NAME = "samples.json"
+MATRIX_VERSION = 1
+BATCH_BYTES = 16 * 1024 * 1024  # text read from a dump at a time
+BATCH_ENTRIES = 1 << 20  # entries remapped at a time when matrices are merged
+_NPY_HEADER_SIZE = 128  # the length is patched into the header when a file is closed
+_INT32_LIMIT = 2 ** 31
+
+def _require_numpy():
+    if not HAVE_NUMPY:
+        raise RuntimeError("NumPy is required for the abundance matrix")
+
+def _npy_header(dtype, length):
+    """.npy (version 1.0) header of a 1-D array, padded to _NPY_HEADER_SIZE bytes"""
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (length,)})
+    header = header.encode('latin1').ljust(_NPY_HEADER_SIZE - 11) + b"\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header
+
+def _load_npy(path):
+    """Open a .npy file as a read-only memory map (empty arrays cannot be mapped and are read)"""
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path)
+
+class _NpyWriter:
+    """Append 1-D arrays to a .npy file whose length is filled in when it is closed
+
+    With grow, the dtype is widened (and what was written so far converted)
+    when values do not fit it.
+    """
+
+    def __init__(self, path, dtype, grow=False):
+        self.path = Path(path)
+        self.dtype = np.dtype(dtype)
+        self.grow = grow
+        self.length = 0
+        self._file = open(self.path, 'wb')
+        self._file.write(_npy_header(self.dtype, 0))
+
+    def append(self, values):
+        values = np.asarray(values)
+        if not len(values):
+            return
+        if self.grow and values.max() > np.iinfo(self.dtype).max:
+            self._widen(np.min_scalar_type(values.max()))
+        self._file.write(values.astype(self.dtype, copy=False).tobytes())
+        self.length += len(values)
+
+    def _widen(self, dtype):
+        """Rewrite the values written so far with a wider dtype"""
+        self.close()
+        narrow = _load_npy(self.path)
+        wide_path = self.path.with_suffix('.wide.tmp')
+        with open(wide_path, 'wb') as outfile:
+            outfile.write(_npy_header(dtype, self.length))
+            for start in range(0, self.length, BATCH_ENTRIES):
+                outfile.write(np.asarray(narrow[start:start + BATCH_ENTRIES], dtype=dtype).tobytes())
+        del narrow
+        os.replace(wide_path, self.path)
+        self.dtype = np.dtype(dtype)
+        self._file = open(self.path, 'r+b')
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """Write the final length into the header and close the file"""
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype, self.length))
+        self._file.close()
+
+def _parse_block(block, k):
+    """Return (keys, counts) of the 'kmer<TAB>count' lines of a newline-terminated block"""
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data == ord("\n"))
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    keep = (ends - starts > k + 1) & (data[starts] != ord("#"))
+    starts, ends = starts[keep], ends[keep]
+    counts = np.zeros(len(starts), dtype=np.uint64)
+    if not len(starts):
+        return _keys_of(data, starts, k), counts
+    if not np.isin(data[starts + k], (ord("\t"), ord(" "))).all():
+        raise ValueError(f"k-mers that are not {k} bases long")
+    # Count digits, most significant first; a trailing '\r' ends the number
+    digits = starts + k + 1
+    widths = ends - digits
+    for j in range(int(widths.max())):
+        rows = np.flatnonzero(widths > j)
+        values = data[digits[rows] + j]
+        rows = rows[(values >= ord("0")) & (values <= ord("9"))]
+        counts[rows] = counts[rows] * np.uint64(10) + (data[digits[rows] + j] - ord("0")).astype(np.uint64)
+    return _keys_of(data, starts, k), counts
+
+def _keys_of(data, starts, k):
+    """The k-mers at starts as sortable keys: packed uint64 for k <= 32, S<k> bytes above"""
+    if k <= MAX_PACKED_K:
+        return pack_kmers(data, starts, k) if len(starts) else np.zeros(0, dtype=np.uint64)
+    chars = data[starts[:, None] + np.arange(k)] if len(starts) else np.zeros((0, k), dtype=np.uint8)
+    return np.ascontiguousarray(chars).view(f"S{k}").ravel()
+
+def _text_batches(path, k, batch_bytes=BATCH_BYTES):
+    """Yield (keys, counts) batches of a 'kmer<TAB>count' file (a dump or binary_existence.txt)"""
+    carry = b""
+    with open(path, 'rb') as infile:
+        while True:
+            block = infile.read(batch_bytes)
+            if not block:
+                break
+            block = carry + block
+            end = block.rfind(b"\n") + 1
+            carry = block[end:]
+            if end:
+                yield _parse_block(block[:end], k)
+    if carry.strip():
+        yield _parse_block(carry + b"\n", k)
+
+def _db_batches(db_path, k, batch_bytes=BATCH_BYTES):
+    """Yield sorted (keys, counts) batches of a KMC database"""
+    db = KMCDatabase(db_path)
+    if k <= MAX_PACKED_K:
+        yield from db.iter_batches()
+        return
+    batch_records = max(1, batch_bytes // (k + 8))
+    kmers, counts = [], []
+    for kmer, count in db.iter_records(batch_records):
+        kmers.append(int_to_kmer(kmer, k).encode('ascii'))
+        counts.append(count)
+        if len(kmers) >= batch_records:
+            yield np.array(kmers, dtype=f"S{k}"), np.array(counts, dtype=np.uint64)
+            kmers, counts = [], []
+    if kmers:
+        yield np.array(kmers, dtype=f"S{k}"), np.array(counts, dtype=np.uint64)
+
+def _lookup(vocabulary, batches):
+    """Turn (keys, counts) batches into (column ids, counts), leaving out k-mers not in vocabulary"""
+    for keys, counts in batches:
+        ids = np.searchsorted(vocabulary, keys)
+        found = ids < len(vocabulary)
+        found[found] = vocabulary[ids[found]] == keys[found]
+        yield ids[found], counts[found]
+
+def _write_vocabulary(binary_file, kmers_file, k, batch_bytes=BATCH_BYTES):
+    """Write the k-mers of binary_existence.txt to kmers.npy, return (k-mers, sum of their file counts)"""
+    writer = _NpyWriter(kmers_file, np.uint64 if k <= MAX_PACKED_K else f"S{k}")
+    total = 0
+    try:
+        for keys, file_counts in _text_batches(binary_file, k, batch_bytes):
+            writer.append(keys)
+            total += int(file_counts.sum())
+    finally:
+        writer.close()
+    return writer.length, total
+
+class _MatrixWriter:
+    """Write CSR rows over a vocabulary of n_columns k-mers into a folder"""
+
+    def __init__(self, folder, n_columns, entries):
+        self.folder = Path(folder)
+        self.n_columns = n_columns
+        # Size the index dtype from the entries binary_existence promises
+        self.index_dtype = np.dtype(np.int32 if max(n_columns, entries) < _INT32_LIMIT else np.int64)
+        self.indptr = [0]
+        self.indices = _NpyWriter(self.folder / INDICES_NAME, self.index_dtype)
+        self.data = _NpyWriter(self.folder / DATA_NAME, np.uint8, grow=True)
+
+    def add_row(self, batches, source):
+        """Append one row from sorted (column ids, counts) batches"""
+        last = -1
+        for ids, counts in batches:
+            if not len(ids):
+                continue
+            if ids[0] <= last or (len(ids) > 1 and (np.diff(ids) <= 0).any()):
+                raise ValueError(f"{source} is not sorted by k-mer")
+            last = ids[-1]
+            self.indices.append(ids)
+            self.data.append(counts)
+        self.indptr.append(self.indices.length)
+
+    def close(self):
+        self.indices.close()
+        self.data.close()
+        np.save(self.folder / INDPTR_NAME, np.asarray(self.indptr, dtype=self.index_dtype))
+
+def _write_samples(folder, names, k, writer):
+    samples = {
+        'matrix_version': MATRIX_VERSION,
+        'k': int(k),
+        'shape': [len(names), writer.n_columns],
+        'nnz': writer.indices.length,
+        'index_dtype': writer.index_dtype.name,
+        'data_dtype': writer.data.dtype.name,
+        'kmers_dtype': 'uint64' if k <= MAX_PACKED_K else f"S{k}",
+        'samples': [str(name) for name in names],
+    }
+    with open(Path(folder) / SAMPLES_NAME, 'w') as outfile:
+        json.dump(samples, outfile, indent=2)
+
+def _check_entries(writer, expected):
+    if writer.indices.length != expected:
+        raise ValueError(f"the matrix has {writer.indices.length} entries but binary_existence.txt counts {expected}; "
+                         f"the per-file counts do not match binary_existence")
+
+def write_abundance_matrix(sources, names, binary_file, folder, k, kind='dump', batch_bytes=BATCH_BYTES):
+    """Write the abundance matrix of sources (one row each, named names) over the k-mers of binary_file
+
+    sources are sorted text dumps (kind 'dump') or KMC databases (kind
+    'kmc_db') of the files binary_file was built from. Returns the number
+    of entries (non-zero counts) written.
+    """
+    _require_numpy()
+    k = int(k)
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    n_columns, expected = _write_vocabulary(binary_file, folder / KMERS_NAME, k, batch_bytes)
+    vocabulary = _load_npy(folder / KMERS_NAME)
+    read = _db_batches if kind == 'kmc_db' else _text_batches
+    writer = _MatrixWriter(folder, n_columns, expected)
+    try:
+        for source in sources:
+            writer.add_row(_lookup(vocabulary, read(source, k, batch_bytes)), source)
+    finally:
+        writer.close()
+    _check_entries(writer, expected)
+    _write_samples(folder, names, k, writer)
+    return writer.indices.length
+
+def merge_abundance_matrices(folders, binary_file, folder, names=None, batch_bytes=BATCH_BYTES):
+    """Stack the rows of several abundance matrices over the k-mers of their merged binary_file
+
+    The columns of each part are mapped to the new vocabulary by k-mer;
+    k-mers binary_file does not have (dropped by --min-files/--max-files)
+    are left out. The rows of each part follow those of the previous one,
+    or the order of names if it is given (every row name of the parts,
+    once). Returns the number of entries written.
+    """
+    _require_numpy()
+    parts = [AbundanceMatrix(part) for part in folders]
+    k = parts[0].k
+    if any(part.k != k for part in parts):
+        raise ValueError("the abundance matrices were built with different k-mer lengths")
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    rows = [(name, part, row) for part in parts for row, name in enumerate(part.names)]
+    if names is not None:
+        if sorted(names) != sorted(name for name, _, _ in rows):
+            raise ValueError("names must list every row of the abundance matrices once")
+        position = {name: i for i, name in enumerate(names)}
+        rows.sort(key=lambda entry: position[entry[0]])
+    n_columns, expected = _write_vocabulary(binary_file, folder / KMERS_NAME, k, batch_bytes)
+    vocabulary = _load_npy(folder / KMERS_NAME)
+    writer = _MatrixWriter(folder, n_columns, expected)
+    try:
+        for _, part, row in rows:
+            writer.add_row(_lookup(vocabulary, part.iter_row_batches(row)), part.folder)
+    finally:
+        writer.close()
+    _check_entries(writer, expected)
+    _write_samples(folder, [name for name, _, _ in rows], k, writer)
+    return writer.indices.length
+
+def replace_matrix(built, final):
+    """Move a built matrix folder to final, replacing the folder there"""
+    final = Path(final)
+    old = final.with_name(f"{final.name}.old")
+    if final.exists():
+        os.replace(final, old)
+    os.replace(built, final)
+    shutil.rmtree(old, ignore_errors=True)
+
+class AbundanceMatrix:
+    """Read-only, lazily mapped access to an abundance matrix folder"""
+
+    def __init__(self, folder):
+        _require_numpy()
+        self.folder = Path(folder)
+        with open(self.folder / SAMPLES_NAME, 'r') as infile:
+            samples = json.load(infile)
+        if samples.get('matrix_version') != MATRIX_VERSION:
+            raise ValueError(f"{self.folder} has an unsupported version: {samples.get('matrix_version')}")
+        self.k = samples['k']
+        self.shape = tuple(samples['shape'])
+        self.names = samples['samples']
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = _load_npy(self.folder / name)
+        return self._arrays[name]
+
+    @property
+    def kmers(self):
+        """Column k-mers (packed uint64 or S<k> bytes), memory-mapped"""
+        return self._array(KMERS_NAME)
+
+    @property
+    def indptr(self):
+        return self._array(INDPTR_NAME)
+
+    @property
+    def indices(self):
+        return self._array(INDICES_NAME)
+
+    @property
+    def data(self):
+        return self._array(DATA_NAME)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def row(self, file):
+        """Return (column ids, counts) of one file (by name or index)"""
+        i = self.names.index(file) if isinstance(file, str) else file
+        lo, hi = int(self.indptr[i]), int(self.indptr[i + 1])
+        return np.asarray(self.indices[lo:hi]), np.asarray(self.data[lo:hi])
+
+    def iter_row_batches(self, row, batch_entries=BATCH_ENTRIES):
+        """Yield (k-mer keys, counts) of a row in batches of at most batch_entries"""
+        lo, hi = int(self.indptr[row]), int(self.indptr[row + 1])
+        for start in range(lo, hi, batch_entries):
+            stop = min(hi, start + batch_entries)
+            yield self.kmers[np.asarray(self.indices[start:stop])], np.asarray(self.data[start:stop])
+
+    def kmer_strings(self, columns):
+        """Return the k-mers of column ids as ACGT strings"""
+        keys = self.kmers[np.asarray(columns)]
+        if self.k > MAX_PACKED_K:
+            return [key.decode('ascii') for key in keys]
+        return [row.tobytes().decode('ascii') for row in unpack_kmers(keys, self.k)]
+
+    def column(self, kmer):
+        """Return the column id of a k-mer string, or None if it has no column"""
+        data = np.frombuffer(kmer.upper().encode('ascii') + b"\t1\n", dtype=np.uint8)
+        key = _keys_of(data, np.zeros(1, dtype=np.int64), self.k)
+        j = int(np.searchsorted(self.kmers, key)[0])
+        return j if j < self.shape[1] and self.kmers[j] == key[0] else None
+
+    def to_scipy(self):
+        """Return a scipy.sparse.csr_matrix over the memory-mapped components (needs SciPy)"""
+        try:
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            raise RuntimeError("SciPy is required for to_scipy(); the .npy components can be used directly")
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape, copy=False)
@@ -0,0 +1,284 @@
+"""
+K-mer aggregation for KMC Batch Processing
+Builds binary_existence (number of files containing each k-mer) from dumps
+"""
+
+import heapq
+import os
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+
+from presence_matrix import PresenceMatrix, PresenceMatrixWriter
+
+# Maximum number of files merged at once by the streaming engine. Larger
+# inputs are merged in several passes through intermediate files so the
+# number of open file handles stays below typical ulimit settings.
+DEFAULT_FAN_IN = 256
+
+def read_dump_kmers(dump_file):
+    """Yield the k-mer column of a KMC text dump, skipping comments and blanks"""
+    with open(dump_file, 'r') as infile:
+        for line in infile:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                parts = line.split()
+                if len(parts) >= 1:
+                    yield parts[0]
+
+def read_kmer_counts(count_file):
+    """Yield (k-mer, file_count) pairs from a binary_existence style file"""
+    with open(count_file, 'r') as infile:
+        for line in infile:
+            if line.startswith('#'):
+                continue
+            kmer, count = line.split('\t')
+            yield kmer, int(count)
+
+def _checked_sorted(records, source):
+    """Pass records keyed by k-mer through, failing loudly if they are out of order"""
+    previous = None
+    for record in records:
+        kmer = record[0]
+        if previous is not None and kmer <= previous:
+            raise ValueError(f"{source} is not sorted by k-mer (dump it with 'kmc_tools transform ... dump -s')")
+        previous = kmer
+        yield record
+
+def merge_kmer_counts(streams):
+    """Merge sorted (k-mer, count) streams, summing counts of equal k-mers
+
+    Memory use is proportional to the number of streams, not the number of
+    k-mers.
+    """
+    merged = heapq.merge(*streams, key=itemgetter(0))
+    for kmer, group in groupby(merged, key=itemgetter(0)):
+        yield kmer, sum(count for _, count in group)
+
+def merge_kmer_presence(streams):
+    """Merge sorted (k-mer, count, file bitset) streams, summing counts and OR-ing bitsets"""
+    merged = heapq.merge(*streams, key=itemgetter(0))
+    for kmer, group in groupby(merged, key=itemgetter(0)):
+        count = 0
+        mask = 0
+        for _, file_count, file_mask in group:
+            count += file_count
+            mask |= file_mask
+        yield kmer, count, mask
+
+def _write_presence_partial(records, partial_file):
+    """Write (k-mer, count, bitset) records of an intermediate merge level"""
+    with open(partial_file, 'w') as outfile:
+        for kmer, count, mask in records:
+            outfile.write(f"{kmer}\t{count}\t{mask:x}\n")
+
+def _read_presence_partial(partial_file):
+    """Read (k-mer, count, bitset) records of an intermediate merge level"""
+    with open(partial_file, 'r') as infile:
+        for line in infile:
+            kmer, count, mask = line.split('\t')
+            yield kmer, int(count), int(mask, 16)
+
+def _add_matrix_rows(records, matrix):
+    """Append each record's bitset to the presence matrix and pass (k-mer, count) on"""
+    for kmer, count, mask in records:
+        matrix.add_mask(mask)
+        yield kmer, count
+
+def filter_file_counts(records, min_files=None, max_files=None):
+    """Pass on the records whose file count (second field) is within [min_files, max_files]
+
+    Either bound may be None. Without bounds records is returned as is.
+    """
+    if min_files is None and max_files is None:
+        return records
+    low = min_files if min_files is not None else 0
+    high = max_files if max_files is not None else float('inf')
+    return (record for record in records if low <= record[1] <= high)
+
+def write_kmer_counts(pairs, count_file):
+    """Write (k-mer, file_count) pairs with the binary_existence header, return the row count"""
+    total = 0
+    with open(count_file, 'w') as outfile:
+        outfile.write("# k-mer\tfile_count\n")
+        for kmer, count in pairs:
+            outfile.write(f"{kmer}\t{count}\n")
+            total += 1
+    return total
+
+class MemoryCounter:
+    """Incremental per-k-mer file counts kept in a dictionary"""
+
+    def __init__(self):
+        self.kmer_file_count = {}  # k-mer -> count of files it appears in
+
+    def add(self, kmers):
+        """Fold the k-mers of one file into the counts"""
+        kmers_in_this_file = set(kmers)
+
+        # Add 1 to count for each unique k-mer seen in this file
+        kmer_file_count = self.kmer_file_count
+        for kmer in kmers_in_this_file:
+            kmer_file_count[kmer] = kmer_file_count.get(kmer, 0) + 1
+
+    def write(self, binary_file, min_files=None, max_files=None):
+        """Write the counts sorted by k-mer, return the number of k-mers written
+
+        Only k-mers found in min_files to max_files files are written.
+        """
+        counts = self.kmer_file_count
+        pairs = ((kmer, counts[kmer]) for kmer in sorted(counts.keys()))
+        return write_kmer_counts(filter_file_counts(pairs, min_files, max_files), binary_file)
+
+def binary_existence_memory(dump_files, binary_file, reader=read_dump_kmers, min_files=None, max_files=None):
+    """Count files per k-mer with an in-memory dictionary, return the number of k-mers
+
+    reader turns each entry of dump_files into an iterable of k-mer strings
+    (default: parse a KMC text dump). Only k-mers found in min_files to
+    max_files files are written (either bound may be None).
+    """
+    counter = MemoryCounter()
+    for dump_file in dump_files:
+        counter.add(reader(dump_file))
+    return counter.write(binary_file, min_files, max_files)
+
+def binary_existence_stream(dump_files, binary_file, tmp_dir=None, fan_in=DEFAULT_FAN_IN,
+                            reader=read_dump_kmers, presence_file=None, file_names=None,
+                            min_files=None, max_files=None):
+    """Count files per k-mer with a k-way merge of sorted dumps, return the number of k-mers
+
+    Every dump must be sorted by k-mer (kmc_tools transform ... dump -s),
+    or reader must yield sorted k-mer strings for each source. The output
+    is written in a single pass. With more than fan_in dumps, groups of
+    fan_in are first merged into intermediate files in tmp_dir (default:
+    next to binary_file), which are removed level by level.
+
+    If presence_file is given, a packed presence/absence matrix (see
+    presence_matrix.py) is written row by row alongside binary_file, with
+    columns in dump_files order labelled by file_names.
+
+    k-mers found in fewer than min_files or more than max_files files are
+    dropped as the final merge streams, before any row is written.
+    """
+    tmp_dir = Path(tmp_dir) if tmp_dir else Path(binary_file).parent
+    fan_in = max(2, fan_in)
+
+    if presence_file is None:
+        merge, write_partial, read_partial = merge_kmer_counts, write_kmer_counts, read_kmer_counts
+
+        def open_dump(index, dump_file):
+            return _checked_sorted(((kmer, 1) for kmer in reader(dump_file)), dump_file)
+    else:
+        merge, write_partial, read_partial = merge_kmer_presence, _write_presence_partial, _read_presence_partial
+
+        def open_dump(index, dump_file):
+            bit = 1 << index
+            return _checked_sorted(((kmer, 1, bit) for kmer in reader(dump_file)), dump_file)
+
+    def open_partial(partial_file):
+        return _checked_sorted(read_partial(partial_file), partial_file)
+
+    def remove(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    sources = [partial(open_dump, index, f) for index, f in enumerate(dump_files)]
+    intermediates = []
+    level = 0
+    try:
+        while len(sources) > fan_in:
+            next_sources = []
+            next_intermediates = []
+            for n in range(0, len(sources), fan_in):
+                group = sources[n:n + fan_in]
+                partial_file = tmp_dir / f"binary_existence.merge{level}_{n // fan_in}.tmp"
+                next_intermediates.append(partial_file)
+                write_partial(merge([open_source() for open_source in group]), partial_file)
+                next_sources.append(partial(open_partial, partial_file))
+            # Intermediates of the previous level are no longer needed
+            remove(intermediates)
+            sources, intermediates = next_sources, next_intermediates
+            level += 1
+
+        records = filter_file_counts(merge([open_source() for open_source in sources]), min_files, max_files)
+        if presence_file is None:
+            return write_kmer_counts(records, binary_file)
+        if file_names is None:
+            file_names = [Path(f).name for f in dump_files]
+        with PresenceMatrixWriter(presence_file, file_names) as matrix:
+            return write_kmer_counts(_add_matrix_rows(records, matrix), binary_file)
+    finally:
+        remove(intermediates)
+
+def _column_mapper(columns):
+    """Return a function moving bit j of a mask to bit columns[j]
+
+    The mask is translated a byte at a time through 256-entry tables.
+    """
+    tables = []
+    for start in range(0, len(columns), 8):
+        targets = columns[start:start + 8]
+        table = [0] * 256
+        for value in range(256):
+            for bit, target in enumerate(targets):
+                if value >> bit & 1:
+                    table[value] |= 1 << target
+        tables.append(table)
+
+    def remap(mask):
+        moved = 0
+        for table in tables:
+            if mask:
+                moved |= table[mask & 0xFF]
+                mask >>= 8
+        return moved
+    return remap
+
+def merge_binary_existence(count_files, binary_file, presence_files=None, presence_file=None,
+                           file_names=None, min_files=None, max_files=None):
+    """Merge binary_existence files of disjoint file sets into one, return the number of k-mers
+
+    Each input must be sorted by k-mer (as every engine writes it); counts
+    of the same k-mer are summed in one streaming pass. With presence_files
+    (one per count file, row-aligned with it) and presence_file, a combined
+    presence matrix is written too, the columns of each input placed after
+    those of the previous one, or in the order of file_names if it is given
+    (every column name of the inputs, once). min_files and max_files filter
+    on the summed counts.
+    """
+    if presence_files is None or presence_file is None:
+        streams = [_checked_sorted(read_kmer_counts(f), f) for f in count_files]
+        return write_kmer_counts(filter_file_counts(merge_kmer_counts(streams), min_files, max_files), binary_file)
+
+    def shifted(count_file, matrix, shift):
+        rows = zip(read_kmer_counts(count_file), matrix.iter_masks())
+        return _checked_sorted(((kmer, count, mask << shift) for (kmer, count), mask in rows), count_file)
+
+    def moved(count_file, matrix, columns):
+        remap = _column_mapper(columns)
+        rows = zip(read_kmer_counts(count_file), matrix.iter_masks())
+        return _checked_sorted(((kmer, count, remap(mask)) for (kmer, count), mask in rows), count_file)
+
+    matrices = [PresenceMatrix(f) for f in presence_files]
+    input_names = [name for matrix in matrices for name in matrix.file_names]
+    if file_names is None:
+        file_names = input_names
+    elif sorted(file_names) != sorted(input_names):
+        raise ValueError("file_names must list every file of the presence matrices once")
+    position = {name: j for j, name in enumerate(file_names)}
+    streams = []
+    shift = 0
+    for count_file, matrix in zip(count_files, matrices):
+        columns = [position[name] for name in matrix.file_names]
+        if columns == list(range(shift, shift + matrix.n_files)):
+            streams.append(shifted(count_file, matrix, shift))
+        else:
+            streams.append(moved(count_file, matrix, columns))
+        shift += matrix.n_files
+    with PresenceMatrixWriter(presence_file, file_names) as matrix:
+        records = filter_file_counts(merge_kmer_presence(streams), min_files, max_files)
+        return write_kmer_counts(_add_matrix_rows(records, matrix), binary_file)
@@ -0,0 +1,238 @@
+"""
+Stand-in for the kmc and kmc_tools binaries, for benchmarks without KMC
+
+Counts canonical k-mers in Python and writes real KMC databases through
+kmc_db.write_kmc_db, so every stage of run_kmc_batch (native reader,
+dumps, unions, aggregation) runs on realistic files. Only the options
+run_kmc_batch uses are understood.
+
+  python fake_kmc.py kmc [-k21] [-m4] [-t4] [-ci2] [-cx1000] [-jSUMMARY] [-fa|-fm] INPUT DB WORKDIR
+  python fake_kmc.py kmc_tools transform DB [-ci2] [-cx1000] dump [-s] OUT
+  python fake_kmc.py kmc_tools simple DB1 DB2 union|intersect|kmers_subtract OUT
+  python fake_kmc.py kmc_tools complex OPS_FILE
+
+Unlike KMC, -ci defaults to 1 so that every k-mer is kept. Like KMC, the
+input may be gzipped and -j writes a JSON summary of the count.
+
+install(bin_dir) writes small kmc/kmc_tools launchers that run_kmc_batch
+can call like the real executables.
+"""
+
+import gzip
+import json
+import os
+import stat
+import sys
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kmc_db import KMCDatabase, int_to_kmer, write_kmc_db
+
+VERSION = "3.2.4-benchmark"
+USAGE = f"""K-Mer Counter (KMC) ver. {VERSION}
+Usage:
+ kmc [options] <input_file_name> <output_file_name> <working_directory>
+  input_file_name - single file in specified (-f switch) format (gziped or not)
+Parameters:
+  -k<len> - k-mer length (default: 25)
+  -m<size> - max amount of RAM in GB (default: 12)
+  -t<number> - total number of threads (default: no. of CPU cores)
+  -f<a/q/m/bam/kmc> - input in FASTA format (-fa), FASTQ format (-fq), multi FASTA (-fm)
+  -ci<value> - exclude k-mers occurring less than <value> times (default: 1)
+  -cx<value> - exclude k-mers occurring more than <value> times
+  -j<file_name> - file name with execution summary in JSON format
+"""
+
+_COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+def read_sequences(fasta_file, multiline=True):
+    """Yield the upper-case sequences of a FASTA file
+
+    Without multiline every sequence line is a separate read, as in KMC's
+    -fa mode on multi-line files.
+    """
+    current = []
+    gzipped = str(fasta_file).endswith('.gz')
+    with (gzip.open(fasta_file, 'rt') if gzipped else open(fasta_file, 'r')) as infile:
+        for line in infile:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                if current:
+                    yield "".join(current)
+                    current = []
+            elif multiline:
+                current.append(line.upper())
+            else:
+                yield line.upper()
+    if current:
+        yield "".join(current)
+
+def count_kmers(sequences, k):
+    """Count canonical k-mers (the smaller of a k-mer and its reverse complement)"""
+    counts = {}
+    for sequence in sequences:
+        reverse = sequence.translate(_COMPLEMENT)[::-1]
+        n = len(sequence)
+        for i in range(n - k + 1):
+            kmer = sequence[i:i + k]
+            rc = reverse[n - i - k:n - i]
+            canonical = kmer if kmer <= rc else rc
+            counts[canonical] = counts.get(canonical, 0) + 1
+    return {kmer: count for kmer, count in counts.items() if set(kmer) <= set("ACGT")}
+
+def counter_bounds(args):
+    """Return the (-ci, -cx) values among args"""
+    low, high = 1, None
+    for arg in args:
+        if arg.startswith('-ci'):
+            low = int(arg[3:])
+        elif arg.startswith('-cx'):
+            high = int(arg[3:])
+    return low, high
+
+def within(counts, low, high):
+    """Keep the k-mers counted low to high times"""
+    return {kmer: count for kmer, count in counts.items() if count >= low and (high is None or count <= high)}
+
+def load(db_path):
+    """Return (k, {k-mer: count}) for a database"""
+    db = KMCDatabase(db_path)
+    k = db.kmer_length
+    return k, {int_to_kmer(kmer, k): count for kmer, count in db.iter_records()}
+
+OPERATIONS = ('union', 'intersect', 'kmers_subtract')
+
+def combine(dbs, operations):
+    """Fold databases left to right with kmc_tools set operations (one for all, or one per step)"""
+    if isinstance(operations, str):
+        operations = [operations] * (len(dbs) - 1)
+    k, result = load(dbs[0])
+    for db_path, operation in zip(dbs[1:], operations):
+        _, other = load(db_path)
+        if operation == 'union':
+            for kmer, count in other.items():
+                result[kmer] = result.get(kmer, 0) + count
+        elif operation == 'intersect':
+            result = {kmer: min(count, other[kmer]) for kmer, count in result.items() if kmer in other}
+        elif operation == 'kmers_subtract':
+            result = {kmer: count for kmer, count in result.items() if kmer not in other}
+        else:
+            raise SystemExit(f"Unsupported operation: {operation}")
+    return k, result
+
+def kmc(args):
+    if not args:
+        print(USAGE)
+        return 0
+    k = 25
+    multiline = False
+    summary_file = None
+    positional = []
+    for arg in args:
+        if arg.startswith('-ci') or arg.startswith('-cx'):
+            continue
+        elif arg.startswith('-j'):
+            summary_file = arg[2:]
+        elif arg.startswith('-k'):
+            k = int(arg[2:])
+        elif arg.startswith('-f'):
+            multiline = arg == '-fm'
+        elif not arg.startswith('-'):
+            positional.append(arg)
+    input_file, db_path, _ = positional
+    started = time.perf_counter()
+    sequences = list(read_sequences(input_file, multiline))
+    all_counts = count_kmers(sequences, k)
+    low, high = counter_bounds(args)
+    counts = within(all_counts, low, high)
+    write_kmc_db(db_path, counts.items(), k)
+    print(f"Total no. of k-mers: {len(counts)}")
+    if summary_file:
+        # Same layout as KMC's -j summary
+        elapsed = f"{time.perf_counter() - started:.3f}s"
+        with open(summary_file, 'w') as outfile:
+            json.dump({
+                "1st_stage": elapsed, "2nd_stage": "0.000s", "Total": elapsed,
+                "Tmp_size": "0MB", "Tmp_size_strict_memory": "0MB", "Tmp_total_size": "0MB",
+                "Stats": {
+                    "#k-mers_below_min_threshold": sum(1 for c in all_counts.values() if low and c < low),
+                    "#k-mers_above_max_threshold": sum(1 for c in all_counts.values() if high and c > high),
+                    "#Unique_k-mers": len(all_counts),
+                    "#Unique_counted_k-mers": len(counts),
+                    "#Total no. of k-mers": sum(all_counts.values()),
+                    "#Total_reads": len(sequences),
+                    "#Total_super-k-mers": 0,
+                },
+            }, outfile, indent=1)
+    return 0
+
+def kmc_tools(args):
+    args = [arg for arg in args if not (arg.startswith('-t') or arg == '-hp')]
+    if not args:
+        print(USAGE)
+        return 0
+    command = args[0]
+    if command == 'transform':
+        db_path, out = args[1], args[-1]
+        operation = args.index('dump')
+        sorted_dump = '-s' in args[operation + 1:]
+        k, counts = load(db_path)
+        counts = within(counts, *counter_bounds(args[2:operation]))
+        kmers = sorted(counts)
+        if not sorted_dump:
+            # KMC dumps in its internal bin order unless -s is given
+            kmers.sort(key=lambda kmer: zlib.crc32(kmer[:9].encode()) % 512)
+        with open(out, 'w') as outfile:
+            for kmer in kmers:
+                outfile.write(f"{kmer}\t{counts[kmer]}\n")
+    elif command == 'simple':
+        # simple db1 ... dbN op1 ... opN-1 output, as cli.py calls it for overlap_merge
+        first_op = next((i for i, arg in enumerate(args) if arg in OPERATIONS), None)
+        if first_op is None:
+            raise SystemExit(f"Unsupported operation: {args[-2] if len(args) > 2 else ''}")
+        dbs, operations = args[1:first_op], args[first_op:-1]
+        if len(operations) != len(dbs) - 1:
+            raise SystemExit(f"kmc_tools simple needs {len(dbs) - 1} operations for {len(dbs)} databases")
+        k, result = combine(dbs, operations)
+        write_kmc_db(args[-1], result.items(), k)
+    elif command == 'complex':
+        with open(args[1]) as ops:
+            lines = [line.strip() for line in ops if line.strip()]
+        split = lines.index("OUTPUT:")
+        names = dict(line.split(" = ") for line in lines[1:split])
+        out, expression = lines[split + 1].split(" = ")
+        tokens = expression.split()
+        operation = {'+': 'union', '*': 'intersect', '-': 'kmers_subtract'}[tokens[1]]
+        k, result = combine([names[token] for token in tokens[::2]], operation)
+        write_kmc_db(out, result.items(), k)
+    else:
+        raise SystemExit(f"Unsupported kmc_tools command: {command}")
+    return 0
+
+def install(bin_dir):
+    """Write kmc and kmc_tools launchers into bin_dir, return their paths"""
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for tool in ('kmc', 'kmc_tools'):
+        path = bin_dir / tool
+        with open(path, 'w') as outfile:
+            outfile.write(f"#!{sys.executable}\n")
+            outfile.write("import sys\n")
+            outfile.write(f"sys.path.insert(0, {str(Path(__file__).resolve().parent)!r})\n")
+            outfile.write("import fake_kmc\n")
+            outfile.write(f"sys.exit(fake_kmc.{tool}(sys.argv[1:]))\n")
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        paths.append(str(path))
+    return paths
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ('kmc', 'kmc_tools'):
+        sys.exit("Usage: fake_kmc.py kmc|kmc_tools [arguments]")
+    tool = kmc if sys.argv[1] == 'kmc' else kmc_tools
+    sys.exit(tool(sys.argv[2:]))
@@ -0,0 +1,81 @@
+"""
+Synthetic FASTA collections for the KMC Batch Processing benchmarks
+
+Each genome is built from fixed-size segments. With probability shared a
+segment is copied from a common backbone (so its k-mers occur in many
+genomes), otherwise it is random sequence unique to the genome. Output is
+deterministic for a given seed.
+
+Usage:
+    python benchmarks/make_fasta.py OUTPUT_DIR --genomes 20 --length 200000 --shared 0.5
+"""
+
+import argparse
+import random
+from pathlib import Path
+
+SEGMENT = 1000  # bases per shared/unique segment
+
+def random_sequence(rng, length):
+    """Return a uniformly random ACGT string"""
+    return "".join(rng.choices("ACGT", k=length))
+
+def wrap(sequence, line_width):
+    """Split a sequence into lines of line_width bases (0 = single line)"""
+    if not line_width:
+        return sequence + "\n"
+    return "".join(sequence[i:i + line_width] + "\n" for i in range(0, len(sequence), line_width))
+
+def make_genome(rng, backbone, length, shared):
+    """Build one genome from backbone and random segments"""
+    parts = []
+    for start in range(0, length, SEGMENT):
+        size = min(SEGMENT, length - start)
+        if rng.random() < shared:
+            parts.append(backbone[start:start + size])
+        else:
+            parts.append(random_sequence(rng, size))
+    return "".join(parts)
+
+def generate_collection(output_dir, genomes=10, length=100000, line_width=80, shared=0.5,
+                        contigs=1, seed=0, extension=".fna"):
+    """Write genomes FASTA files to output_dir, return their paths
+
+    length is the total length per genome, split evenly over contigs
+    records. line_width controls multi-line wrapping (0 writes each record
+    on one line) and shared the fraction of segments taken from the common
+    backbone.
+    """
+    rng = random.Random(seed)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    backbone = random_sequence(rng, length)
+    paths = []
+    width = len(str(genomes - 1))
+    for g in range(genomes):
+        sequence = make_genome(rng, backbone, length, shared)
+        path = output_dir / f"genome_{g:0{width}d}{extension}"
+        contig_length = -(-length // contigs)
+        with open(path, 'w') as outfile:
+            for c in range(contigs):
+                outfile.write(f">genome_{g}_contig_{c} synthetic\n")
+                outfile.write(wrap(sequence[c * contig_length:(c + 1) * contig_length], line_width))
+        paths.append(path)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic FASTA collection')
+    parser.add_argument('output', help='Output folder')
+    parser.add_argument('--genomes', type=int, default=10, help='Number of genomes (default: 10)')
+    parser.add_argument('--length', type=int, default=100000, help='Bases per genome (default: 100000)')
+    parser.add_argument('--line-width', type=int, default=80, help='Bases per line, 0 for single-line records (default: 80)')
+    parser.add_argument('--shared', type=float, default=0.5, help='Fraction of sequence shared between genomes (default: 0.5)')
+    parser.add_argument('--contigs', type=int, default=1, help='Records per genome (default: 1)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+    paths = generate_collection(args.output, args.genomes, args.length, args.line_width,
+                                args.shared, args.contigs, args.seed)
+    print(f"Wrote {len(paths)} FASTA files to {args.output}")
+
+if __name__ == "__main__":
+    main()
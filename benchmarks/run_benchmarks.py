@@ -0,0 +1,245 @@
+"""
+Benchmark suite for KMC Batch Processing
+
+Generates a synthetic FASTA collection, then times:
+
+  normalize    fasta_normalize.normalize_fasta on a multi-line assembly
+  aggregation  combination_raw and every binary_existence engine on
+               prepared per-file dumps and databases
+  end_to_end   run_kmc_batch with the fake kmc/kmc_tools (fake_kmc.py)
+               in several configurations
+
+Each measurement is the best of --repeats runs. Results go to a JSON file
+together with the commit and machine description; pass --compare with an
+earlier file to print speedups.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --output new.json --compare bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE))
+
+import fake_kmc
+from make_fasta import generate_collection
+from aggregate import binary_existence_memory, binary_existence_stream
+from cli import binary_existence_readers, run_kmc_batch, write_combination_block
+from combination import CombinationWriter, combination_name
+from fasta_normalize import normalize_fasta
+from kmc_db import write_kmc_db
+from kmer_numpy import HAVE_NUMPY, binary_existence_numpy
+from partitioned import binary_existence_partitioned
+
+SCENARIOS = ('normalize', 'aggregation', 'end_to_end')
+
+def timed(func, repeats):
+    """Run func repeats times, return (best seconds, mean seconds, last result)"""
+    times = []
+    result = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    return min(times), sum(times) / len(times), result
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE.parent,
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def prepare_databases(fasta_files, out_dir, k):
+    """Count each file with the fake counter, write its database and sorted dump"""
+    db_paths = []
+    for fasta_file in fasta_files:
+        db_dir = Path(out_dir) / fasta_file.stem
+        db_dir.mkdir(parents=True, exist_ok=True)
+        db_path = str(db_dir / fasta_file.stem)
+        counts = fake_kmc.count_kmers(fake_kmc.read_sequences(fasta_file), k)
+        write_kmc_db(db_path, counts.items(), k)
+        with open(f"{db_path}_dump.txt", 'w') as outfile:
+            for kmer in sorted(counts):
+                outfile.write(f"{kmer}\t{counts[kmer]}\n")
+        db_paths.append(db_path)
+    return db_paths
+
+def bench_normalize(config, work_dir, record):
+    """Time normalize_fasta on one wrapped multi-contig assembly"""
+    source_dir = work_dir / "normalize_input"
+    fasta_file = generate_collection(source_dir, genomes=1, length=config.length * config.genomes,
+                                     line_width=80, contigs=50, seed=config.seed)[0]
+    size = fasta_file.stat().st_size
+    best, mean, _ = timed(lambda: normalize_fasta(fasta_file, work_dir / "normalized.fna"), config.repeats)
+    record('normalize', 'normalize_fasta', best, mean, bytes=size, mb_per_s=round(size / best / 1e6, 1))
+
+def bench_aggregation(config, fasta_files, work_dir, record):
+    """Time combination_raw and the binary_existence engines on prepared inputs"""
+    db_paths = prepare_databases(fasta_files, work_dir / "databases", config.k)
+    out_dir = work_dir / "aggregation_out"
+    out_dir.mkdir(exist_ok=True)
+    dumps = [Path(f"{db_path}_dump.txt") for db_path in db_paths]
+    binary_file = out_dir / "binary_existence.txt"
+
+    def combination(native_db, combination_format='text'):
+        combo_file = out_dir / combination_name(combination_format)
+        with CombinationWriter(combo_file, combination_format) as writer:
+            for db_path in db_paths:
+                write_combination_block(writer, db_path, native_db)
+
+    variants = [
+        ('combination_raw', 'dumps', lambda: combination(False)),
+        ('combination_raw', 'native_db', lambda: combination(True)),
+        ('combination_raw', 'indexed', lambda: combination(False, 'indexed')),
+        ('binary_existence', 'memory', lambda: binary_existence_memory(dumps, binary_file)),
+        ('binary_existence', 'stream', lambda: binary_existence_stream(dumps, binary_file, tmp_dir=out_dir)),
+    ]
+    variants.append(('binary_existence', f'partitioned_{config.jobs}',
+                     lambda: binary_existence_partitioned([str(d) for d in dumps], binary_file,
+                                                          workers=config.jobs, tmp_dir=out_dir)))
+    _, read_native, read_native_packed = binary_existence_readers(native_db=True)
+    variants.append(('binary_existence', 'memory_native_db',
+                     lambda: binary_existence_memory(db_paths, binary_file, reader=read_native)))
+    variants.append(('binary_existence', 'stream_native_db',
+                     lambda: binary_existence_stream(db_paths, binary_file, tmp_dir=out_dir, reader=read_native)))
+    if HAVE_NUMPY and config.k <= 32:
+        variants.append(('binary_existence', 'numpy',
+                         lambda: binary_existence_numpy(dumps, binary_file, k=config.k)))
+        variants.append(('binary_existence', 'numpy_native_db',
+                         lambda: binary_existence_numpy(db_paths, binary_file, k=config.k,
+                                                        read_packed=read_native_packed)))
+    for scenario, variant, func in variants:
+        best, mean, kmers = timed(func, config.repeats)
+        extra = {'kmers': kmers, 'kmers_per_s': round(kmers / best)} if isinstance(kmers, int) else {}
+        record(scenario, variant, best, mean, **extra)
+
+def bench_end_to_end(config, input_dir, work_dir, record):
+    """Time whole run_kmc_batch runs with the fake KMC binaries"""
+    kmc_exe, kmc_tools_exe = fake_kmc.install(work_dir / "bin")
+    jobs = config.jobs
+    variants = [
+        ('sequential', {}),
+        (f'jobs{jobs}', {'jobs': jobs}),
+        (f'jobs{jobs}_stream', {'jobs': jobs, 'aggregation': 'stream'}),
+        (f'jobs{jobs}_native_db', {'jobs': jobs, 'native_db': True}),
+        (f'jobs{jobs}_pipeline', {'jobs': jobs, 'pipeline': True}),
+        (f'jobs{jobs}_tree_merge', {'jobs': jobs, 'merge_fan_out': 8}),
+    ]
+    if HAVE_NUMPY and config.k <= 32:
+        variants.append((f'jobs{jobs}_numpy', {'jobs': jobs, 'aggregation': 'numpy'}))
+
+    for variant, options in variants:
+        outcomes = []
+
+        def run():
+            output_dir = work_dir / "e2e_out"
+            scratch = work_dir / "e2e_work"
+            shutil.rmtree(output_dir, ignore_errors=True)
+            shutil.rmtree(scratch, ignore_errors=True)
+            outcomes.append(run_kmc_batch(kmc_exe, kmc_tools_exe, input_dir, output_dir, scratch,
+                                          config.k, 4, config.threads, log=lambda message: None, **options))
+        best, mean, _ = timed(run, config.repeats)
+        if all(outcomes):
+            record('end_to_end', variant, best, mean, success=True, files_per_s=round(config.genomes / best, 2))
+        else:
+            # A run that stopped early is not a timing of the whole batch
+            print(f"  WARNING: end_to_end {variant} failed in {outcomes.count(False)} of {len(outcomes)} runs, "
+                  f"its time is not compared")
+            record('end_to_end', variant, best, mean, success=False)
+
+def compare(previous_file, results):
+    """Print the speedup of each measurement against an earlier results file"""
+    with open(previous_file) as infile:
+        previous = json.load(infile)
+    # Failed runs (success False) stopped early, their times are not comparable
+    before = {(r['scenario'], r['variant']): r['best_s'] for r in previous['results'] if r.get('success', True)}
+    print(f"\nCompared with {previous_file} (commit {previous.get('commit')}):")
+    for r in results:
+        if not r.get('success', True):
+            print(f"  {r['scenario']:<17} {r['variant']:<22} skipped, the run failed")
+            continue
+        old = before.get((r['scenario'], r['variant']))
+        if old:
+            print(f"  {r['scenario']:<17} {r['variant']:<22} {old:8.3f} s -> {r['best_s']:8.3f} s  "
+                  f"({old / r['best_s']:.2f}x)")
+
+def main():
+    parser = argparse.ArgumentParser(description='KMC Batch Processing benchmarks')
+    parser.add_argument('--output', default='benchmark_results.json', help='Results JSON file')
+    parser.add_argument('--compare', help='Earlier results JSON to compare against')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument('--genomes', type=int, default=12, help='Genomes in the synthetic collection (default: 12)')
+    parser.add_argument('--length', type=int, default=50000, help='Bases per genome (default: 50000)')
+    parser.add_argument('--line-width', type=int, default=80, help='FASTA line width, 0 for single-line (default: 80)')
+    parser.add_argument('--shared', type=float, default=0.5, help='Fraction of sequence shared between genomes (default: 0.5)')
+    parser.add_argument('--k', type=int, default=21, help='K-mer length (default: 21)')
+    parser.add_argument('--jobs', type=int, default=4, help='Concurrent files in the parallel variants (default: 4)')
+    parser.add_argument('--threads', type=int, default=4, help='Threads passed to run_kmc_batch (default: 4)')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per measurement, the best is kept (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--workdir', help='Scratch folder (default: a temporary folder, deleted afterwards)')
+    config = parser.parse_args()
+
+    scenarios = [name.strip() for name in config.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = []
+
+    def record(scenario, variant, best, mean, **extra):
+        entry = {'scenario': scenario, 'variant': variant, 'best_s': round(best, 6), 'mean_s': round(mean, 6)}
+        entry.update(extra)
+        results.append(entry)
+        print(f"  {scenario:<17} {variant:<22} {best:8.3f} s")
+
+    work_dir = Path(config.workdir or tempfile.mkdtemp(prefix="kmc_bench_"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        input_dir = work_dir / "fasta"
+        fasta_files = generate_collection(input_dir, config.genomes, config.length, config.line_width,
+                                          config.shared, seed=config.seed)
+        print(f"Generated {len(fasta_files)} genomes of {config.length} bases in {input_dir}")
+        if 'normalize' in scenarios:
+            bench_normalize(config, work_dir, record)
+        if 'aggregation' in scenarios:
+            bench_aggregation(config, fasta_files, work_dir, record)
+        if 'end_to_end' in scenarios:
+            bench_end_to_end(config, input_dir, work_dir, record)
+    finally:
+        if not config.workdir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': HAVE_NUMPY,
+        'config': {key: value for key, value in vars(config).items() if key not in ('output', 'compare', 'workdir')},
+        'results': results,
+    }
+    with open(config.output, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    print(f"\nResults written to {config.output}")
+    if config.compare:
+        compare(config.compare, results)
+
+if __name__ == "__main__":
+    main()
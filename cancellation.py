@@ -0,0 +1,69 @@
+"""
+Cooperative cancellation for KMC Batch Processing
+Lets a front end stop a running batch and the KMC child processes it started
+"""
+
+import subprocess
+import threading
+
+from metrics import run_child, stop_child
+
+class BatchCancelled(Exception):
+    """Raised when a command was stopped because the batch was cancelled"""
+
+class CancelToken:
+    """Shared flag plus the child processes that cancel() must terminate
+
+    run() is a drop-in for subprocess.run (built on metrics.run_child), so
+    it can be handed to any code that takes a run= callable.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+
+    def is_set(self):
+        """Return True once cancel() has been called"""
+        return self._event.is_set()
+
+    def cancel(self):
+        """Stop scheduling new work and terminate every running child process"""
+        self._event.set()
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            try:
+                stop_child(process, force=False)
+            except OSError:
+                pass
+
+    def _started(self, process):
+        with self._lock:
+            self._processes.add(process)
+            cancelled = self._event.is_set()
+        if cancelled:
+            stop_child(process, force=False)
+
+    def run(self, cmd, **kwargs):
+        """Run cmd like subprocess.run, raising BatchCancelled if the batch is cancelled"""
+        if self._event.is_set():
+            raise BatchCancelled(f"Cancelled before running {cmd[0]}")
+        launched = []
+
+        def started(process):
+            launched.append(process)
+            self._started(process)
+
+        try:
+            result = run_child(cmd, started=started, **kwargs)
+        except subprocess.CalledProcessError:
+            if self._event.is_set():
+                raise BatchCancelled(f"Cancelled while running {cmd[0]}")
+            raise
+        finally:
+            with self._lock:
+                self._processes.difference_update(launched)
+        if self._event.is_set():
+            raise BatchCancelled(f"Cancelled while running {cmd[0]}")
+        return result
@@ -6,27 +6,495 @@ Designed for HPC environments like HiperGator
 
 import subprocess
 import argparse
+import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import shutil
 import sys
+import threading
+import time
+from itertools import islice
+
+from abundance_matrix import ABUNDANCE_NAME, merge_abundance_matrices, replace_matrix, write_abundance_matrix
+from cancellation import BatchCancelled
+from combination import (CONTAINER_NAME, FORMATS as COMBINATION_FORMATS, CombinationContainer, CombinationWriter,
+                         combination_name)
+from incremental import STAGING_NAME, last_failures, load_manifest, new_inputs, save_manifest
+from fasta_inputs import compression, duplicate_names, find_fasta_files, sample_name
+from fasta_normalize import MODES as NORMALIZE_MODES, NormalizationError, Normalizer, kmc_compressions, resolve_mode
+from aggregate import (MemoryCounter, binary_existence_memory, binary_existence_stream, merge_binary_existence,
+                       read_dump_kmers, read_kmer_counts)
+from kmer_index import INDEX_NAME, INVALID, QUERY_BATCH, KmerIndex, build_index
+from kmer_numpy import HAVE_NUMPY, MAX_PACKED_K, PackedCounter, binary_existence_numpy, read_dump_packed
+from partitioned import DEFAULT_MAX_BUCKET_BYTES, binary_existence_partitioned
+from pipeline import Pipeline, Stage
+from kmc_db import KMCDatabase, db_exists, read_kmer_count
+from metrics import RunMetrics, file_size, null_stage, run_child
+from planner import (CALIBRATION_NAME, Calibration, estimate_plan, format_plan, sample_inputs,
+                     update_calibration)
+from kmc_reduce import copy_db, remove_db, subtract_others, tree_reduce
+from run_logs import LOGS_NAME, STATS_NAME, ChildLogs, merge_logs, stats_file_for, write_stats_table
+from result_cache import DB_EXTENSIONS, ResultCache, file_digest, link_or_copy, tool_version
+from scheduling import ORDERS as SCHEDULE_ORDERS, Scheduler, escalate, measure_inputs
+from shards import (combination_blocks, find_shard_dirs, load_shards, parse_shard, select_shard, shard_dir_name,
+                    write_manifest)
+
+# Optional k-mer set outputs and their folders
+KMER_SETS = {'core': "core_intersect", 'unique': "unique_kmers"}
 
 def log(message):
     """Print log message with flush for real-time output"""
     print(message, flush=True)
 
-def run_kmc_batch(kmc_exe, kmc_tools_exe, input_folder, output_folder, work_dir, k, m, t, file_limit=None):
-    """Run KMC batch processing"""
+def split_budget(m, t, jobs, n_files):
+    """Split the global RAM (GB) and thread budget across concurrent workers
+    
+    Returns (workers, ram_per_worker, threads_per_worker). The number of
+    workers is capped so that every worker gets at least 1 GB and 1 thread
+    and the sum never exceeds the global budget.
+    """
+    workers = max(1, min(jobs, n_files, m, t))
+    return workers, m // workers, t // workers
+
+def dump_file_for(output_db):
+    """Return the text dump path that belongs to a per-file database"""
+    return f"{output_db}_dump.txt"
+
+def counter_flags(min_count=None, max_count=None):
+    """Return the KMC -ci/-cx options for counter bounds (None keeps KMC's default)"""
+    flags = []
+    if min_count is not None:
+        flags.append(f"-ci{min_count}")
+    if max_count is not None:
+        flags.append(f"-cx{max_count}")
+    return flags
+
+def cache_result(cache, cache_key, output_db, dump_file=None, dump_kind='dump', log=log):
+    """Add a finished per-file result to the cache, warning instead of failing"""
+    if cache is None:
+        return
+    try:
+        cache.store(cache_key, output_db, dump_file, dump_kind)
+    except OSError as e:
+        log(f"  Warning: Could not add result to cache: {str(e)}")
+
+def count_fasta_file(kmc_exe, fasta_file, output_folder, work_dir, k, m, t,
+                     normalizer=None, dump_kind=None, cache=None, cache_key=None, min_count=None, max_count=None,
+                     stats_file=None, run=subprocess.run, log=log):
+    """Count k-mers in one FASTA file with KMC
+    
+    normalizer (fasta_normalize.Normalizer) decides how the FASTA file
+    reaches KMC; without one it is passed unchanged as -fa. dump_kind ('dump', 'dump_sorted' or None) is the
+    text dump that will be needed later; a cache hit only counts if that
+    dump is cached too. Without a dump the fresh database is added to the
+    cache here, otherwise dump_database does it. Returns
+    (output_db, from_cache, errors) where output_db is None if the file
+    failed. min_count and max_count are KMC's -ci/-cx: k-mers counted
+    fewer or more times are left out of the database. With stats_file
+    KMC writes its JSON summary there (-j).
+    """
+    file_name = sample_name(fasta_file)
+    errors = []
+    
+    # Create output subfolder
+    file_output_dir = Path(output_folder) / file_name
+    file_output_dir.mkdir(parents=True, exist_ok=True)
+    
+    output_db = str(file_output_dir / file_name)
+    dump_file = dump_file_for(output_db) if dump_kind else None
+    
+    if cache is not None and cache.restore(cache_key, output_db, dump_file, dump_kind or 'dump'):
+        log(f"  ✓ Reused cached result")
+        return output_db, True, errors
+    
+    if normalizer is None:
+        normalizer = Normalizer('off', work_dir)
+    
+    # Results left by an earlier run may be hard links into the cache: KMC
+    # rewrites files in place, so they are unlinked rather than overwritten
+    for path in (*db_files(output_db), dump_file_for(output_db)):
+        Path(path).unlink(missing_ok=True)
+    
+    stats_flags = []
+    if stats_file is not None:
+        # A summary left by an earlier run must not pass for this one
+        Path(stats_file).parent.mkdir(parents=True, exist_ok=True)
+        Path(stats_file).unlink(missing_ok=True)
+        stats_flags.append(f"-j{stats_file}")
+    
+    # Run KMC on the (normalized) FASTA file
+    try:
+        with normalizer.prepare(fasta_file, log) as input_file:
+            log(f"  Running KMC...")
+            kmc_cmd = [
+                kmc_exe,
+                f"-k{k}", f"-m{m}", f"-t{t}", *counter_flags(min_count, max_count), *stats_flags,
+                normalizer.input_flag, str(input_file), output_db, str(work_dir)
+            ]
+            run(kmc_cmd, check=True, capture_output=True, text=True)
+        log(f"  ✓ KMC completed")
+    except NormalizationError as e:
+        log(f"  ✗ ERROR normalizing FASTA: {str(e)}")
+        errors.append(f"Failed to normalize {fasta_file.name}")
+        return None, False, errors
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        error_msg = f"  ✗ ERROR processing {fasta_file.name}: {str(e)}"
+        if e.stderr:
+            error_msg += f"\n    stderr: {e.stderr}"
+        log(error_msg)
+        errors.append(error_msg)
+        return None, False, errors
+    
+    if not dump_kind:
+        cache_result(cache, cache_key, output_db, log=log)
+    return output_db, False, errors
+
+def dump_database(kmc_tools_exe, fasta_file, output_db, sorted_dump=False, cache=None, cache_key=None,
+                  min_count=None, max_count=None, run=subprocess.run, log=log):
+    """Dump a per-file KMC database to text with kmc_tools
+    
+    With sorted_dump the dump is written in k-mer order (required by the
+    streaming binary_existence merge). min_count and max_count are passed
+    on as the input's -ci/-cx. The database and dump are then added to the
+    cache. Returns the list of errors (empty on success).
+    """
+    dump_file = dump_file_for(output_db)
+    dump_kind = 'dump_sorted' if sorted_dump else 'dump'
+    
+    # Run kmc_tools dump
+    log(f"  Running kmc_tools dump...")
+    dump_cmd = [kmc_tools_exe, "transform", output_db, *counter_flags(min_count, max_count), "dump"]
+    if sorted_dump:
+        dump_cmd.append("-s")
+    dump_cmd.append(dump_file)
+    # The dump may be a hard link into the cache, kmc_tools would rewrite it in place
+    Path(dump_file).unlink(missing_ok=True)
+    
+    try:
+        run(dump_cmd, check=True, capture_output=True, text=True)
+        log(f"  ✓ Dump completed: {Path(dump_file).name}")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        error_msg = f"  ✗ ERROR processing {fasta_file.name}: {str(e)}"
+        if e.stderr:
+            error_msg += f"\n    stderr: {e.stderr}"
+        log(error_msg)
+        return [error_msg]
+    
+    cache_result(cache, cache_key, output_db, dump_file, dump_kind, log=log)
+    return []
+
+def db_files(db_path):
+    """Return the .kmc_pre/.kmc_suf paths of a database"""
+    return [f"{db_path}{ext}" for ext in DB_EXTENSIONS]
+
+def note_count(record, fasta_file, output_db):
+    """Fill a count stage record from the FASTA input and the database KMC wrote"""
+    record.ok = bool(output_db)
+    if output_db:
+        record.add_io(read=file_size(fasta_file), written=file_size(*db_files(output_db)))
+        record.kmers = read_kmer_count(output_db)
+
+def note_dump(record, output_db):
+    """Fill a dump stage record from the database and its text dump"""
+    record.ok = bool(output_db)
+    if output_db:
+        record.add_io(read=file_size(*db_files(output_db)), written=file_size(dump_file_for(output_db)))
+        record.kmers = read_kmer_count(output_db)
+
+def process_fasta_file(kmc_exe, kmc_tools_exe, fasta_file, output_folder, work_dir, k, m, t,
+                       normalizer=None, sorted_dump=False, dump=True, cache=None, cache_key=None,
+                       min_count=None, max_count=None, stats_file=None, run=subprocess.run, metrics=None, log=log):
+    """Count k-mers in one FASTA file and dump them to text
+    
+    Runs count_fasta_file and, unless dump=False or the result came from
+    the cache, dump_database, each timed as a stage of metrics if given.
+    Returns (output_db, errors) where output_db is None if the file failed.
+    """
+    stage = metrics.stage if metrics is not None else null_stage
+    dump_kind = ('dump_sorted' if sorted_dump else 'dump') if dump else None
+    with stage('count', fasta_file.name) as record:
+        output_db, from_cache, errors = count_fasta_file(
+            kmc_exe, fasta_file, output_folder, work_dir, k, m, t,
+            normalizer=normalizer, dump_kind=dump_kind, cache=cache, cache_key=cache_key,
+            min_count=min_count, max_count=max_count, stats_file=stats_file, run=run, log=log
+        )
+        note_count(record, fasta_file, output_db)
+    if output_db and dump and not from_cache:
+        with stage('dump', fasta_file.name) as record:
+            errors = dump_database(kmc_tools_exe, fasta_file, output_db, sorted_dump=sorted_dump,
+                                   cache=cache, cache_key=cache_key, min_count=min_count, max_count=max_count,
+                                   run=run, log=log)
+            if errors:
+                output_db = None
+            note_dump(record, output_db)
+    return output_db, errors
+
+def reuse_result(src_db, fasta_file, output_folder, dump=True):
+    """Link the database (and dump) of an identical, already processed file into place"""
+    file_name = sample_name(fasta_file)
+    file_output_dir = Path(output_folder) / file_name
+    file_output_dir.mkdir(parents=True, exist_ok=True)
+    output_db = str(file_output_dir / file_name)
+    for ext in DB_EXTENSIONS:
+        link_or_copy(f"{src_db}{ext}", f"{output_db}{ext}")
+    if dump:
+        link_or_copy(dump_file_for(src_db), dump_file_for(output_db))
+    return output_db
+
+def write_combination_block(writer, db_path, native_db=False):
+    """Append one file's dump to combination_raw (a CombinationWriter), return False if it has none"""
+    db_dir = Path(db_path).parent
+    dump_file = Path(dump_file_for(db_path))
+    if native_db and db_exists(db_path):
+        with writer.block(db_dir.name) as outfile:
+            KMCDatabase(db_path).write_dump(outfile)
+    elif dump_file.exists():
+        writer.add_file(dump_file.parent.name, dump_file)
+    else:
+        return False
+    return True
+
+def binary_existence_readers(native_db=False):
+    """Return (source_for, read_kmers, read_packed) for the binary_existence engines
+    
+    source_for(db_path) gives what the readers take for one processed
+    database (its dump or the database itself), or None if it is missing.
+    """
+    if native_db:
+        source_for = lambda db_path: db_path if db_exists(db_path) else None
+        read_kmers = lambda db_path: KMCDatabase(db_path).iter_kmer_strings()
+        read_packed = lambda db_path: KMCDatabase(db_path).read_kmers()
+    else:
+        source_for = lambda db_path: Path(dump_file_for(db_path)) if Path(dump_file_for(db_path)).exists() else None
+        read_kmers = read_dump_kmers
+        read_packed = None
+    return source_for, read_kmers, read_packed
+
+def run_kmc_batch(kmc_exe, kmc_tools_exe, input_folder, output_folder, work_dir, k, m, t, file_limit=None,
+                  jobs=1, normalize='auto', aggregation='memory', native_db=False, presence_matrix=False,
+                  merge_fan_out=None, cache_dir=None, cache_size=None, pipeline=False, cancel=None,
+                  trace=False, schedule='size', shard=None, append=False, partitions=None,
+                  aggregation_workers=None, max_bucket_bytes=DEFAULT_MAX_BUCKET_BYTES, index=False,
+                  combination_format='text', min_count=None, max_count=None, min_files=None, max_files=None,
+                  kmer_sets=(), dump_kmer_sets=False, recursive=False, file_timeout=None, retries=1,
+                  retry_failed=False, abundance_matrix=False, calibration_file=None, keep_intermediates=False,
+                  progress=None, log=log):
+    """Run KMC batch processing
+    
+    The inputs are the FASTA files of input_folder (and of its subfolders
+    with recursive), plain or compressed with gzip, bzip2 or xz
+    (fasta_inputs.py). Each is named by its sample name, which must be
+    unique. Compressed files are never decompressed to disk: KMC reads
+    gzip itself when its usage says so, other inputs are decompressed
+    while being normalized or streamed to KMC through a named pipe.
+    
+    normalize is a fasta_normalize mode ('auto', 'kmc', 'buffered', 'pipe'
+    or 'off') choosing how multi-line FASTA reaches KMC; True and False
+    mean 'buffered' and 'off'.
+    
+    With jobs > 1, up to that many KMC + dump pipelines run at once. The
+    RAM/thread budget (m, t) is shared by the workers and each worker counts
+    in its own private subfolder of work_dir. Per-file log lines are
+    replayed in processing order and processed_dbs is kept in input
+    order, so the log, outputs and errors are the same regardless of which
+    file finishes first.
+    
+    schedule (scheduling.py) picks the processing order and each file's
+    KMC RAM/threads: 'size' and 'bases' start the largest files first and
+    give each file a share of (m, t) proportional to its size, 'name'
+    processes files in input order with an equal split. file_limit still
+    takes the first files by name before scheduling.
+    
+    shard=(i, N) processes only the i-th (1-based) of N size-balanced
+    partitions of the input list (shards.py) and writes the outputs, the
+    run report and shard.json to output_folder/shard_i_of_N, counting in
+    work_dir/shard_i_of_N. merge_shard_outputs combines the shards.
+    
+    Finished runs list their inputs in output_folder/manifest.json. With
+    append only the files missing from it are counted, in a staging
+    folder, and append_outputs then folds them into the existing
+    overlap_merge, combination_raw and binary_existence (incremental.py).
+    
+    aggregation selects the binary_existence engine: 'memory' keeps every
+    distinct k-mer in a dictionary, 'stream' dumps each database sorted and
+    k-way merges the dumps using memory proportional to the number of files,
+    'numpy' counts on 2-bit packed uint64 arrays (needs NumPy and k <= 32,
+    otherwise falls back to 'memory'), 'partitioned' routes the k-mers into
+    prefix buckets on disk and counts them in a pool of aggregation_workers
+    processes (partitioned.py; partitions buckets, by default enough to keep
+    each under max_bucket_bytes).
+    
+    With native_db the per-file text dumps are skipped: combination_raw,
+    binary_existence and the overlap_merge dump read the KMC databases
+    directly through kmc_db.KMCDatabase (k-mers in sorted order).
+    
+    presence_matrix additionally writes binary_existence/presence_matrix.bin,
+    one bit per file per k-mer row-aligned with binary_existence.txt. It is
+    built by the streaming merge, so it implies aggregation='stream'.
+    
+    abundance_matrix additionally writes output_folder/abundance_matrix,
+    the per-file KMC counts as a sparse CSR matrix (files x the k-mers of
+    binary_existence.txt) in memory-mappable .npy files, built from the
+    dumps (or databases) one file at a time (abundance_matrix.py; needs
+    NumPy).
+    
+    min_count and max_count are KMC's -ci/-cx counter bounds, passed to
+    counting and to every kmc_tools dump (None keeps KMC's defaults); they
+    enter the result cache key. min_files and max_files drop k-mers found
+    in fewer or more files from binary_existence and the presence matrix
+    while they are written. Filtered outputs cannot be appended to, and
+    shard runs leave the file filters to merge_shard_outputs.
+    
+    combination_format is 'text' (combination_raw.txt) or 'indexed'
+    (combination_raw.kmcc, the same blocks with a footer offset table for
+    random access per file, see combination.py). The dumps are streamed
+    into it without reading them into memory.
+    
+    index writes binary_existence/binary_existence.idx, the sorted k-mer
+    lookup index used by the query command (kmer_index.py). An index left
+    by an earlier run is rebuilt whenever binary_existence is rewritten.
+    
+    merge_fan_out builds overlap_merge as a tree of unions with at most that
+    many databases per kmc_tools call; independent unions of a round run up
+    to jobs at a time. Without it a single kmc_tools command is used.
+    
+    kmer_sets adds k-mer set databases next to overlap_merge (KMER_SETS):
+    'core' intersects every file into core_intersect, 'unique' writes each
+    file's k-mers found in no other file to unique_kmers, subtracting a
+    balanced union tree of the other files (kmc_reduce.subtract_others).
+    Both use kmc_tools trees of merge_fan_out (default 16) inputs per call.
+    They are dumped to text only with dump_kmer_sets.
+    
+    cache_dir enables the persistent result cache (result_cache.py): files
+    whose content and counting parameters were seen before reuse the cached
+    database and dump, identical files under different names are counted
+    once, and the cache is kept under cache_size bytes by LRU eviction.
+    
+    pipeline runs counting, dumping and aggregation as concurrent stages
+    joined by bounded queues (pipeline.py): while one file is counted the
+    previous one is dumped and the one before is folded into
+    combination_raw and the binary_existence counts, in processing order
+    (combination_raw blocks and processed_dbs follow it). The stream engine
+    still merges all sorted dumps at the end. Per-stage idle time and
+    queue depth are logged when the files are done.
+    
+    cancel is an optional cancellation.CancelToken. Every KMC and kmc_tools
+    command runs through it; once it is cancelled the running commands are
+    terminated, no further files are started, the remaining outputs are
+    skipped and False is returned.
+    
+    Every stage is measured (metrics.py): wall and CPU time per file and
+    stage, CPU time and peak RSS of each KMC/kmc_tools child, bytes read
+    and written and k-mers per second. They are written to
+    run_report.json in output_folder, and with trace also as a Chrome
+    trace-event timeline, run_trace.json. progress(done, total) is called
+    each time a file is finished.
+    
+    The output of every KMC and kmc_tools command is streamed to rotating
+    logs in output_folder/logs (run_logs.py), one per input file plus
+    batch.log. KMC also writes a JSON summary per file there, which ends
+    up in the per-file statistics table kmc_stats.tsv/kmc_stats.json.
+    
+    file_timeout (seconds) limits every KMC and kmc_tools command of a
+    file; a command still running then is killed with its process group.
+    Files that fail are retried up to retries times once every other file
+    has had its turn, each time with twice the RAM and threads of their
+    previous run (capped at m and t). The summary tells the files that
+    succeeded on a retry (transient failures) from those that failed
+    every attempt (permanent failures); the latter are listed in
+    run_report.json, and retry_failed appends only those to the outputs.
+    
+    Each file's database and dump are deleted once the outputs are
+    written; keep_intermediates leaves them in output_folder/<sample name>
+    (with append they are moved next to the existing outputs).
+    
+    A successful run also adds its measurements to calibration_file, the
+    model the --plan estimates are computed from (planner.py).
+    """
+    metrics = RunMetrics()
+    base_run = cancel.run if cancel is not None else run_child
+    run = metrics.measure_run(base_run)
+    attempts = {}  # fasta file -> runs so far
+    shares = {}  # fasta file -> (RAM GB, threads) of its last run
+    failures = {}  # fasta file -> errors of its last run, until one succeeds
+    
+    def cancelled():
+        return cancel is not None and cancel.is_set()
+    
+    def file_finished(done):
+        if progress is not None:
+            progress(done, len(fasta_files))
+    
+    def write_report(success):
+        metrics.info.update({
+            'input_folder': str(input_folder),
+            'output_folder': str(output_folder),
+            'k': int(k), 'ram_gb': int(m), 'threads': int(t), 'jobs': jobs, 'workers': workers,
+            'aggregation': aggregation, 'native_db': native_db, 'normalize': normalize,
+            'pipeline': pipeline, 'schedule': schedule, 'shard': f"{shard[0]}/{shard[1]}" if shard else None,
+            'append': append_to is not None, 'kmer_sets': list(kmer_sets), **options,
+            'file_timeout_s': file_timeout, 'retries': retries,
+            'files': len(fasta_files), 'processed': len(processed_dbs),
+            'retried_files': {f.name: n for f, n in sorted(attempts.items()) if n > 1},
+            'failed_files': sorted(f.name for f in failures),
+            'errors': len(errors), 'cancelled': cancelled(), 'success': success,
+        })
+        try:
+            metrics.write_report(Path(output_folder) / "run_report.json")
+            if trace:
+                metrics.write_trace(Path(output_folder) / "run_trace.json")
+            if shard is not None:
+                write_manifest(output_folder, shard[0], shard[1], k, all_files, fasta_files, processed_dbs,
+                               errors=len(errors), cancelled=cancelled(), options=options)
+        except OSError as e:
+            log(f"Warning: Could not write the run report: {str(e)}")
+        if calibration_file and success:
+            try:
+                update_calibration(calibration_file, metrics.report())
+            except (OSError, ValueError) as e:
+                log(f"Warning: Could not update the calibration in {calibration_file}: {str(e)}")
     
-    import shutil
+    def stop_cancelled():
+        nonlocal output_folder
+        log("\n" + "=" * 60)
+        log("Batch cancelled, remaining outputs were not created")
+        if append_to is not None:
+            # The existing outputs were not touched, only the logs are kept
+            merge_logs(Path(output_folder) / LOGS_NAME, append_to / LOGS_NAME)
+            shutil.rmtree(output_folder, ignore_errors=True)
+            output_folder = append_to
+        write_report(False)
+        return False
+    
+    for name, value in (('min_count', min_count), ('max_count', max_count),
+                        ('min_files', min_files), ('max_files', max_files)):
+        if value is not None and value < 1:
+            log(f"ERROR: {name} must be at least 1, got {value}")
+            return False
+    if min_count is not None and max_count is not None and min_count > max_count:
+        log(f"ERROR: min_count ({min_count}) is larger than max_count ({max_count})")
+        return False
+    if min_files is not None and max_files is not None and min_files > max_files:
+        log(f"ERROR: min_files ({min_files}) is larger than max_files ({max_files})")
+        return False
+    file_filter = min_files is not None or max_files is not None
+    options = {'min_count': min_count, 'max_count': max_count, 'min_files': min_files, 'max_files': max_files}
     
     # Get all FASTA files
-    fasta_files = []
-    for ext in ['*.fasta', '*.fa', '*.fna']:
-        fasta_files.extend(Path(input_folder).glob(ext))
+    fasta_files = find_fasta_files(input_folder, recursive=recursive)
     
     if not fasta_files:
         log("ERROR: No FASTA files found in input folder!")
         return False
     
+    duplicates = duplicate_names(fasta_files)
+    if duplicates:
+        log("ERROR: Several input files have the same sample name:")
+        for name, files in sorted(duplicates.items()):
+            log(f"  {name}: {', '.join(str(f) for f in sorted(files))}")
+        return False
+    
     # Sort files for consistent ordering
     fasta_files = sorted(fasta_files)
     
@@ -39,52 +507,479 @@ def run_kmc_batch(kmc_exe, kmc_tools_exe, input_folder, output_folder, work_dir,
     else:
         log(f"Found {len(fasta_files)} FASTA files to process")
     
+    # Keep only this shard's part of the collection
+    all_files = fasta_files
+    if shard is not None:
+        if file_filter:
+            log("ERROR: Shard runs cannot filter by file count, pass --min-files/--max-files to merge-shards")
+            return False
+        fasta_files = select_shard(all_files, shard[0], shard[1])
+        output_folder = Path(output_folder) / shard_dir_name(*shard)
+        work_dir = Path(work_dir) / shard_dir_name(*shard)
+        output_folder.mkdir(parents=True, exist_ok=True)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        log(f"Shard {shard[0]}/{shard[1]}: {len(fasta_files)} of {len(all_files)} files "
+            f"({file_size(*fasta_files) / 1024 ** 2:.1f} of {file_size(*all_files) / 1024 ** 2:.1f} MB) "
+            f"-> {output_folder}")
+        if not fasta_files:
+            write_manifest(output_folder, shard[0], shard[1], k, all_files, [], [], options=options)
+            log("No files fall into this shard, nothing to do")
+            return True
+    
+    # Count only the files that the existing outputs do not include yet
+    manifest = None
+    append_to = None
+    if retry_failed:
+        if shard is not None:
+            log("ERROR: --retry-failed cannot be used with --shard, rerun the shard itself")
+            return False
+        try:
+            failed = last_failures(output_folder)
+        except (OSError, ValueError) as e:
+            log(f"ERROR: Could not read the run report: {str(e)}")
+            return False
+        if failed is None:
+            log("ERROR: The output folder has no record of failed files (run_report.json)")
+            return False
+        if not failed:
+            log("The last run had no failed files, nothing to retry")
+            return True
+        # The failed files are not in the manifest, so an append picks them up
+        append = True
+    if append:
+        if shard is not None:
+            log("ERROR: Appending to sharded outputs is not supported, merge the shards first")
+            return False
+        if file_filter:
+            log("ERROR: --min-files/--max-files cannot be used with --append (the counts of dropped k-mers are lost)")
+            return False
+        try:
+            manifest = load_manifest(output_folder)
+        except (OSError, ValueError) as e:
+            log(f"ERROR: Could not read the manifest: {str(e)}")
+            return False
+        built_with = (manifest or {}).get('options') or {}
+        if manifest is None:
+            log("Append: the output folder has no manifest.json yet, processing all files")
+        elif manifest['k'] != int(k):
+            log(f"ERROR: The existing outputs were built with k={manifest['k']}, not k={k}")
+            return False
+        elif built_with.get('min_files') is not None or built_with.get('max_files') is not None:
+            log("ERROR: The existing outputs were filtered by file count and cannot be appended to")
+            return False
+        elif (built_with.get('min_count'), built_with.get('max_count')) != (min_count, max_count):
+            log(f"ERROR: The existing outputs were counted with min_count={built_with.get('min_count')}, "
+                f"max_count={built_with.get('max_count')}, not min_count={min_count}, max_count={max_count}")
+            return False
+        else:
+            new_files = new_inputs(fasta_files, manifest)
+            log(f"Append: {len(fasta_files) - len(new_files)} files already included, {len(new_files)} new")
+            if retry_failed:
+                new_files = [fasta_file for fasta_file in new_files if fasta_file.name in failed]
+                log(f"Retrying the {len(new_files)} of them that failed in the last run")
+            if not new_files:
+                log("Nothing to add, the outputs are up to date")
+                return True
+            fasta_files = new_files
+            append_to = Path(output_folder)
+            output_folder = append_to / STAGING_NAME
+            shutil.rmtree(output_folder, ignore_errors=True)
+            output_folder.mkdir(parents=True)
+            has_matrix = (append_to / "binary_existence" / "presence_matrix.bin").exists()
+            if has_matrix and not presence_matrix:
+                log("Append: the existing outputs have a presence matrix, extending it as well")
+                presence_matrix = True
+            elif presence_matrix and not has_matrix:
+                log("Append: the existing outputs have no presence matrix, not creating one")
+                presence_matrix = False
+            has_abundance = (append_to / ABUNDANCE_NAME).is_dir()
+            if has_abundance and not abundance_matrix:
+                log("Append: the existing outputs have an abundance matrix, extending it as well")
+            elif abundance_matrix and not has_abundance:
+                log("Append: the existing outputs have no abundance matrix, not creating one "
+                    "(the counts of the included files are gone)")
+            abundance_matrix = has_abundance
+            for existing_format in COMBINATION_FORMATS:
+                if (append_to / "combination_raw" / combination_name(existing_format)).exists():
+                    if existing_format != combination_format:
+                        log(f"Append: the existing combination_raw is {existing_format}, extending it as such")
+                        combination_format = existing_format
+                    break
+            existing_sets = tuple(name for name, folder in KMER_SETS.items() if (append_to / folder).is_dir())
+            if existing_sets and set(existing_sets) != set(kmer_sets):
+                log(f"Append: the existing outputs have k-mer sets ({', '.join(existing_sets)}), updating those")
+            elif kmer_sets and not existing_sets:
+                log("Append: the existing outputs have no k-mer sets, not creating them")
+            kmer_sets = existing_sets
+            dump_kmer_sets = bool(existing_sets) and has_set_dumps(append_to)
+    
     log("=" * 60)
     
+    if presence_matrix and aggregation != 'stream':
+        log(f"Presence matrix requested, using the stream aggregation engine instead of '{aggregation}'")
+        aggregation = 'stream'
+    if aggregation == 'numpy' and not HAVE_NUMPY:
+        log("NumPy is not installed, falling back to the memory engine")
+        aggregation = 'memory'
+    elif aggregation == 'numpy' and int(k) > MAX_PACKED_K:
+        log(f"NumPy engine supports k <= {MAX_PACKED_K}, falling back to the memory engine")
+        aggregation = 'memory'
+    if abundance_matrix and not HAVE_NUMPY:
+        log("ERROR: The abundance matrix needs NumPy, which is not installed")
+        return False
+    # The streaming merge and the abundance matrix read the dumps in k-mer order
+    sorted_dump = aggregation == 'stream' or abundance_matrix
+    source_for, read_kmers, read_packed = binary_existence_readers(native_db)
+    
+    def source_bytes(db_paths):
+        # Size of what the aggregation reads for these databases
+        if native_db:
+            return file_size(*[path for db_path in db_paths for path in db_files(db_path)])
+        return file_size(*[dump_file_for(db_path) for db_path in db_paths])
+    
+    # Child output is streamed to per-file logs instead of being kept in memory
+    logs_dir = Path(output_folder) / LOGS_NAME
+    child_logs = ChildLogs(logs_dir)
+    base_run = child_logs.wrap(base_run)
+    run = metrics.measure_run(base_run)
+    
+    def file_run(fasta_file):
+        logged = child_logs.wrap(base_run, sample_name(fasta_file))
+        if not file_timeout:
+            return metrics.measure_run(logged)
+        
+        def timed(cmd, *args, **kwargs):
+            kwargs.setdefault('timeout', file_timeout)
+            return logged(cmd, *args, **kwargs)
+        return metrics.measure_run(timed)
+    
     # Process each file
     processed_dbs = []
     errors = []
-    individual_folders = []  # Track all individual folders for cleanup
     
-    for i, fasta_file in enumerate(fasta_files, 1):
-        file_name = fasta_file.stem
-        log(f"\n[{i}/{len(fasta_files)}] Processing: {fasta_file.name}")
+    workers, worker_m, worker_t = split_budget(m, t, jobs, len(fasta_files))
+    
+    # Order the work (largest first unless schedule='name') and size each file's KMC share
+    sizes = None
+    if schedule != 'name':
+        with metrics.stage('measure') as record:
+            sizes = measure_inputs(fasta_files, schedule, workers=workers)
+            if schedule == 'bases':
+                record.add_io(read=file_size(*fasta_files))
+    scheduler = Scheduler(fasta_files, m, t, workers=workers, order=schedule, sizes=sizes)
+    schedule_files = scheduler.order
+    if schedule != 'name':
+        unit = 'bases' if schedule == 'bases' else 'bytes'
+        log(f"Scheduling largest files first ({sizes[schedule_files[0]]} to {sizes[schedule_files[-1]]} {unit})")
+    if workers > 1:
+        if schedule == 'name':
+            log(f"Running {workers} files concurrently ({worker_m} GB RAM, {worker_t} threads each)")
+        else:
+            log(f"Running {workers} files concurrently, sharing {m} GB RAM and {t} threads by file size")
+    
+    # Decide how FASTA files are normalized for KMC
+    if normalize is True:
+        normalize = 'buffered'
+    elif not normalize:
+        normalize = 'off'
+    normalize = resolve_mode(normalize, kmc_exe)
+    log(f"FASTA normalization: {normalize}")
+    compressed = [fasta_file for fasta_file in fasta_files if compression(fasta_file)]
+    native_compressions = kmc_compressions(kmc_exe) if compressed else ()
+    if compressed:
+        direct = sum(1 for fasta_file in compressed if compression(fasta_file) in native_compressions)
+        if normalize in ('kmc', 'off'):
+            log(f"Compressed inputs: {len(compressed)} ({direct} read by KMC directly, "
+                f"{len(compressed) - direct} decompressed into a pipe)")
+        else:
+            log(f"Compressed inputs: {len(compressed)} (decompressed while normalizing)")
+    normalizer = Normalizer(normalize, work_dir, schedule_files, workers=workers,
+                            native_compressions=native_compressions)
+    
+    # Hash inputs so cached and duplicate files can be reused
+    cache = None
+    cache_keys = {}
+    primaries = {}  # content key -> first file with that content
+    if cache_dir:
+        cache = ResultCache(cache_dir, cache_size)
+        params = {
+            'k': int(k),
+            'kmc_version': tool_version(kmc_exe),
+            'input': 'raw' if normalize == 'off' else 'normalized',
+        }
+        # Only set bounds enter the key, so results cached before they existed stay valid
+        if min_count is not None:
+            params['min_count'] = int(min_count)
+        if max_count is not None:
+            params['max_count'] = int(max_count)
+        log(f"Hashing {len(fasta_files)} input files for the result cache...")
+        with metrics.stage('hash') as record, ThreadPoolExecutor(max_workers=workers) as executor:
+            digests = list(executor.map(file_digest, fasta_files))
+            record.add_io(read=file_size(*fasta_files))
+        for fasta_file, digest in zip(fasta_files, digests):
+            cache_keys[fasta_file] = ResultCache.make_key(digest, params)
+        for fasta_file in schedule_files:
+            primaries.setdefault(cache_keys[fasta_file], fasta_file)
+        duplicates = len(fasta_files) - len(primaries)
+        if duplicates:
+            log(f"  {duplicates} files have the same content as another input and will be counted once")
+    primary_done = {key: threading.Event() for key in primaries}
+    primary_dbs = {}
+    
+    # One private KMC temp folder per worker so concurrent runs never collide
+    worker_dirs = queue.Queue()
+    for n in range(workers):
+        worker_dir = Path(work_dir) / f"worker_{n}"
+        worker_dir.mkdir(parents=True, exist_ok=True)
+        worker_dirs.put(worker_dir)
+    
+    def file_budget(fasta_file, attempt):
+        # A retry waits for more RAM and threads than the file's last run had
+        if attempt and fasta_file in shares:
+            return escalate(*shares[fasta_file], m, t)
+        return 1, 1
+    
+    def file_done(fasta_file, output_db, file_errors):
+        if output_db:
+            failures.pop(fasta_file, None)
+        elif file_errors:
+            failures[fasta_file] = file_errors
+    
+    def process(fasta_file, file_log, attempt=0):
+        cache_key = cache_keys.get(fasta_file)
+        primary = primaries.get(cache_key)
+        output_db = None
+        try:
+            if primary is not None and primary != fasta_file:
+                # Primaries are scheduled first, so this never waits on an unstarted file
+                primary_done[cache_key].wait()
+                if primary_dbs.get(cache_key):
+                    output_db = reuse_result(primary_dbs[cache_key], fasta_file, output_folder, dump=not native_db)
+                    file_log(f"  ✓ Identical to {primary.name}, reused its result")
+                    return output_db, []
+            if cancelled():
+                file_log("  ✗ Skipped, batch cancelled")
+                return None, []
+            
+            worker_dir = worker_dirs.get()
+            try:
+                with scheduler.allocate(fasta_file, file_budget(fasta_file, attempt)) as (file_m, file_t):
+                    shares[fasta_file] = (file_m, file_t)
+                    attempts[fasta_file] = attempt + 1
+                    if attempt or (workers > 1 and schedule != 'name'):
+                        file_log(f"  KMC budget: {file_m} GB RAM, {file_t} threads")
+                    output_db, file_errors = process_fasta_file(
+                        kmc_exe, kmc_tools_exe, fasta_file, output_folder, worker_dir,
+                        k, file_m, file_t, normalizer=normalizer,
+                        sorted_dump=sorted_dump, dump=not native_db,
+                        cache=cache, cache_key=cache_key, min_count=min_count, max_count=max_count,
+                        stats_file=stats_file_for(logs_dir, sample_name(fasta_file)),
+                        run=file_run(fasta_file), metrics=metrics, log=file_log
+                    )
+                return output_db, file_errors
+            finally:
+                worker_dirs.put(worker_dir)
+        except BatchCancelled:
+            output_db = None
+            file_log("  ✗ Cancelled")
+            return None, []
+        finally:
+            if primary == fasta_file:
+                primary_dbs[cache_key] = output_db
+                primary_done[cache_key].set()
+    
+    def process_buffered(fasta_file, attempt=0):
+        messages = []
+        output_db, file_errors = process(fasta_file, messages.append, attempt)
+        return output_db, file_errors, messages
+    
+    def file_label(i, n, attempt):
+        return f"[{i}/{n}]" if not attempt else f"[retry {attempt}, {i}/{n}]"
+    
+    combo_state = None
+    counter_state = None
+    if pipeline:
+        # Stage 1: count (KMC), stage 2: dump (kmc_tools), stage 3: fold the
+        # finished file into combination_raw and binary_existence, in processing order
+        def count_stage(job):
+            fasta_file = job['fasta_file']
+            cache_key = cache_keys.get(fasta_file)
+            primary = primaries.get(cache_key)
+            if primary is not None and primary != fasta_file:
+                primary_done[cache_key].wait()
+                if primary_dbs.get(cache_key):
+                    job['output_db'] = reuse_result(primary_dbs[cache_key], fasta_file, output_folder,
+                                                    dump=not native_db)
+                    job['messages'].append(f"  ✓ Identical to {primary.name}, reused its result")
+                    job['from_cache'] = True
+                    return job
+            if cancelled():
+                job['messages'].append("  ✗ Skipped, batch cancelled")
+                return job
+            worker_dir = worker_dirs.get()
+            try:
+                with scheduler.allocate(fasta_file, file_budget(fasta_file, job['attempt'])) as (file_m, file_t), \
+                        metrics.stage('count', fasta_file.name) as record:
+                    shares[fasta_file] = (file_m, file_t)
+                    attempts[fasta_file] = job['attempt'] + 1
+                    if job['attempt'] or (workers > 1 and schedule != 'name'):
+                        job['messages'].append(f"  KMC budget: {file_m} GB RAM, {file_t} threads")
+                    job['output_db'], job['from_cache'], job['errors'] = count_fasta_file(
+                        kmc_exe, fasta_file, output_folder, worker_dir, k, file_m, file_t,
+                        normalizer=normalizer,
+                        dump_kind=None if native_db else ('dump_sorted' if sorted_dump else 'dump'),
+                        cache=cache, cache_key=cache_key, min_count=min_count, max_count=max_count,
+                        stats_file=stats_file_for(logs_dir, sample_name(fasta_file)),
+                        run=file_run(fasta_file), log=job['messages'].append
+                    )
+                    note_count(record, fasta_file, job['output_db'])
+            except BatchCancelled:
+                job['messages'].append("  ✗ Cancelled")
+            finally:
+                worker_dirs.put(worker_dir)
+            return job
         
-        # Create output subfolder
-        file_output_dir = Path(output_folder) / file_name
-        file_output_dir.mkdir(parents=True, exist_ok=True)
-        individual_folders.append(file_output_dir)  # Track for cleanup
+        def dump_stage(job):
+            fasta_file = job['fasta_file']
+            cache_key = cache_keys.get(fasta_file)
+            try:
+                if job['output_db'] and not native_db and not job['from_cache']:
+                    with metrics.stage('dump', fasta_file.name) as record:
+                        job['errors'] = dump_database(
+                            kmc_tools_exe, fasta_file, job['output_db'], sorted_dump=sorted_dump,
+                            cache=cache, cache_key=cache_key, min_count=min_count, max_count=max_count,
+                            run=file_run(fasta_file), log=job['messages'].append
+                        )
+                        if job['errors']:
+                            job['output_db'] = None
+                        note_dump(record, job['output_db'])
+            except BatchCancelled:
+                job['messages'].append("  ✗ Cancelled")
+                job['output_db'] = None
+            finally:
+                if primaries.get(cache_key) == fasta_file:
+                    primary_dbs[cache_key] = job['output_db']
+                    primary_done[cache_key].set()
+            return job
         
-        output_db = str(file_output_dir / file_name)
+        combo_dir = Path(output_folder) / "combination_raw"
+        combo_dir.mkdir(parents=True, exist_ok=True)
+        combo_state = {'writer': CombinationWriter(combo_dir / combination_name(combination_format),
+                                                   combination_format), 'error': None}
+        if aggregation == 'memory':
+            counter_state = {'counter': MemoryCounter(), 'error': None}
+        elif aggregation == 'numpy':
+            counter_state = {'counter': PackedCounter(int(k)), 'error': None}
         
-        # Run KMC
-        log(f"  Running KMC...")
-        kmc_cmd = [
-            kmc_exe,
-            f"-k{k}", f"-m{m}", f"-t{t}",
-            "-fa", str(fasta_file), output_db, work_dir
+        def fold_stage(job):
+            log(f"\n{file_label(job['index'] + 1, job['total'], job['attempt'])} "
+                f"Processing: {job['fasta_file'].name}")
+            for message in job['messages']:
+                log(message)
+            output_db = job['output_db']
+            file_done(job['fasta_file'], output_db, job['errors'])
+            if not job['attempt']:
+                file_finished(job['index'] + 1)
+            if not output_db:
+                return job
+            processed_dbs.append(output_db)
+            with metrics.stage('aggregate', job['fasta_file'].name) as record:
+                if not combo_state['error']:
+                    try:
+                        write_combination_block(combo_state['writer'], output_db, native_db)
+                    except Exception as e:
+                        combo_state['error'] = e
+                source = source_for(output_db)
+                if counter_state is not None and not counter_state['error'] and source is not None:
+                    try:
+                        if aggregation == 'numpy':
+                            packed = read_packed(source) if read_packed else read_dump_packed(source, int(k))
+                            counter_state['counter'].add(packed)
+                        else:
+                            counter_state['counter'].add(read_kmers(source))
+                    except Exception as e:
+                        counter_state['error'] = e
+                record.add_io(read=source_bytes([output_db]))
+                record.kmers = read_kmer_count(output_db)
+            return job
+        
+        stages = [
+            Stage("count", count_stage, workers=workers),
+            Stage("dump", dump_stage, workers=workers),
+            Stage("aggregate", fold_stage, ordered=True),
         ]
         
-        try:
-            result = subprocess.run(kmc_cmd, check=True, capture_output=True, text=True)
-            log(f"  ✓ KMC completed")
-            
-            # Run kmc_tools dump
-            log(f"  Running kmc_tools dump...")
-            dump_file = str(file_output_dir / f"{file_name}_dump.txt")
-            dump_cmd = [kmc_tools_exe, "transform", output_db, "dump", dump_file]
-            
-            subprocess.run(dump_cmd, check=True, capture_output=True, text=True)
-            log(f"  ✓ Dump completed: {file_name}_dump.txt")
-            
-            processed_dbs.append(output_db)
-            
-        except subprocess.CalledProcessError as e:
-            error_msg = f"  ✗ ERROR processing {fasta_file.name}: {str(e)}"
-            if e.stderr:
-                error_msg += f"\n    stderr: {e.stderr}"
-            log(error_msg)
-            errors.append(error_msg)
+        def run_round(round_files, attempt):
+            Pipeline(stages).run([
+                {'index': i, 'total': len(round_files), 'attempt': attempt, 'fasta_file': f, 'output_db': None,
+                 'from_cache': False, 'errors': [], 'messages': []}
+                for i, f in enumerate(round_files)
+            ])
+    elif workers == 1:
+        results = {}
+        
+        def run_round(round_files, attempt):
+            for i, fasta_file in enumerate(round_files, 1):
+                log(f"\n{file_label(i, len(round_files), attempt)} Processing: {fasta_file.name}")
+                output_db, file_errors = process(fasta_file, log, attempt)
+                results[fasta_file] = output_db
+                file_done(fasta_file, output_db, file_errors)
+                if not attempt:
+                    file_finished(i)
+    else:
+        results = {}
+        
+        def run_round(round_files, attempt):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(process_buffered, f, attempt) for f in round_files]
+                # Collect in submission order to keep results deterministic
+                for i, (fasta_file, future) in enumerate(zip(round_files, futures), 1):
+                    output_db, file_errors, messages = future.result()
+                    log(f"\n{file_label(i, len(round_files), attempt)} Processing: {fasta_file.name}")
+                    for message in messages:
+                        log(message)
+                    results[fasta_file] = output_db
+                    file_done(fasta_file, output_db, file_errors)
+                    if not attempt:
+                        file_finished(i)
+    
+    # Failed files go to the end of the queue: they are retried once every file has had its turn
+    round_files = schedule_files
+    try:
+        for attempt in range(max(0, retries) + 1):
+            if attempt:
+                round_files = [fasta_file for fasta_file in round_files if fasta_file in failures]
+                if not round_files or cancelled():
+                    break
+                log("\n" + "=" * 60)
+                log(f"Retrying {len(round_files)} failed files with more RAM and threads "
+                    f"(retry {attempt} of {retries})")
+            run_round(round_files, attempt)
+    finally:
+        if combo_state is not None:
+            if not processed_dbs or cancelled():
+                combo_state['writer'].abort()
+            else:
+                combo_state['writer'].close()
+    errors.extend(error for fasta_file in fasta_files for error in failures.get(fasta_file, []))
+    
+    if pipeline:
+        log("\nPipeline stages (time in seconds):")
+        for stage in stages:
+            stats = stage.report()
+            log(f"  {stats['stage']:<10} workers={stats['workers']} files={stats['items']} "
+                f"busy={stats['busy_s']:.1f} idle={stats['idle_s']:.1f} blocked={stats['blocked_s']:.1f} "
+                f"queue max={stats['max_queue_depth']} mean={stats['mean_queue_depth']:.1f}")
+    else:
+        # Keep processed_dbs in input order whatever the processing order
+        processed_dbs.extend(results[f] for f in fasta_files if results.get(f))
+    
+    normalizer.close()
+    for n in range(workers):
+        shutil.rmtree(Path(work_dir) / f"worker_{n}", ignore_errors=True)
+    if cancelled():
+        return stop_cancelled()
+    file_errors = len(errors)
     
     # Create overlap_merge
     if processed_dbs:
@@ -95,113 +990,253 @@ def run_kmc_batch(kmc_exe, kmc_tools_exe, input_folder, output_folder, work_dir,
         overlap_dir.mkdir(parents=True, exist_ok=True)
         overlap_db = str(overlap_dir / "overlap_merge")
         
-        try:
-            # Build union command
-            union_cmd = [kmc_tools_exe, "simple"] + processed_dbs
-            for i in range(len(processed_dbs) - 1):
-                union_cmd.append("union")
-            union_cmd.append(overlap_db)
-            
-            subprocess.run(union_cmd, check=True, capture_output=True, text=True)
-            log("  ✓ Union completed")
-            
-            # Dump merged database
-            overlap_dump = str(overlap_dir / "overlap_merge_dump.txt")
-            dump_cmd = [kmc_tools_exe, "transform", overlap_db, "dump", overlap_dump]
-            subprocess.run(dump_cmd, check=True, capture_output=True, text=True)
-            log(f"  ✓ Dump completed: overlap_merge_dump.txt")
-            
-        except subprocess.CalledProcessError as e:
-            error_msg = f"  ✗ ERROR creating overlap_merge: {str(e)}"
-            if e.stderr:
-                error_msg += f"\n    stderr: {e.stderr}"
-            log(error_msg)
-            errors.append(error_msg)
+        with metrics.stage('overlap_merge') as record:
+            try:
+                if merge_fan_out:
+                    # Hierarchical union in rounds of at most merge_fan_out databases
+                    merge_tmp = Path(work_dir) / "overlap_merge_tmp"
+                    try:
+                        rounds = tree_reduce(
+                            kmc_tools_exe, processed_dbs, 'union', overlap_db,
+                            merge_tmp, fan_out=merge_fan_out,
+                            jobs=jobs, threads=t, name="overlap_merge",
+                            run=metrics.measure_run(base_run, record), log=log
+                        )
+                    finally:
+                        shutil.rmtree(merge_tmp, ignore_errors=True)
+                    log(f"  ✓ Union completed in {rounds} rounds")
+                elif len(processed_dbs) == 1:
+                    # kmc_tools simple needs two inputs (a --retry-failed or --append
+                    # run may count only one file): the union of one database is a copy
+                    copy_db(processed_dbs[0], overlap_db)
+                    log("  ✓ Union completed (one database, copied)")
+                else:
+                    # Build union command
+                    union_cmd = [kmc_tools_exe, "simple"] + processed_dbs
+                    for i in range(len(processed_dbs) - 1):
+                        union_cmd.append("union")
+                    union_cmd.append(overlap_db)
+                    
+                    run(union_cmd, check=True, capture_output=True, text=True)
+                    log("  ✓ Union completed")
+                
+                # Dump merged database
+                overlap_dump = str(overlap_dir / "overlap_merge_dump.txt")
+                if native_db:
+                    with open(overlap_dump, 'w') as outfile:
+                        KMCDatabase(overlap_db).write_dump(outfile)
+                else:
+                    dump_cmd = [kmc_tools_exe, "transform", overlap_db, "dump", overlap_dump]
+                    run(dump_cmd, check=True, capture_output=True, text=True)
+                log(f"  ✓ Dump completed: overlap_merge_dump.txt")
+                record.add_io(read=file_size(*[path for db_path in processed_dbs for path in db_files(db_path)]),
+                              written=file_size(*db_files(overlap_db), overlap_dump))
+                record.kmers = read_kmer_count(overlap_db)
+                
+            except BatchCancelled:
+                record.ok = False
+            except (subprocess.CalledProcessError, ValueError, OSError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating overlap_merge: {str(e)}"
+                if getattr(e, 'stderr', None):
+                    error_msg += f"\n    stderr: {e.stderr}"
+                log(error_msg)
+                errors.append(error_msg)
     else:
         log("\n" + "=" * 60)
         log("WARNING: No databases were successfully processed, skipping overlap_merge")
     
+    # Create the core and unique k-mer sets
+    if cancelled():
+        return stop_cancelled()
+    if processed_dbs and kmer_sets:
+        errors.extend(write_kmer_sets(
+            kmc_tools_exe, output_folder, work_dir,
+            core_dbs=processed_dbs if 'core' in kmer_sets else None,
+            unique_parts=[(db_path, [(db_path, Path(db_path).name)]) for db_path in processed_dbs]
+            if 'unique' in kmer_sets else None,
+            dump=dump_kmer_sets, fan_out=merge_fan_out, jobs=jobs, threads=t, native_db=native_db,
+            metrics=metrics, run=base_run, log=log
+        ))
+    
     # Create combination_raw (concatenated dumps)
+    if cancelled():
+        return stop_cancelled()
     if processed_dbs:
-        log("\nCreating combination_raw (concatenated text dumps)...")
+        if combination_format == 'indexed':
+            log("\nCreating combination_raw (indexed container of the dumps)...")
+        else:
+            log("\nCreating combination_raw (concatenated text dumps)...")
         combo_dir = Path(output_folder) / "combination_raw"
         combo_dir.mkdir(parents=True, exist_ok=True)
-        combo_file = combo_dir / "combination_raw.txt"
+        combo_file = combo_dir / combination_name(combination_format)
         
-        try:
-            with open(combo_file, 'w') as outfile:
-                for db_path in processed_dbs:
-                    db_dir = Path(db_path).parent
-                    dump_file = db_dir / f"{Path(db_path).name}_dump.txt"
-                    if dump_file.exists():
-                        with open(dump_file, 'r') as infile:
-                            outfile.write(f"# === {dump_file.parent.name} ===\n")
-                            outfile.write(infile.read())
-                            outfile.write("\n")
-            log(f"  ✓ Concatenation completed: combination_raw.txt")
-        except Exception as e:
-            error_msg = f"  ✗ ERROR creating combination_raw: {str(e)}"
-            log(error_msg)
-            errors.append(error_msg)
+        with metrics.stage('combination_raw') as record:
+            try:
+                if combo_state is not None:
+                    # Already folded in while the files were processed
+                    if combo_state['error']:
+                        raise combo_state['error']
+                else:
+                    with CombinationWriter(combo_file, combination_format) as writer:
+                        for db_path in processed_dbs:
+                            write_combination_block(writer, db_path, native_db)
+                log(f"  ✓ Concatenation completed: {combo_file.name}")
+                record.add_io(read=source_bytes(processed_dbs), written=file_size(combo_file))
+            except Exception as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating combination_raw: {str(e)}"
+                log(error_msg)
+                errors.append(error_msg)
     else:
         log("\nWARNING: No databases were successfully processed, skipping combination_raw")
     
     # Create binary_existence (count files where each k-mer appears)
+    if cancelled():
+        return stop_cancelled()
     if processed_dbs:
         log("\nCreating binary_existence (presence/absence across files)...")
         binary_dir = Path(output_folder) / "binary_existence"
         binary_dir.mkdir(parents=True, exist_ok=True)
         binary_file = binary_dir / "binary_existence.txt"
         
-        try:
-            kmer_file_count = {}  # k-mer -> count of files it appears in
-            
-            for db_path in processed_dbs:
-                db_dir = Path(db_path).parent
-                dump_file = db_dir / f"{Path(db_path).name}_dump.txt"
-                if dump_file.exists():
-                    kmers_in_this_file = set()
-                    with open(dump_file, 'r') as infile:
-                        for line in infile:
-                            line = line.strip()
-                            if line and not line.startswith('#'):
-                                parts = line.split()
-                                if len(parts) >= 1:
-                                    kmer = parts[0]
-                                    kmers_in_this_file.add(kmer)
-                    
-                    # Add 1 to count for each unique k-mer seen in this file
-                    for kmer in kmers_in_this_file:
-                        kmer_file_count[kmer] = kmer_file_count.get(kmer, 0) + 1
-            
-            # Write results sorted by k-mer
-            with open(binary_file, 'w') as outfile:
-                outfile.write("# k-mer\tfile_count\n")
-                for kmer in sorted(kmer_file_count.keys()):
-                    outfile.write(f"{kmer}\t{kmer_file_count[kmer]}\n")
-            
-            log(f"  ✓ Binary existence completed: binary_existence.txt")
-            log(f"  Total unique k-mers across all files: {len(kmer_file_count)}")
-        except Exception as e:
-            error_msg = f"  ✗ ERROR creating binary_existence: {str(e)}"
-            log(error_msg)
-            errors.append(error_msg)
+        with metrics.stage('binary_existence') as record:
+            try:
+                db_paths = [db_path for db_path in processed_dbs if source_for(db_path) is not None]
+                sources = [source_for(db_path) for db_path in db_paths]
+                
+                if counter_state is not None:
+                    # Already folded in while the files were processed
+                    if counter_state['error']:
+                        raise counter_state['error']
+                    unique_kmers = counter_state['counter'].write(binary_file, min_files, max_files)
+                elif aggregation == 'stream':
+                    presence_file = binary_dir / "presence_matrix.bin" if presence_matrix else None
+                    unique_kmers = binary_existence_stream(
+                        sources, binary_file, tmp_dir=work_dir, reader=read_kmers,
+                        presence_file=presence_file, file_names=[Path(db_path).name for db_path in db_paths],
+                        min_files=min_files, max_files=max_files
+                    )
+                elif aggregation == 'numpy':
+                    unique_kmers = binary_existence_numpy(sources, binary_file, k=int(k), read_packed=read_packed,
+                                                          min_files=min_files, max_files=max_files)
+                elif aggregation == 'partitioned':
+                    unique_kmers = binary_existence_partitioned(
+                        [str(source) for source in sources], binary_file, kind='kmc_db' if native_db else 'dump',
+                        partitions=partitions, workers=aggregation_workers, tmp_dir=work_dir,
+                        max_bucket_bytes=max_bucket_bytes, k=int(k), min_files=min_files, max_files=max_files
+                    )
+                else:
+                    unique_kmers = binary_existence_memory(sources, binary_file, reader=read_kmers,
+                                                           min_files=min_files, max_files=max_files)
+                
+                log(f"  ✓ Binary existence completed: binary_existence.txt")
+                if presence_matrix:
+                    log(f"  ✓ Presence matrix completed: presence_matrix.bin ({len(db_paths)} files)")
+                if file_filter:
+                    log(f"  K-mers in {min_files or 1} to {max_files or len(db_paths)} files: {unique_kmers}")
+                else:
+                    log(f"  Total unique k-mers across all files: {unique_kmers}")
+                record.add_io(read=source_bytes(db_paths),
+                              written=file_size(binary_file, binary_dir / "presence_matrix.bin"))
+                record.kmers = unique_kmers
+            except Exception as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating binary_existence: {str(e)}"
+                log(error_msg)
+                errors.append(error_msg)
     else:
         log("\nWARNING: No databases were successfully processed, skipping binary_existence")
     
+    # Per-file counts over the binary_existence k-mers, before the dumps are deleted
+    if cancelled():
+        return stop_cancelled()
+    binary_file = Path(output_folder) / "binary_existence" / "binary_existence.txt"
+    if processed_dbs and abundance_matrix and binary_file.exists():
+        log("\nCreating abundance_matrix (per-file k-mer counts, sparse CSR)...")
+        abundance_dir = Path(output_folder) / ABUNDANCE_NAME
+        
+        with metrics.stage('abundance_matrix') as record:
+            try:
+                db_paths = [db_path for db_path in processed_dbs if source_for(db_path) is not None]
+                entries = write_abundance_matrix(
+                    [source_for(db_path) for db_path in db_paths], [Path(db_path).name for db_path in db_paths],
+                    binary_file, abundance_dir, k, kind='kmc_db' if native_db else 'dump'
+                )
+                log(f"  ✓ Abundance matrix completed: {ABUNDANCE_NAME}/ ({len(db_paths)} files, {entries} counts)")
+                record.add_io(read=source_bytes(db_paths), written=file_size(*abundance_dir.iterdir()))
+                record.kmers = entries
+            except (OSError, ValueError, RuntimeError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating abundance_matrix: {str(e)}"
+                log(error_msg)
+                errors.append(error_msg)
+    
     # Clean up individual file folders
-    log("\nCleaning up individual file folders...")
-    import shutil
-    deleted_count = 0
-    for db_path in processed_dbs:
-        db_dir = Path(db_path).parent
+    if keep_intermediates:
+        log(f"\nKeeping {len(processed_dbs)} individual file folders")
+    else:
+        log("\nCleaning up individual file folders...")
+        deleted_count = 0
+        for db_path in processed_dbs:
+            db_dir = Path(db_path).parent
+            try:
+                shutil.rmtree(db_dir)
+                deleted_count += 1
+            except Exception as e:
+                log(f"  Warning: Could not delete {db_dir}: {str(e)}")
+        
+        log(f"  ✓ Deleted {deleted_count} individual file folders")
+    
+    # Record the included inputs; with append, first fold the new files into the existing outputs
+    input_names = {sample_name(fasta_file): fasta_file.name for fasta_file in fasta_files}
+    processed_names = [input_names[Path(db_path).name] for db_path in processed_dbs]
+    outputs_ok = len(errors) == file_errors and not cancelled()
+    if append_to is not None:
+        if processed_dbs and outputs_ok:
+            append_errors = append_outputs(kmc_tools_exe, output_folder, append_to, work_dir, threads=t,
+                                           native_db=native_db, metrics=metrics, run=base_run, log=log)
+            errors.extend(append_errors)
+            outputs_ok = not append_errors
+        elif processed_dbs:
+            log("\nWARNING: The new files' outputs are incomplete, the existing outputs were not changed")
+            outputs_ok = False
+        merge_logs(logs_dir, append_to / LOGS_NAME)
+        if keep_intermediates:
+            # The kept file folders go next to the existing outputs before staging is removed
+            for db_path in processed_dbs:
+                db_dir = Path(db_path).parent
+                try:
+                    shutil.rmtree(append_to / db_dir.name, ignore_errors=True)
+                    shutil.move(str(db_dir), str(append_to / db_dir.name))
+                except OSError as e:
+                    log(f"  Warning: Could not move {db_dir} to {append_to}: {str(e)}")
+        shutil.rmtree(output_folder, ignore_errors=True)
+        output_folder = append_to
+    
+    # Lookup index over the final binary_existence
+    index_file = Path(output_folder) / "binary_existence" / INDEX_NAME
+    if shard is None and processed_dbs and outputs_ok and (index or index_file.exists()):
+        errors.extend(write_kmer_index(index_file.parent, presence_matrix, metrics, log=log))
+    if processed_dbs and outputs_ok:
+        write_kmc_stats(output_folder, [Path(db_path).name for db_path in processed_dbs],
+                        previous=manifest if append_to is not None else None, log=log)
+    manifest_written = False
+    if shard is None and processed_dbs and outputs_ok:
         try:
-            shutil.rmtree(db_dir)
-            deleted_count += 1
-        except Exception as e:
-            log(f"  Warning: Could not delete {db_dir}: {str(e)}")
+            save_manifest(output_folder, k, processed_names, previous=manifest if append_to is not None else None,
+                          options=options)
+            manifest_written = True
+        except OSError as e:
+            log(f"  Warning: Could not write manifest.json: {str(e)}")
     
-    log(f"  ✓ Deleted {deleted_count} individual file folders")
+    # Where the time went
+    log("\nStage timings:")
+    for name, entry in metrics.summary().items():
+        rate = f", {entry['kmers_per_s']:.0f} k-mers/s" if entry['kmers'] and entry['kmers_per_s'] else ""
+        log(f"  {name:<17} {entry['count']:>4}x  wall {entry['wall_s']:.1f} s, "
+            f"child CPU {entry['child_cpu_s']:.1f} s, "
+            f"peak child RSS {entry['child_peak_rss_bytes'] / 1024 ** 2:.0f} MB{rate}")
     
     # Summary
     log("\n" + "=" * 60)
@@ -209,16 +1244,896 @@ def run_kmc_batch(kmc_exe, kmc_tools_exe, input_folder, output_folder, work_dir,
     log(f"Successfully processed: {len(processed_dbs)}/{len(fasta_files)} files")
     log(f"\nFinal outputs:")
     log(f"  - overlap_merge/overlap_merge_dump.txt")
-    log(f"  - combination_raw/combination_raw.txt")
+    log(f"  - combination_raw/{combination_name(combination_format)}")
     log(f"  - binary_existence/binary_existence.txt")
+    if presence_matrix:
+        log(f"  - binary_existence/presence_matrix.bin")
+    if abundance_matrix:
+        log(f"  - {ABUNDANCE_NAME}/ (kmers.npy, indptr.npy, indices.npy, data.npy, samples.json)")
+    if index_file.exists():
+        log(f"  - binary_existence/{INDEX_NAME}")
+    if 'core' in kmer_sets:
+        log(f"  - {KMER_SETS['core']}/{KMER_SETS['core']}" + (" (+ dump)" if dump_kmer_sets else ""))
+    if 'unique' in kmer_sets:
+        log(f"  - {KMER_SETS['unique']}/<file>" + (" (+ dumps)" if dump_kmer_sets else ""))
+    if (Path(output_folder) / f"{STATS_NAME}.tsv").exists():
+        log(f"  - {STATS_NAME}.tsv, {STATS_NAME}.json")
+    if keep_intermediates:
+        log(f"  - <file>/ (KMC database{'' if native_db else ' and dump'} of each input file)")
+    log(f"  - {LOGS_NAME}/ (KMC and kmc_tools output)")
+    log(f"  - run_report.json")
+    if manifest_written:
+        log(f"  - manifest.json")
+    if trace:
+        log(f"  - run_trace.json")
+    recovered = [fasta_file for fasta_file in fasta_files if attempts.get(fasta_file, 0) > 1
+                 and fasta_file not in failures]
+    if recovered:
+        log(f"\nTransient failures (succeeded on a retry): {len(recovered)}")
+        for fasta_file in recovered:
+            log(f"  {fasta_file.name} (attempt {attempts[fasta_file]})")
+    if failures:
+        log(f"\nPermanent failures (failed every attempt): {len(failures)}")
+        for fasta_file in fasta_files:
+            if fasta_file in failures:
+                tries = attempts.get(fasta_file, 1)
+                log(f"  {fasta_file.name} ({tries} attempt{'s' if tries != 1 else ''})")
+        if shard is None:
+            log("  Rerun only these with --retry-failed")
     if errors:
         log(f"\nErrors encountered: {len(errors)}")
         log("\nError details:")
         for error in errors:
             log(error)
     
+    write_report(len(errors) == 0)
     return len(errors) == 0
 
+def write_kmer_index(binary_dir, presence=False, metrics=None, log=log):
+    """Build the lookup index of binary_dir/binary_existence.txt, return the errors
+    
+    With presence the index rows point into presence_matrix.bin.
+    """
+    binary_file = Path(binary_dir) / "binary_existence.txt"
+    index_file = Path(binary_dir) / INDEX_NAME
+    presence_file = Path(binary_dir) / "presence_matrix.bin" if presence else None
+    stage = metrics.stage if metrics is not None else null_stage
+    log("\nBuilding the k-mer lookup index...")
+    with stage('kmer_index') as record:
+        try:
+            rows = build_index(binary_file, index_file, presence_file=presence_file)
+            log(f"  ✓ K-mer index completed: {INDEX_NAME} ({rows} k-mers)")
+            record.add_io(read=file_size(binary_file), written=file_size(index_file))
+            record.kmers = rows
+        except (OSError, ValueError) as e:
+            record.ok = False
+            error_msg = f"  ✗ ERROR creating {INDEX_NAME}: {str(e)}"
+            log(error_msg)
+            return [error_msg]
+    return []
+
+def write_kmc_stats(output_folder, names, previous=None, logs_dirs=None, log=log):
+    """Write the per-file KMC statistics table of an output folder, warning instead of failing
+    
+    names are the sample names of the files counted; previous (the
+    manifest an append extends) adds the files already included. The KMC
+    summaries are read from logs_dirs (default: output_folder/logs).
+    """
+    if previous:
+        names = list(names) + [sample_name(name) for name in previous['files']]
+    try:
+        rows = write_stats_table(output_folder, names, logs_dirs=logs_dirs)
+    except OSError as e:
+        log(f"  Warning: Could not write {STATS_NAME}.tsv: {str(e)}")
+        return
+    if rows:
+        log(f"\nKMC statistics of {rows} files written to {STATS_NAME}.tsv")
+
+def write_set_dump(kmc_tools_exe, db_path, dump_file, native_db=False, run=run_child):
+    """Dump a k-mer set database to text"""
+    if native_db:
+        with open(dump_file, 'w') as outfile:
+            KMCDatabase(db_path).write_dump(outfile)
+    else:
+        run([kmc_tools_exe, "transform", str(db_path), "dump", str(dump_file)],
+            check=True, capture_output=True, text=True)
+
+def write_kmer_sets(kmc_tools_exe, output_folder, work_dir, core_dbs=None, unique_parts=None, dump=False,
+                    fan_out=None, jobs=1, threads=None, native_db=False, metrics=None, run=run_child, log=log):
+    """Build the core and per-file unique k-mer databases in output_folder, return the errors
+    
+    core_dbs are intersected into core_intersect/core_intersect. Each of
+    unique_parts is (db, [(target_db, name)]): every target loses the
+    k-mers of the other parts' databases and is written to
+    unique_kmers/name. A run passes each file's database as its own
+    target; merge-shards and --append pass each part's overlap_merge with
+    the unique databases it already has. Both are kmc_tools trees with at
+    most fan_out (16 by default) inputs per call, running up to jobs calls
+    at a time. With dump every database is also dumped to name_dump.txt.
+    """
+    metrics = metrics if metrics is not None else RunMetrics()
+    errors = []
+    fan_out = fan_out or 16
+    sets_tmp = Path(work_dir) / "kmer_sets_tmp"
+    
+    if core_dbs:
+        log("\nCreating core_intersect (k-mers present in every file)...")
+        core_dir = Path(output_folder) / KMER_SETS['core']
+        core_dir.mkdir(parents=True, exist_ok=True)
+        core_db = str(core_dir / KMER_SETS['core'])
+        with metrics.stage('core_intersect') as record:
+            try:
+                try:
+                    rounds = tree_reduce(kmc_tools_exe, core_dbs, 'intersect', core_db, sets_tmp, fan_out=fan_out,
+                                         jobs=jobs, threads=threads, name="core_intersect",
+                                         run=metrics.measure_run(run, record), log=log)
+                finally:
+                    shutil.rmtree(sets_tmp, ignore_errors=True)
+                written = db_files(core_db)
+                if dump:
+                    dump_file = core_dir / "core_intersect_dump.txt"
+                    write_set_dump(kmc_tools_exe, core_db, dump_file, native_db, metrics.measure_run(run, record))
+                    written.append(dump_file)
+                record.kmers = read_kmer_count(core_db)
+                record.add_io(read=file_size(*[path for db_path in core_dbs for path in db_files(db_path)]),
+                              written=file_size(*written))
+                log(f"  ✓ Intersection completed in {rounds} rounds: {record.kmers} core k-mers")
+            except BatchCancelled:
+                record.ok = False
+                errors.append("  ✗ Cancelled while creating core_intersect")
+            except (subprocess.CalledProcessError, ValueError, OSError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating core_intersect: {str(e)}"
+                if getattr(e, 'stderr', None):
+                    error_msg += f"\n    stderr: {e.stderr}"
+                log(error_msg)
+                errors.append(error_msg)
+    
+    if unique_parts:
+        log("\nCreating unique_kmers (k-mers found in a single file)...")
+        unique_dir = Path(output_folder) / KMER_SETS['unique']
+        unique_dir.mkdir(parents=True, exist_ok=True)
+        targets = [[(target_db, unique_dir / name) for target_db, name in part_targets]
+                   for _, part_targets in unique_parts]
+        outputs = [str(output_db) for part_targets in targets for _, output_db in part_targets]
+        with metrics.stage('unique_kmers') as record:
+            try:
+                measured = metrics.measure_run(run, record)
+                try:
+                    depth = subtract_others(kmc_tools_exe, [db_path for db_path, _ in unique_parts], targets,
+                                            sets_tmp, fan_out=fan_out, jobs=jobs, threads=threads,
+                                            name="unique_kmers", run=measured, log=log)
+                finally:
+                    shutil.rmtree(sets_tmp, ignore_errors=True)
+                written = [path for db_path in outputs for path in db_files(db_path)]
+                if dump:
+                    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+                        futures = [executor.submit(write_set_dump, kmc_tools_exe, db_path, f"{db_path}_dump.txt",
+                                                   native_db, measured) for db_path in outputs]
+                        for future in futures:
+                            future.result()
+                    written.extend(f"{db_path}_dump.txt" for db_path in outputs)
+                record.kmers = sum(read_kmer_count(db_path) for db_path in outputs)
+                record.add_io(read=file_size(*[path for db_path, _ in unique_parts for path in db_files(db_path)]),
+                              written=file_size(*written))
+                log(f"  ✓ Subtraction tree of depth {depth} completed: {len(outputs)} files, "
+                    f"{record.kmers} unique k-mers")
+            except BatchCancelled:
+                record.ok = False
+                errors.append("  ✗ Cancelled while creating unique_kmers")
+            except (subprocess.CalledProcessError, ValueError, OSError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating unique_kmers: {str(e)}"
+                if getattr(e, 'stderr', None):
+                    error_msg += f"\n    stderr: {e.stderr}"
+                log(error_msg)
+                errors.append(error_msg)
+    return errors
+
+def part_kmer_sets(folder):
+    """Return (core db or None, [(unique db, name)] or None) of the k-mer sets an output folder has"""
+    folder = Path(folder)
+    core_db = folder / KMER_SETS['core'] / KMER_SETS['core']
+    unique_dir = folder / KMER_SETS['unique']
+    uniques = None
+    if unique_dir.is_dir():
+        uniques = [(str(pre.with_suffix('')), pre.stem) for pre in sorted(unique_dir.glob("*.kmc_pre"))]
+    return (str(core_db) if db_exists(core_db) else None), uniques
+
+def has_set_dumps(folder):
+    """Whether the k-mer sets of an output folder were dumped to text"""
+    return any(next((Path(folder) / name).glob("*_dump.txt"), None) for name in KMER_SETS.values())
+
+def append_outputs(kmc_tools_exe, staging_folder, output_folder, work_dir, threads=None, native_db=False,
+                   metrics=None, run=run_child, log=log):
+    """Fold the outputs of a run over new files (staging_folder) into existing outputs
+    
+    binary_existence (and its presence matrix) is merged with the new
+    counts in one streaming pass, the abundance matrix gets the new files'
+    rows over the merged k-mers, overlap_merge is unioned with the new
+    files' union database by kmc_tools and dumped again, and the new
+    combination_raw blocks are appended. Nothing is recounted. Existing
+    k-mer sets are updated from the staged ones: core_intersect is
+    intersected with the new core, old unique databases lose the new
+    files' k-mers and new ones lose the old overlap_merge's. The new
+    binary_existence, overlap_merge and k-mer sets are built under
+    temporary names and only replace the old ones when all are complete.
+    Returns the list of errors.
+    """
+    metrics = metrics if metrics is not None else RunMetrics()
+    errors = []
+    staging_folder = Path(staging_folder)
+    output_folder = Path(output_folder)
+    log("\n" + "=" * 60)
+    log("Adding the new files to the existing outputs...")
+    
+    binary_dir = output_folder / "binary_existence"
+    binary_file = binary_dir / "binary_existence.txt"
+    presence_file = binary_dir / "presence_matrix.bin"
+    new_binary = staging_folder / "binary_existence" / "binary_existence.txt"
+    new_presence = staging_folder / "binary_existence" / "presence_matrix.bin"
+    abundance_dir = output_folder / ABUNDANCE_NAME
+    new_abundance = staging_folder / ABUNDANCE_NAME
+    merged_abundance = output_folder / f"{ABUNDANCE_NAME}.tmp"
+    overlap_dir = output_folder / "overlap_merge"
+    overlap_db = str(overlap_dir / "overlap_merge")
+    overlap_dump = overlap_dir / "overlap_merge_dump.txt"
+    new_overlap_db = str(staging_folder / "overlap_merge" / "overlap_merge")
+    merged_db = str(overlap_dir / "overlap_merge_appended")
+    replacements = []  # (built file, final file)
+    
+    # Build the merged binary_existence
+    with metrics.stage('append_binary_existence') as record:
+        try:
+            if binary_file.exists():
+                merged_binary = binary_dir / "binary_existence.txt.tmp"
+                merged_presence = binary_dir / "presence_matrix.bin.tmp"
+                presence = presence_file.exists() and new_presence.exists()
+                unique_kmers = merge_binary_existence(
+                    [binary_file, new_binary], merged_binary,
+                    presence_files=[presence_file, new_presence] if presence else None,
+                    presence_file=merged_presence if presence else None
+                )
+                replacements.append((merged_binary, binary_file))
+                if presence:
+                    replacements.append((merged_presence, presence_file))
+                record.add_io(read=file_size(binary_file, new_binary, presence_file, new_presence),
+                              written=file_size(merged_binary, merged_presence))
+            else:
+                binary_dir.mkdir(parents=True, exist_ok=True)
+                unique_kmers = sum(1 for _ in read_kmer_counts(new_binary))
+                replacements.append((new_binary, binary_file))
+                if new_presence.exists():
+                    replacements.append((new_presence, presence_file))
+            record.kmers = unique_kmers
+            log(f"  ✓ binary_existence merged ({unique_kmers} unique k-mers)")
+        except (OSError, ValueError) as e:
+            record.ok = False
+            error_msg = f"  ✗ ERROR merging binary_existence: {str(e)}"
+            log(error_msg)
+            errors.append(error_msg)
+    
+    # Add the new files' rows to the abundance matrix, over the merged k-mers
+    if not errors and new_abundance.is_dir():
+        with metrics.stage('append_abundance_matrix') as record:
+            try:
+                parts = [abundance_dir, new_abundance] if abundance_dir.is_dir() else [new_abundance]
+                built_binary = next(built for built, final in replacements if final == binary_file)
+                entries = merge_abundance_matrices(parts, built_binary, merged_abundance)
+                record.add_io(read=file_size(*[path for part in parts for path in part.iterdir()]),
+                              written=file_size(*merged_abundance.iterdir()))
+                record.kmers = entries
+                log(f"  ✓ abundance_matrix extended ({entries} counts)")
+            except (OSError, ValueError, RuntimeError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR merging abundance_matrix: {str(e)}"
+                log(error_msg)
+                errors.append(error_msg)
+    
+    # Build the merged overlap_merge database and dump
+    if not errors:
+        with metrics.stage('append_overlap_merge') as record:
+            try:
+                overlap_dir.mkdir(parents=True, exist_ok=True)
+                if db_exists(overlap_db):
+                    merge_tmp = Path(work_dir) / "append_merge_tmp"
+                    try:
+                        tree_reduce(kmc_tools_exe, [overlap_db, new_overlap_db], 'union', merged_db, merge_tmp,
+                                    fan_out=2, threads=threads, name="overlap_merge",
+                                    run=metrics.measure_run(run, record))
+                    finally:
+                        shutil.rmtree(merge_tmp, ignore_errors=True)
+                else:
+                    copy_db(new_overlap_db, merged_db)
+                merged_dump = overlap_dir / "overlap_merge_dump.txt.tmp"
+                if native_db:
+                    with open(merged_dump, 'w') as outfile:
+                        KMCDatabase(merged_db).write_dump(outfile)
+                else:
+                    metrics.measure_run(run, record)(
+                        [kmc_tools_exe, "transform", merged_db, "dump", str(merged_dump)],
+                        check=True, capture_output=True, text=True
+                    )
+                for merged, final in zip(db_files(merged_db), db_files(overlap_db)):
+                    replacements.append((Path(merged), Path(final)))
+                replacements.append((merged_dump, overlap_dump))
+                record.add_io(read=file_size(*db_files(overlap_db), *db_files(new_overlap_db)),
+                              written=file_size(*db_files(merged_db), merged_dump))
+                record.kmers = read_kmer_count(merged_db)
+                log("  ✓ overlap_merge unioned with the new files")
+            except BatchCancelled:
+                record.ok = False
+                errors.append("  ✗ Cancelled while merging overlap_merge")
+            except (subprocess.CalledProcessError, ValueError, OSError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR merging overlap_merge: {str(e)}"
+                if getattr(e, 'stderr', None):
+                    error_msg += f"\n    stderr: {e.stderr}"
+                log(error_msg)
+                errors.append(error_msg)
+    
+    # Update the k-mer sets (built in the staging folder, which holds the new files' sets)
+    old_core, old_uniques = part_kmer_sets(output_folder)
+    new_core, new_uniques = part_kmer_sets(staging_folder)
+    sets_folder = staging_folder / "kmer_sets"
+    if not errors and (old_core or old_uniques is not None):
+        errors.extend(write_kmer_sets(
+            kmc_tools_exe, sets_folder, work_dir,
+            core_dbs=[old_core, new_core] if old_core and new_core else None,
+            unique_parts=[(overlap_db, old_uniques), (new_overlap_db, new_uniques)]
+            if old_uniques is not None and new_uniques is not None else None,
+            dump=has_set_dumps(output_folder), fan_out=2, threads=threads, native_db=native_db,
+            metrics=metrics, run=run, log=log
+        ))
+    
+    if errors:
+        for built, _ in replacements:
+            if staging_folder not in Path(built).parents:
+                try:
+                    os.remove(built)
+                except OSError:
+                    pass
+        remove_db(merged_db)
+        shutil.rmtree(merged_abundance, ignore_errors=True)
+        log("  The existing outputs were not changed")
+        return errors
+    
+    # Everything is built: swap the files in, then append combination_raw
+    for built, final in replacements:
+        os.replace(built, final)
+    if merged_abundance.is_dir():
+        replace_matrix(merged_abundance, abundance_dir)
+    for folder in KMER_SETS.values():
+        if (sets_folder / folder).is_dir():
+            old_folder = output_folder / f"{folder}.old"
+            os.replace(output_folder / folder, old_folder)
+            os.replace(sets_folder / folder, output_folder / folder)
+            shutil.rmtree(old_folder, ignore_errors=True)
+    with metrics.stage('append_combination_raw') as record:
+        # The staging run wrote the same format as the existing outputs
+        combination_format = 'indexed' if (staging_folder / "combination_raw" / CONTAINER_NAME).exists() else 'text'
+        new_combo = staging_folder / "combination_raw" / combination_name(combination_format)
+        combo_file = output_folder / "combination_raw" / new_combo.name
+        try:
+            combo_file.parent.mkdir(parents=True, exist_ok=True)
+            with CombinationWriter(combo_file, combination_format, append=True) as writer:
+                writer.extend(new_combo)
+            record.add_io(read=file_size(new_combo), written=file_size(new_combo))
+            log("  ✓ combination_raw extended with the new files")
+        except (OSError, ValueError) as e:
+            record.ok = False
+            error_msg = f"  ✗ ERROR appending to combination_raw: {str(e)}"
+            log(error_msg)
+            errors.append(error_msg)
+    return errors
+
+def merge_shard_outputs(kmc_tools_exe, shard_dirs, output_folder, work_dir, jobs=1, threads=None,
+                        merge_fan_out=None, native_db=False, index=False, min_files=None, max_files=None, log=log):
+    """Combine the outputs of --shard runs into the final outputs, without recounting
+    
+    overlap_merge is the kmc_tools union of the shard overlap_merge
+    databases (as a tree with at most merge_fan_out per call, 16 by
+    default), combination_raw gets the shard blocks back in input order
+    and binary_existence is a streaming merge of the sorted shard files
+    with counts summed. A presence matrix or abundance matrix is merged
+    only if every shard wrote one, its files put back in input order too. min_files and max_files drop k-mers by their total file
+    count while binary_existence is merged. index also builds the k-mer
+    lookup index of the merged binary_existence. K-mer sets every shard
+    wrote are merged: core_intersect intersects the shard cores and each
+    shard's unique databases lose the k-mers of the other shards'
+    overlap_merge. The shards' KMC statistics are combined into one
+    kmc_stats.tsv. Returns True if everything was created.
+    """
+    metrics = RunMetrics()
+    base_run = ChildLogs(Path(output_folder) / LOGS_NAME).wrap(run_child)
+    run = metrics.measure_run(base_run)
+    errors = []
+    
+    try:
+        shards = load_shards(shard_dirs)
+    except ValueError as e:
+        log(f"ERROR: {str(e)}")
+        return False
+    
+    total_files = shards[0][1]['total_files']
+    processed = sum(len(manifest['processed']) for _, manifest in shards)
+    log(f"Merging {len(shards)} shards: {processed}/{total_files} files processed")
+    for shard_dir, manifest in shards:
+        if manifest['errors']:
+            log(f"  Warning: shard {manifest['shard']} finished with {manifest['errors']} errors")
+    log("=" * 60)
+    
+    Path(output_folder).mkdir(parents=True, exist_ok=True)
+    
+    # Create overlap_merge
+    shard_dbs = [str(shard_dir / "overlap_merge" / "overlap_merge") for shard_dir, _ in shards]
+    shard_dbs = [db_path for db_path in shard_dbs if db_exists(db_path)]
+    if shard_dbs:
+        log("Creating overlap_merge (union of the shard overlap_merge databases)...")
+        overlap_dir = Path(output_folder) / "overlap_merge"
+        overlap_dir.mkdir(parents=True, exist_ok=True)
+        overlap_db = str(overlap_dir / "overlap_merge")
+        overlap_dump = str(overlap_dir / "overlap_merge_dump.txt")
+        merge_tmp = Path(work_dir) / "merge_shards_tmp"
+        
+        with metrics.stage('overlap_merge') as record:
+            try:
+                try:
+                    rounds = tree_reduce(
+                        kmc_tools_exe, shard_dbs, 'union', overlap_db, merge_tmp,
+                        fan_out=merge_fan_out or 16, jobs=jobs, threads=threads,
+                        name="overlap_merge", run=run, log=log
+                    )
+                finally:
+                    shutil.rmtree(merge_tmp, ignore_errors=True)
+                log(f"  ✓ Union completed in {rounds} rounds")
+                if native_db:
+                    with open(overlap_dump, 'w') as outfile:
+                        KMCDatabase(overlap_db).write_dump(outfile)
+                else:
+                    run([kmc_tools_exe, "transform", overlap_db, "dump", overlap_dump],
+                        check=True, capture_output=True, text=True)
+                log(f"  ✓ Dump completed: overlap_merge_dump.txt")
+                record.add_io(read=file_size(*[path for db_path in shard_dbs for path in db_files(db_path)]),
+                              written=file_size(*db_files(overlap_db), overlap_dump))
+                record.kmers = read_kmer_count(overlap_db)
+            except (subprocess.CalledProcessError, ValueError, OSError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating overlap_merge: {str(e)}"
+                if getattr(e, 'stderr', None):
+                    error_msg += f"\n    stderr: {e.stderr}"
+                log(error_msg)
+                errors.append(error_msg)
+    else:
+        log("WARNING: No shard has an overlap_merge database, skipping overlap_merge")
+    
+    # Merge the k-mer sets of the shards that have files
+    shard_sets = [part_kmer_sets(Path(db_path).parent.parent) for db_path in shard_dbs]
+    shard_cores = [core for core, _ in shard_sets]
+    shard_uniques = [uniques for _, uniques in shard_sets]
+    core_dbs = shard_cores if shard_sets and all(shard_cores) else None
+    unique_parts = list(zip(shard_dbs, shard_uniques)) if shard_sets and None not in shard_uniques else None
+    if core_dbs or unique_parts:
+        errors.extend(write_kmer_sets(
+            kmc_tools_exe, output_folder, work_dir, core_dbs=core_dbs, unique_parts=unique_parts,
+            dump=any(has_set_dumps(shard_dir) for shard_dir, _ in shards), fan_out=merge_fan_out, jobs=jobs,
+            threads=threads, native_db=native_db, metrics=metrics, run=base_run, log=log
+        ))
+    
+    # The merged outputs list the files in input order, whichever shard counted them
+    names = sorted(name for _, manifest in shards for name in manifest['inputs'])
+    position = {sample_name(name): i for i, name in enumerate(names)}
+    file_order = sorted((name for _, manifest in shards for name in manifest['processed']),
+                        key=lambda name: position.get(name, len(position)))
+    
+    # Create combination_raw (shard blocks back in input order)
+    shard_combos = []
+    for shard_dir, _ in shards:
+        for combination_format in COMBINATION_FORMATS:
+            shard_combo = shard_dir / "combination_raw" / combination_name(combination_format)
+            if shard_combo.exists():
+                shard_combos.append((shard_combo, combination_format))
+                break
+    if shard_combos:
+        log("\nCreating combination_raw (shard blocks in input order)...")
+        combo_dir = Path(output_folder) / "combination_raw"
+        combo_dir.mkdir(parents=True, exist_ok=True)
+        combination_format = shard_combos[0][1]
+        combo_file = combo_dir / combination_name(combination_format)
+        
+        with metrics.stage('combination_raw') as record:
+            try:
+                if len({shard_format for _, shard_format in shard_combos}) > 1:
+                    raise ValueError("the shards wrote combination_raw in different formats (--combination-format)")
+                blocks = []
+                for n, (shard_combo, _) in enumerate(shard_combos):
+                    if combination_format == 'indexed':
+                        shard_blocks = [(name, offset, offset + size)
+                                        for name, offset, size in CombinationContainer(shard_combo).blocks]
+                    else:
+                        # Text blocks are '# === name ===' + dump + a blank line; keep only the dump
+                        shard_blocks = [(name, start + len(f"# === {name} ===\n".encode('utf-8')), end - 1)
+                                        for name, start, end in combination_blocks(shard_combo)]
+                    for name, start, end in shard_blocks:
+                        blocks.append((position.get(name, len(position)), n, name, start, end))
+                sources = [open(shard_combo, 'rb') for shard_combo, _ in shard_combos]
+                try:
+                    with CombinationWriter(combo_file, combination_format) as writer:
+                        for _, n, name, start, end in sorted(blocks):
+                            writer.add_range(name, sources[n], start, end)
+                finally:
+                    for source in sources:
+                        source.close()
+                log(f"  ✓ Concatenation completed: {combo_file.name} ({len(blocks)} files)")
+                record.add_io(read=file_size(*[shard_combo for shard_combo, _ in shard_combos]),
+                              written=file_size(combo_file))
+            except (OSError, ValueError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating combination_raw: {str(e)}"
+                log(error_msg)
+                errors.append(error_msg)
+    else:
+        log("\nWARNING: No shard has a combination_raw file, skipping combination_raw")
+    
+    # Create binary_existence (sum the shard counts per k-mer)
+    shard_binaries = [shard_dir / "binary_existence" for shard_dir, _ in shards]
+    shard_binaries = [folder for folder in shard_binaries if (folder / "binary_existence.txt").exists()]
+    presence = bool(shard_binaries) and all((folder / "presence_matrix.bin").exists() for folder in shard_binaries)
+    if shard_binaries:
+        log("\nCreating binary_existence (merge of the shard counts)...")
+        binary_dir = Path(output_folder) / "binary_existence"
+        binary_dir.mkdir(parents=True, exist_ok=True)
+        binary_file = binary_dir / "binary_existence.txt"
+        count_files = [folder / "binary_existence.txt" for folder in shard_binaries]
+        presence_files = [folder / "presence_matrix.bin" for folder in shard_binaries] if presence else None
+        
+        with metrics.stage('binary_existence') as record:
+            try:
+                unique_kmers = merge_binary_existence(
+                    count_files, binary_file, presence_files=presence_files,
+                    presence_file=binary_dir / "presence_matrix.bin" if presence else None,
+                    file_names=file_order, min_files=min_files, max_files=max_files
+                )
+                log(f"  ✓ Binary existence completed: binary_existence.txt")
+                if presence:
+                    log(f"  ✓ Presence matrix completed: presence_matrix.bin ({processed} files, in input order)")
+                log(f"  Total unique k-mers across all files: {unique_kmers}")
+                record.add_io(read=file_size(*count_files, *(presence_files or [])),
+                              written=file_size(binary_file, binary_dir / "presence_matrix.bin"))
+                record.kmers = unique_kmers
+            except (OSError, ValueError) as e:
+                record.ok = False
+                error_msg = f"  ✗ ERROR creating binary_existence: {str(e)}"
+                log(error_msg)
+                errors.append(error_msg)
+        if record.ok and (index or (binary_dir / INDEX_NAME).exists()):
+            errors.extend(write_kmer_index(binary_dir, presence, metrics, log=log))
+        
+        # Stack the shard abundance matrices over the merged k-mers
+        shard_abundances = [shard_dir / ABUNDANCE_NAME for shard_dir, _ in shards]
+        if record.ok and all(folder.is_dir() for folder in shard_abundances):
+            log("\nCreating abundance_matrix (rows of the shard matrices)...")
+            abundance_dir = Path(output_folder) / ABUNDANCE_NAME
+            with metrics.stage('abundance_matrix') as record:
+                try:
+                    merged_abundance = Path(output_folder) / f"{ABUNDANCE_NAME}.tmp"
+                    entries = merge_abundance_matrices(shard_abundances, binary_file, merged_abundance,
+                                                       names=file_order)
+                    replace_matrix(merged_abundance, abundance_dir)
+                    log(f"  ✓ Abundance matrix completed: {ABUNDANCE_NAME}/ ({processed} files, in input order)")
+                    parts = [path for folder in shard_abundances for path in folder.iterdir()]
+                    record.add_io(read=file_size(*parts), written=file_size(*abundance_dir.iterdir()))
+                    record.kmers = entries
+                except (OSError, ValueError, RuntimeError) as e:
+                    record.ok = False
+                    error_msg = f"  ✗ ERROR creating abundance_matrix: {str(e)}"
+                    log(error_msg)
+                    errors.append(error_msg)
+    else:
+        log("\nWARNING: No shard has a binary_existence file, skipping binary_existence")
+    
+    # Per-file KMC statistics of all shards
+    write_kmc_stats(output_folder, [name for _, manifest in shards for name in manifest['processed']],
+                    logs_dirs=[shard_dir / LOGS_NAME for shard_dir, _ in shards], log=log)
+    
+    log("\n" + "=" * 60)
+    log(f"MERGE COMPLETE!")
+    log(f"Merged {len(shards)} shards, {processed}/{total_files} files")
+    if errors:
+        log(f"\nErrors encountered: {len(errors)}")
+        for error in errors:
+            log(error)
+    
+    metrics.info.update({
+        'output_folder': str(output_folder),
+        'merged_shards': [str(shard_dir) for shard_dir, _ in shards],
+        'k': shards[0][1]['k'], 'files': total_files, 'processed': processed,
+        'errors': len(errors), 'success': not errors,
+    })
+    try:
+        metrics.write_report(Path(output_folder) / "run_report.json")
+    except OSError as e:
+        log(f"Warning: Could not write the run report: {str(e)}")
+    return not errors
+
+def merge_shards_main(argv):
+    """Command line of 'merge-shards'"""
+    parser = argparse.ArgumentParser(
+        prog='kmc_batch_cli.py merge-shards',
+        description='Combine the outputs of --shard runs into the final overlap_merge, '
+                    'combination_raw and binary_existence'
+    )
+    parser.add_argument('--kmc-tools', required=True, help='Path to KMC_tools executable')
+    parser.add_argument('--output', required=True,
+                        help='Output folder given to the shard runs; the merged outputs are written here')
+    parser.add_argument('--shards', nargs='+',
+                        help='Shard folders to merge (default: every shard_i_of_N folder in --output)')
+    parser.add_argument('--workdir', help='Working directory for temporary files (default: --output)')
+    parser.add_argument('--jobs', type=int, default=1, help='Concurrent kmc_tools unions (default: 1)')
+    parser.add_argument('--threads', type=int, default=4, help='Number of threads (default: 4)')
+    parser.add_argument('--merge-fan-out', type=int, default=16,
+                        help='At most N databases per kmc_tools union (default: 16)')
+    parser.add_argument('--native-db', action='store_true',
+                        help='Dump overlap_merge with the built-in KMC database reader instead of kmc_tools')
+    parser.add_argument('--index', action='store_true',
+                        help=f'Also build binary_existence/{INDEX_NAME} for the query command')
+    parser.add_argument('--min-files', type=positive_int,
+                        help='Keep only k-mers found in at least N files in binary_existence')
+    parser.add_argument('--max-files', type=positive_int,
+                        help='Keep only k-mers found in at most N files in binary_existence')
+    args = parser.parse_args(argv)
+    
+    if not Path(args.kmc_tools).exists():
+        log(f"ERROR: KMC_tools executable not found: {args.kmc_tools}")
+        sys.exit(1)
+    if not Path(args.output).is_dir():
+        log(f"ERROR: Output folder not found: {args.output}")
+        sys.exit(1)
+    shard_dirs = args.shards if args.shards else find_shard_dirs(args.output)
+    work_dir = args.workdir if args.workdir else args.output
+    Path(work_dir).mkdir(parents=True, exist_ok=True)
+    
+    log("KMC Batch Processing - Merging shards")
+    log("=" * 60)
+    success = merge_shard_outputs(
+        args.kmc_tools, shard_dirs, args.output, work_dir,
+        jobs=args.jobs, threads=args.threads, merge_fan_out=args.merge_fan_out, native_db=args.native_db,
+        index=args.index, min_files=args.min_files, max_files=args.max_files
+    )
+    sys.exit(0 if success else 1)
+
+def query_main(argv):
+    """Command line of 'query'"""
+    parser = argparse.ArgumentParser(
+        prog='kmc_batch_cli.py query',
+        description='Look up k-mers in the binary_existence lookup index: the number of files containing '
+                    'each k-mer and, if the run wrote a presence matrix, which files'
+    )
+    parser.add_argument('--output', help=f'Output folder of a run (uses binary_existence/{INDEX_NAME})')
+    parser.add_argument('--index', help='Index file (instead of --output)')
+    parser.add_argument('--kmer', nargs='+', default=[], help='K-mers to look up')
+    parser.add_argument('--file', help="File with one query k-mer per line ('-' for stdin)")
+    parser.add_argument('--prefix', nargs='+', default=[], help='List the k-mers starting with these bases')
+    parser.add_argument('--limit', type=int, help='At most N k-mers per prefix')
+    parser.add_argument('--files', action='store_true',
+                        help='Also list the files containing each k-mer (needs --presence-matrix outputs)')
+    parser.add_argument('--no-canonical', action='store_true',
+                        help='Look up k-mers as given instead of as KMC counts them (smaller of k-mer and '
+                             'reverse complement)')
+    parser.add_argument('--build', action='store_true',
+                        help='Build (or rebuild) the index from binary_existence.txt in --output first')
+    parser.add_argument('--results', help='Write the results to this file (default: standard output)')
+    args = parser.parse_args(argv)
+    
+    def message(text):
+        print(text, file=sys.stderr)
+    
+    if bool(args.output) == bool(args.index):
+        parser.error("give either --output or --index")
+    if args.build and not args.output:
+        parser.error("--build needs --output")
+    if not (args.kmer or args.file or args.prefix or args.build):
+        parser.error("nothing to look up: give --kmer, --file or --prefix")
+    
+    index_file = Path(args.index) if args.index else Path(args.output) / "binary_existence" / INDEX_NAME
+    if args.build:
+        binary_dir = index_file.parent
+        if not (binary_dir / "binary_existence.txt").exists():
+            message(f"ERROR: binary_existence.txt not found in {binary_dir}")
+            sys.exit(1)
+        if write_kmer_index(binary_dir, (binary_dir / "presence_matrix.bin").exists(), log=message):
+            sys.exit(1)
+    if not index_file.exists():
+        message(f"ERROR: Index not found: {index_file} (build it with --build, or run with --index)")
+        sys.exit(1)
+    
+    try:
+        index = KmerIndex(index_file)
+        matrix = index.presence_matrix() if args.files else None
+    except (OSError, ValueError) as e:
+        message(f"ERROR: {str(e)}")
+        sys.exit(1)
+    if args.files and matrix is None:
+        message(f"ERROR: {index_file} has no presence matrix; rerun with --presence-matrix to list files")
+        sys.exit(1)
+    canonical = not args.no_canonical
+    outfile = open(args.results, 'w') if args.results else sys.stdout
+    
+    def write_rows(kmers, rows):
+        """Write the result lines, return (found, invalid)"""
+        lines = []
+        invalid = 0
+        for kmer, row in zip(kmers, rows):
+            if row == INVALID:
+                # Not a k-mer of the index: marked rather than reported absent
+                invalid += 1
+                count = "invalid"
+            else:
+                count = index.count(row) if row >= 0 else 0
+            if matrix is not None:
+                files = ",".join(matrix.row_files(row)) if row >= 0 else ""
+                lines.append(f"{kmer}\t{count}\t{files}\n")
+            else:
+                lines.append(f"{kmer}\t{count}\n")
+        outfile.write("".join(lines))
+        return sum(1 for row in rows if row >= 0), invalid
+    
+    try:
+        with index:
+            started = time.perf_counter()
+            queries = found = invalid = 0
+            if args.kmer:
+                queries += len(args.kmer)
+                hits, bad = write_rows(args.kmer, index.find_many(args.kmer, canonical))
+                found += hits
+                invalid += bad
+            if args.file:
+                infile = sys.stdin if args.file == '-' else open(args.file, 'r')
+                try:
+                    while True:
+                        lines = list(islice(infile, QUERY_BATCH))
+                        if not lines:
+                            break
+                        batch = [line.strip() for line in lines]
+                        batch = [kmer for kmer in batch if kmer and not kmer.startswith('#')]
+                        queries += len(batch)
+                        hits, bad = write_rows(batch, index.find_many(batch, canonical))
+                        found += hits
+                        invalid += bad
+                finally:
+                    if infile is not sys.stdin:
+                        infile.close()
+            if queries:
+                elapsed = time.perf_counter() - started
+                message(f"Looked up {queries} k-mers in {elapsed:.3f} s: {found} found, "
+                        f"{queries - found - invalid} absent")
+            if invalid:
+                message(f"ERROR: {invalid} queries are not {index.k}-mers of A/C/G/T (marked 'invalid')")
+            for prefix in args.prefix:
+                try:
+                    start, stop = index.prefix_range(prefix)
+                except ValueError as e:
+                    message(f"ERROR: Prefix {prefix}: {str(e)}")
+                    invalid += 1
+                    continue
+                shown = stop if args.limit is None else min(stop, start + args.limit)
+                for first in range(start, shown, QUERY_BATCH):
+                    rows = range(first, min(shown, first + QUERY_BATCH))
+                    write_rows([index.kmer(row) for row in rows], rows)
+                if shown < stop:
+                    message(f"Prefix {prefix}: showing {shown - start} of {stop - start} k-mers (--limit)")
+                else:
+                    message(f"Prefix {prefix}: {stop - start} k-mers")
+    except OSError as e:
+        message(f"ERROR: {str(e)}")
+        sys.exit(1)
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+    sys.exit(1 if invalid else 0)
+
+def plan_batch(args, log=log):
+    """--plan: estimate the runtime, peak RAM and disk of a batch without running KMC
+    
+    The inputs are found and measured as a real run would select them
+    (--limit, --shard, --append, --retry-failed), and with --plan-sample
+    N that many files are read to measure their bases and k-mer diversity.
+    The rates come from the calibration file the earlier runs updated.
+    """
+    if not args.input or not Path(args.input).is_dir():
+        log(f"ERROR: Input folder not found: {args.input}")
+        return False
+    fasta_files = sorted(find_fasta_files(args.input, recursive=args.recursive))
+    if args.limit is not None and args.limit > 0:
+        fasta_files = fasta_files[:args.limit]
+    if args.shard:
+        fasta_files = select_shard(fasta_files, *args.shard)
+    if (args.append or args.retry_failed) and args.output:
+        try:
+            manifest = load_manifest(args.output)
+            failed = last_failures(args.output) if args.retry_failed else None
+        except (OSError, ValueError) as e:
+            log(f"ERROR: Could not read the existing outputs: {str(e)}")
+            return False
+        if manifest is not None:
+            fasta_files = new_inputs(fasta_files, manifest)
+            if failed is not None:
+                fasta_files = [fasta_file for fasta_file in fasta_files if fasta_file.name in failed]
+    if not fasta_files:
+        log("No FASTA files to process, nothing to plan")
+        return True
+    
+    k = args.k or 21
+    ram = args.ram or 4
+    threads = args.threads or 4
+    workers = split_budget(ram, threads, args.jobs or 1, len(fasta_files))[0]
+    aggregation = args.aggregation
+    if args.presence_matrix:
+        aggregation = 'stream'
+    elif aggregation == 'numpy' and (not HAVE_NUMPY or k > MAX_PACKED_K):
+        aggregation = 'memory'
+    calibration_file = args.calibration or (Path(args.workdir) / CALIBRATION_NAME if args.workdir else None)
+    try:
+        calibration = Calibration.load(calibration_file)
+    except (OSError, ValueError) as e:
+        log(f"ERROR: Could not read the calibration: {str(e)}")
+        return False
+    
+    samples = None
+    if args.plan_sample:
+        log(f"Sampling {min(args.plan_sample, len(fasta_files))} files for bases and k-mer diversity...")
+        sizes = {fasta_file: os.path.getsize(fasta_file) for fasta_file in fasta_files}
+        samples = sample_inputs(fasta_files, sizes, k, args.plan_sample,
+                                min_count=args.min_count, max_count=args.max_count)
+    plan = estimate_plan(
+        fasta_files, calibration, k, ram, threads, workers, aggregation=aggregation, native_db=args.native_db,
+        presence_matrix=args.presence_matrix, abundance_matrix=args.abundance_matrix,
+        partitions_bytes=args.max_bucket_mb * 1024 ** 2, samples=samples,
+        min_count=args.min_count, max_count=args.max_count
+    )
+    log("KMC Batch Processing - Plan (nothing is run)")
+    log("=" * 60)
+    log(f"k={k}, {ram} GB RAM, {threads} threads, {workers} files at a time, aggregation: {aggregation}")
+    log(f"Calibration: {calibration_file if calibration_file else 'none (pass --workdir or --calibration)'}")
+    for line in format_plan(plan):
+        log(line)
+    return True
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a whole number, got {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def positive_number(value):
+    """argparse type for durations and sizes that must be above 0"""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number, got {value!r}")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be above 0, got {value}")
+    return number
+
+def kmer_sets_argument(value):
+    """argparse type for --kmer-sets core,unique"""
+    names = tuple(name.strip() for name in value.split(',') if name.strip())
+    unknown = set(names) - set(KMER_SETS)
+    if unknown or not names:
+        raise argparse.ArgumentTypeError(f"expected a comma-separated subset of {', '.join(KMER_SETS)}, got {value!r}")
+    return names
+
+def shard_argument(value):
+    """argparse type for --shard i/N"""
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
 def get_input(prompt, default=None, validate_path=False, check_exists=False, is_dir=False):
     """Get input from user with optional default and validation"""
     if default:
@@ -256,6 +2171,11 @@ def get_input(prompt, default=None, validate_path=False, check_exists=False, is_
         return value
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge-shards':
+        merge_shards_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'query':
+        query_main(sys.argv[2:])
+    
     parser = argparse.ArgumentParser(
         description='KMC Batch Processing for HPC environments',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -281,22 +2201,125 @@ Usage modes:
        --output /blue/project/output \\
        --workdir /blue/project/temp \\
        --limit 50
+  
+  4. Split one collection over N cluster jobs, then merge (e.g. SLURM --array=1-20):
+     python3 kmc_batch_cli.py ... --shard ${SLURM_ARRAY_TASK_ID}/20
+     python3 kmc_batch_cli.py merge-shards \\
+       --kmc-tools /path/to/kmc_tools \\
+       --output /blue/project/output
+  
+  5. Look up k-mers in a finished run (build the index with --index or query --build):
+     python3 kmc_batch_cli.py query --output /blue/project/output --kmer ACGTACGTACGTACGTACGTA
+     python3 kmc_batch_cli.py query --output /blue/project/output --file kmers.txt --files
+     python3 kmc_batch_cli.py query --output /blue/project/output --prefix ACGTAC
         """
     )
     
     parser.add_argument('--kmc', help='Path to KMC executable')
     parser.add_argument('--kmc-tools', help='Path to KMC_tools executable')
     parser.add_argument('--input', help='Input folder containing FASTA files')
+    parser.add_argument('--recursive', action='store_true',
+                        help='Also look for FASTA files in the subfolders of --input')
     parser.add_argument('--output', help='Output folder for results')
     parser.add_argument('--workdir', help='Working directory for temporary files')
     parser.add_argument('--k', type=int, help='K-mer length (default: 21)')
     parser.add_argument('--ram', type=int, help='RAM in GB (default: 4)')
     parser.add_argument('--threads', type=int, help='Number of threads (default: 4)')
-    parser.add_argument('--limit', type=int, help='Process only first N files (useful for testing)')
+    parser.add_argument('--limit', type=int, help='Process only the first N files by name (useful for testing)')
+    parser.add_argument('--jobs', type=int, help='Number of files to process concurrently; RAM and threads are split between them (default: 1)')
+    parser.add_argument('--aggregation', choices=['memory', 'stream', 'numpy', 'partitioned'], default='memory',
+                        help="binary_existence engine: 'memory' (dictionary of all k-mers), 'stream' "
+                             "(k-way merge of sorted dumps, memory bounded by the number of files), "
+                             "'numpy' (2-bit packed arrays, needs NumPy and k <= 32) or 'partitioned' "
+                             "(prefix buckets counted in parallel processes)")
+    parser.add_argument('--partitions', type=int,
+                        help='Prefix buckets of the partitioned engine (default: enough to keep each under '
+                             '--max-bucket-mb and every worker busy)')
+    parser.add_argument('--aggregation-workers', type=int,
+                        help='Processes of the partitioned engine (default: number of CPU cores)')
+    parser.add_argument('--max-bucket-mb', type=int, default=DEFAULT_MAX_BUCKET_BYTES // 1024 ** 2,
+                        help='Largest bucket a partitioned worker counts at once; bigger ones are split '
+                             f'further, which bounds the memory per worker (default: {DEFAULT_MAX_BUCKET_BYTES // 1024 ** 2})')
+    parser.add_argument('--native-db', action='store_true',
+                        help='Read KMC databases directly instead of creating text dumps with kmc_tools')
+    parser.add_argument('--presence-matrix', action='store_true',
+                        help='Also write a packed k-mer x file presence/absence bit matrix (uses the stream engine)')
+    parser.add_argument('--abundance-matrix', action='store_true',
+                        help='Also write abundance_matrix/, the per-file k-mer counts as a sparse CSR matrix '
+                             '(files x k-mers) in memory-mappable .npy files (needs NumPy)')
+    parser.add_argument('--merge-fan-out', type=int,
+                        help='Build overlap_merge as a tree of unions with at most N databases per kmc_tools call, '
+                             'running independent unions concurrently (recommended for thousands of files)')
+    parser.add_argument('--cache-dir',
+                        help='Folder of the persistent result cache (default: <workdir>/kmc_cache)')
+    parser.add_argument('--cache-size', type=float, default=50,
+                        help='Maximum result cache size in GB; least recently used entries are evicted (default: 50)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the result cache; count every file from scratch')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Overlap counting, dumping and aggregation of consecutive files in a staged pipeline')
+    parser.add_argument('--normalize', choices=NORMALIZE_MODES, default='auto',
+                        help="How multi-line FASTA reaches KMC: 'kmc' (KMC reads it with -fm), 'buffered' "
+                             "(rewritten ahead of counting), 'pipe' (rewritten into a named pipe), 'off', "
+                             "or 'auto' (kmc if supported, else buffered; default)")
+    parser.add_argument('--schedule', choices=SCHEDULE_ORDERS, default='size',
+                        help="Processing order and per-file RAM/threads: 'size' (largest files first, budget "
+                             "shared by file size; default), 'bases' (the same by sequence length, from a fast "
+                             "scan) or 'name' (input order, equal split)")
+    parser.add_argument('--append', action='store_true',
+                        help='Count only the input files not yet listed in <output>/manifest.json and fold them '
+                             'into the existing outputs')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Rerun only the files that failed in the last run into --output (see run_report.json) '
+                             'and fold them into the existing outputs, like --append')
+    parser.add_argument('--file-timeout', type=positive_number,
+                        help='Kill a KMC/kmc_tools command of a file (with its process group) after N minutes '
+                             'and treat the file as failed')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Retry failed files up to N times at the end of the batch, each time with twice the '
+                             'RAM and threads (up to --ram/--threads); 0 disables retries (default: 1)')
+    parser.add_argument('--shard', type=shard_argument,
+                        help='Process only shard i of N (i/N, 1-based; files balanced by size) into '
+                             '<output>/shard_i_of_N; combine the shards with merge-shards')
+    parser.add_argument('--min-count', type=positive_int,
+                        help="KMC -ci: leave out k-mers counted fewer than N times in a file (KMC's default: 2)")
+    parser.add_argument('--max-count', type=positive_int,
+                        help='KMC -cx: leave out k-mers counted more than N times in a file')
+    parser.add_argument('--min-files', type=positive_int,
+                        help='Keep only k-mers found in at least N files in binary_existence and the presence matrix')
+    parser.add_argument('--max-files', type=positive_int,
+                        help='Keep only k-mers found in at most N files in binary_existence and the presence matrix')
+    parser.add_argument('--combination-format', choices=COMBINATION_FORMATS, default='text',
+                        help='combination_raw as one text file (text, default) or as combination_raw.kmcc, the '
+                             'same blocks with an offset table for reading single files (indexed)')
+    parser.add_argument('--index', action='store_true',
+                        help=f'Also build binary_existence/{INDEX_NAME} for fast lookups with the query command')
+    parser.add_argument('--kmer-sets', type=kmer_sets_argument, default=(),
+                        help='Also build k-mer set databases next to overlap_merge: core (core_intersect, in every '
+                             'file) and/or unique (unique_kmers, per file, found in no other file); e.g. core,unique')
+    parser.add_argument('--dump-kmer-sets', action='store_true',
+                        help='Also dump the --kmer-sets databases to text')
+    parser.add_argument('--keep-intermediates', action='store_true',
+                        help='Keep the KMC database and dump of every file in <output>/<file> instead of '
+                             'deleting them once the combined outputs are written')
+    parser.add_argument('--trace', action='store_true',
+                        help='Also write run_trace.json, a Chrome trace-event timeline of all stages')
+    parser.add_argument('--plan', action='store_true',
+                        help='Only estimate the runtime, peak RAM and disk of the batch from the input sizes and '
+                             'earlier runs; KMC is not run (needs --input)')
+    parser.add_argument('--plan-sample', type=positive_int,
+                        help='With --plan, read N files spread over the size range to measure their bases and '
+                             'k-mer diversity')
+    parser.add_argument('--calibration',
+                        help=f'Calibration file that every run updates and --plan reads '
+                             f'(default: <workdir>/{CALIBRATION_NAME})')
     parser.add_argument('--interactive', action='store_true', help='Force interactive mode')
     
     args = parser.parse_args()
     
+    if args.plan:
+        sys.exit(0 if plan_batch(args) else 1)
+    
     # Check if we should use interactive mode
     use_interactive = args.interactive or not any([args.kmc, args.kmc_tools, args.input, args.output, args.workdir])
     
@@ -339,6 +2362,7 @@ Usage modes:
         k = int(get_input("K-mer length", default="21"))
         ram = int(get_input("RAM in GB", default="4"))
         threads = int(get_input("Number of threads", default="4"))
+        jobs = int(get_input("Files to process concurrently", default="1"))
         
         # Ask about file limit
         limit_input = get_input("Process only first N files (leave empty for all)", default="None")
@@ -356,6 +2380,7 @@ Usage modes:
         print(f"K-mer length:       {k}")
         print(f"RAM:                {ram} GB")
         print(f"Threads:            {threads}")
+        print(f"Concurrent files:   {jobs}")
         print(f"File limit:         {file_limit if file_limit else 'All files'}")
         print("=" * 60)
         
@@ -375,6 +2400,7 @@ Usage modes:
         k = args.k if args.k else 21
         ram = args.ram if args.ram else 4
         threads = args.threads if args.threads else 4
+        jobs = args.jobs if args.jobs else 1
         file_limit = args.limit
         
         # Validate paths
@@ -390,6 +2416,13 @@ Usage modes:
             log(f"ERROR: Input folder not found: {input_folder}")
             sys.exit(1)
     
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir if args.cache_dir else str(Path(work_dir) / "kmc_cache")
+        if args.shard and not args.cache_dir:
+            # Concurrent shards must not share one cache index
+            cache_dir = str(Path(work_dir) / shard_dir_name(*args.shard) / "kmc_cache")
+    
     # Create output and work directories if they don't exist
     Path(output_folder).mkdir(parents=True, exist_ok=True)
     Path(work_dir).mkdir(parents=True, exist_ok=True)
@@ -404,13 +2437,55 @@ Usage modes:
     log(f"K-mer length: {k}")
     log(f"RAM: {ram} GB")
     log(f"Threads: {threads}")
+    log(f"Concurrent files: {jobs}")
+    log(f"Aggregation engine: {args.aggregation}")
+    log(f"Read KMC databases directly: {'yes' if args.native_db else 'no'}")
+    log(f"Result cache: {cache_dir if cache_dir else 'disabled'}")
+    log(f"Pipelined stages: {'yes' if args.pipeline else 'no'}")
+    log(f"Scheduling: {args.schedule}")
+    log(f"combination_raw format: {args.combination_format}")
+    if args.min_count or args.max_count:
+        log(f"KMC counter bounds: min {args.min_count or 'default'}, max {args.max_count or 'default'}")
+    if args.min_files or args.max_files:
+        log(f"Files per k-mer kept: {args.min_files or 1} to {args.max_files or 'all'}")
+    if args.shard:
+        log(f"Shard: {args.shard[0]}/{args.shard[1]}")
+    if args.recursive:
+        log(f"Search subfolders: yes")
+    if args.append:
+        log(f"Append to existing outputs: yes")
+    if args.retry_failed:
+        log(f"Retry the files that failed last time: yes")
+    if args.file_timeout:
+        log(f"Timeout per file command: {args.file_timeout:g} min")
+    log(f"Retries of failed files: {max(0, args.retries)}")
+    if args.index:
+        log(f"K-mer lookup index: yes")
+    if args.kmer_sets:
+        log(f"K-mer sets: {', '.join(args.kmer_sets)}{' (dumped)' if args.dump_kmer_sets else ''}")
+    if args.keep_intermediates:
+        log(f"Keep per-file KMC outputs: yes")
     log(f"File limit: {file_limit if file_limit else 'None (process all files)'}")
     log("=" * 60)
     
     success = run_kmc_batch(
         kmc_exe, kmc_tools_exe, input_folder, 
         output_folder, work_dir, 
-        k, ram, threads, file_limit
+        k, ram, threads, file_limit,
+        jobs=jobs, aggregation=args.aggregation, native_db=args.native_db,
+        presence_matrix=args.presence_matrix, merge_fan_out=args.merge_fan_out,
+        cache_dir=cache_dir, cache_size=int(args.cache_size * 1024 ** 3),
+        pipeline=args.pipeline, normalize=args.normalize, trace=args.trace,
+        schedule=args.schedule, shard=args.shard, append=args.append, recursive=args.recursive,
+        partitions=args.partitions, aggregation_workers=args.aggregation_workers,
+        max_bucket_bytes=args.max_bucket_mb * 1024 ** 2, index=args.index,
+        combination_format=args.combination_format, min_count=args.min_count, max_count=args.max_count,
+        min_files=args.min_files, max_files=args.max_files, kmer_sets=args.kmer_sets,
+        dump_kmer_sets=args.dump_kmer_sets,
+        file_timeout=args.file_timeout * 60 if args.file_timeout else None, retries=max(0, args.retries),
+        retry_failed=args.retry_failed, abundance_matrix=args.abundance_matrix,
+        calibration_file=args.calibration or str(Path(work_dir) / CALIBRATION_NAME),
+        keep_intermediates=args.keep_intermediates
     )
     
     sys.exit(0 if success else 1)
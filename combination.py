@@ -0,0 +1,262 @@
+"""
+combination_raw writers and readers for KMC Batch Processing
+Streams per-file dump blocks into combination_raw, as text or an indexed container
+
+Two formats hold the same per-file dump blocks:
+
+  text     combination_raw.txt: for every file a '# === name ===' line,
+           its dump and a blank line
+  indexed  combination_raw.kmcc: the dumps back to back behind a magic
+           number, followed by a footer table of each block's name, offset
+           and size, so a reader seeks straight to one file's block
+
+Container layout (integers little-endian):
+
+  magic     8 bytes, b"KMCCOMB1"
+  blocks    the 'kmer<TAB>count' lines of each file's dump
+  footer    UTF-8 JSON: {"blocks": [[name, offset, size], ...]}
+  trailer   uint64 footer offset, uint64 footer size, b"KMCCOMB1"
+
+Appending only adds blocks and writes a new footer after them, so the
+existing bytes are never rewritten and a failed append is undone by
+truncating back to the old size. Blocks are copied in the kernel
+(copy_file_range, or sendfile on Linux) when both ends are plain files.
+"""
+
+import io
+import json
+import os
+import struct
+import sys
+from contextlib import contextmanager
+
+FORMATS = ('text', 'indexed')
+TEXT_NAME = "combination_raw.txt"
+CONTAINER_NAME = "combination_raw.kmcc"
+MAGIC = b"KMCCOMB1"
+COPY_CHUNK = 16 * 1024 * 1024
+_TRAILER = struct.Struct("<QQ8s")
+
+def combination_name(combination_format):
+    """File name of combination_raw in a format"""
+    return CONTAINER_NAME if combination_format == 'indexed' else TEXT_NAME
+
+def _kernel_copy(src, dst, count, offset):
+    """Copy count bytes from offset of src to the position of dst, return the bytes copied or None"""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(src, dst, count, offset)
+        except OSError:
+            pass
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        try:
+            return os.sendfile(dst, src, offset, count)
+        except OSError:
+            pass
+    return None
+
+def copy_range(infile, outfile, start, end, chunk_size=COPY_CHUNK):
+    """Copy bytes [start, end) of infile to the end of outfile, without reading it all into memory
+
+    outfile must be written sequentially (its position is its end). Both
+    are binary files; the copy stays in the kernel when they are plain
+    files, otherwise it goes through chunk_size reads.
+    """
+    remaining = end - start
+    try:
+        src = infile.fileno()
+        dst = outfile.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        src = dst = None
+    if src is not None and remaining > 0:
+        outfile.flush()
+        position = start
+        try:
+            while position < end:
+                copied = _kernel_copy(src, dst, min(end - position, 1 << 30), position)
+                if not copied:
+                    break
+                position += copied
+        finally:
+            outfile.seek(0, os.SEEK_END)
+        remaining = end - position
+        start = position
+    infile.seek(start)
+    while remaining > 0:
+        data = infile.read(min(chunk_size, remaining))
+        if not data:
+            break
+        outfile.write(data)
+        remaining -= len(data)
+
+def copy_file(path, outfile):
+    """Append the whole file at path to outfile"""
+    with open(path, 'rb') as infile:
+        copy_range(infile, outfile, 0, os.path.getsize(path))
+
+def read_footer(infile, path):
+    """Return the [name, offset, size] table of an open container"""
+    infile.seek(0, os.SEEK_END)
+    size = infile.tell()
+    infile.seek(0)
+    if size < len(MAGIC) + _TRAILER.size or infile.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{path} is not a combination_raw container")
+    infile.seek(size - _TRAILER.size)
+    footer_offset, footer_size, magic = _TRAILER.unpack(infile.read(_TRAILER.size))
+    if magic != MAGIC or footer_offset + footer_size + _TRAILER.size != size:
+        raise ValueError(f"{path} has no valid footer (incomplete write?)")
+    infile.seek(footer_offset)
+    return json.loads(infile.read(footer_size).decode('utf-8'))['blocks']
+
+class CombinationWriter:
+    """Write per-file dump blocks to combination_raw in either format
+
+    With append the blocks are added to an existing file (a container
+    keeps its blocks and gets a new footer). close() finishes the file;
+    abort() removes a new file or truncates an appended one back to what
+    it was.
+    """
+
+    def __init__(self, path, combination_format='text', append=False):
+        self.path = str(path)
+        self.indexed = combination_format == 'indexed'
+        self.blocks = []
+        self._original_size = None
+        if append and os.path.exists(self.path):
+            self._original_size = os.path.getsize(self.path)
+            self._file = open(self.path, 'r+b')
+            if self.indexed:
+                self.blocks = read_footer(self._file, self.path)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(self.path, 'wb')
+            if self.indexed:
+                self._file.write(MAGIC)
+
+    def _begin(self, name):
+        if not self.indexed:
+            self._file.write(f"# === {name} ===\n".encode('utf-8'))
+        return self._file.tell()
+
+    def _end(self, name, start):
+        if self.indexed:
+            self.blocks.append([name, start, self._file.tell() - start])
+        else:
+            self._file.write(b"\n")
+
+    def add_file(self, name, dump_file):
+        """Add the dump at dump_file as the block of name"""
+        start = self._begin(name)
+        copy_file(dump_file, self._file)
+        self._end(name, start)
+
+    def add_range(self, name, infile, start, end):
+        """Add bytes [start, end) of an open binary file (dump lines only) as the block of name"""
+        begin = self._begin(name)
+        copy_range(infile, self._file, start, end)
+        self._end(name, begin)
+
+    @contextmanager
+    def block(self, name):
+        """Add the block of name, written as text to the stream this yields"""
+        start = self._begin(name)
+        text = io.TextIOWrapper(self._file, encoding='ascii', newline='\n', write_through=True)
+        try:
+            yield text
+            text.flush()
+        finally:
+            text.detach()
+        self._end(name, start)
+
+    def extend(self, path):
+        """Add every block of another combination_raw file in the same format"""
+        if self.indexed:
+            container = CombinationContainer(path)
+            for name in container.names():
+                container.copy_block(name, self)
+        else:
+            copy_file(path, self._file)
+
+    def close(self):
+        """Write the footer (containers) and close the file"""
+        if self._file.closed:
+            return
+        if self.indexed:
+            footer_offset = self._file.tell()
+            footer = json.dumps({'blocks': self.blocks}).encode('utf-8')
+            self._file.write(footer)
+            self._file.write(_TRAILER.pack(footer_offset, len(footer), MAGIC))
+        self._file.close()
+
+    def abort(self):
+        """Discard what this writer added"""
+        if not self._file.closed:
+            self._file.close()
+        if self._original_size is None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        else:
+            os.truncate(self.path, self._original_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class CombinationContainer:
+    """Random access to the per-file blocks of a combination_raw container"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, 'rb') as infile:
+            self.blocks = [tuple(block) for block in read_footer(infile, self.path)]
+        self._by_name = {name: (offset, size) for name, offset, size in self.blocks}
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def names(self):
+        """Return the file names in block order"""
+        return [name for name, _, _ in self.blocks]
+
+    def block(self, name):
+        """Return (offset, size) of the block of name, raising KeyError if it has none"""
+        return self._by_name[name]
+
+    def iter_lines(self, name, chunk_size=COPY_CHUNK):
+        """Yield the lines of one block as bytes, reading chunk_size bytes at a time"""
+        offset, size = self.block(name)
+        with open(self.path, 'rb') as infile:
+            infile.seek(offset)
+            remaining = size
+            carry = b""
+            while remaining > 0:
+                data = infile.read(min(chunk_size, remaining))
+                if not data:
+                    raise ValueError(f"{self.path} is truncated")
+                remaining -= len(data)
+                lines = (carry + data).split(b"\n")
+                carry = lines.pop()
+                yield from lines
+            if carry:
+                yield carry
+
+    def iter_records(self, name, chunk_size=COPY_CHUNK):
+        """Yield (kmer, count) for every record of one file's block, lazily"""
+        for line in self.iter_lines(name, chunk_size):
+            parts = line.split()
+            if len(parts) >= 2:
+                yield parts[0].decode('ascii'), int(parts[1])
+
+    def copy_block(self, name, writer):
+        """Add the block of name to a CombinationWriter"""
+        offset, size = self.block(name)
+        with open(self.path, 'rb') as infile:
+            writer.add_range(name, infile, offset, offset + size)
@@ -0,0 +1,80 @@
+"""
+Input discovery for KMC Batch Processing
+Finds plain and compressed FASTA files in one pass, optionally in subfolders
+
+Inputs are files ending in .fasta, .fa or .fna, optionally followed by
+.gz, .bz2 or .xz. The walker lists each folder once with os.scandir and
+takes file types from the directory entries, so no extra stat call is
+made per file. With recursive it descends into subfolders, following
+symlinked folders once each and skipping hidden ones.
+
+A file's sample name is its name without the compression and FASTA
+extensions (Escherichia/562.1234.fna.gz -> 562.1234). It names the
+file's databases, its combination_raw block and its presence matrix
+column, so the sample names of a batch have to be unique.
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+from pathlib import Path
+
+FASTA_EXTENSIONS = ('.fasta', '.fa', '.fna')
+COMPRESSIONS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+_SUFFIXES = tuple(ext + comp for ext in FASTA_EXTENSIONS for comp in ('', *COMPRESSIONS))
+
+def compression(path):
+    """Return the compression extension of an input ('.gz', '.bz2', '.xz'), or None"""
+    suffix = Path(path).suffix
+    return suffix if suffix in COMPRESSIONS else None
+
+def plain_name(path):
+    """File name of an input without its compression extension"""
+    name = Path(path).name
+    suffix = compression(name)
+    return name[:-len(suffix)] if suffix else name
+
+def sample_name(path):
+    """Name of an input without its compression and FASTA extensions"""
+    return Path(plain_name(path)).stem
+
+def open_fasta(path):
+    """Open an input for binary reading, decompressing it on the fly if needed"""
+    suffix = compression(path)
+    if suffix:
+        return COMPRESSIONS[suffix](path, 'rb')
+    return open(path, 'rb')
+
+def find_fasta_files(input_folder, recursive=False):
+    """Return the FASTA files (plain or compressed) in input_folder, and its subfolders with recursive"""
+    fasta_files = []
+    pending = [os.fspath(input_folder)]
+    seen = set()
+    while pending:
+        folder = pending.pop()
+        try:
+            info = os.stat(folder)
+            if (info.st_dev, info.st_ino) in seen:
+                continue
+            seen.add((info.st_dev, info.st_ino))
+            entries = os.scandir(folder)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith(_SUFFIXES) and entry.is_file():
+                        fasta_files.append(Path(entry.path))
+                    elif recursive and not entry.name.startswith('.') and entry.is_dir():
+                        pending.append(entry.path)
+                except OSError:
+                    continue
+    return fasta_files
+
+def duplicate_names(fasta_files):
+    """Return {sample name: [files]} for the sample names shared by several files"""
+    by_name = {}
+    for fasta_file in fasta_files:
+        by_name.setdefault(sample_name(fasta_file), []).append(fasta_file)
+    return {name: files for name, files in by_name.items() if len(files) > 1}
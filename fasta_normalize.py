@@ -0,0 +1,273 @@
+"""
+FASTA normalization for KMC Batch Processing
+Turns multi-line FASTA into one sequence line per record, or avoids the rewrite
+
+Modes:
+
+  kmc       no rewrite, KMC reads multi-line FASTA itself (-fm)
+  buffered  rewrite into the working directory with large binary reads,
+            a few files ahead of KMC in a process pool
+  pipe      rewrite on the fly into a named pipe that KMC reads, so no
+            normalized copy is written to disk (needs os.mkfifo)
+  off       pass the files to KMC unchanged (-fa)
+  auto      kmc if the KMC binary supports -fm, otherwise buffered
+
+Compressed inputs (fasta_inputs.py) are decompressed while they are
+read, so buffered and pipe normalize them without an extra copy. In kmc
+and off modes KMC gets them as they are when it reads that compression
+itself (gzip, if its usage text says so); the others are decompressed on
+the fly into a named pipe that KMC reads.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+from fasta_inputs import compression, open_fasta, plain_name
+
+MODES = ('auto', 'kmc', 'buffered', 'pipe', 'off')
+CHUNK_SIZE = 16 * 1024 * 1024
+
+_WHITESPACE = b" \t\r\n\v\f"
+
+class NormalizationError(Exception):
+    """Raised when a FASTA file could not be normalized"""
+
+def normalize_fasta(input_file, output_file, chunk_size=CHUNK_SIZE):
+    """Convert multi-line FASTA to single-line format for KMC compatibility
+
+    Works on large binary chunks: header lines are located with
+    bytes.find and the sequence between them has its line breaks and
+    blanks removed with bytes.translate, so no Python code runs per
+    sequence line. Blank lines and anything before the first header are
+    dropped.
+    """
+    with open_fasta(input_file) as infile, open(output_file, 'wb') as outfile:
+        in_record = False
+        carry = b""
+        while True:
+            chunk = infile.read(chunk_size)
+            if chunk:
+                data = carry + chunk
+                cut = data.rfind(b"\n") + 1
+                if cut == 0:
+                    # No complete line yet, keep reading
+                    carry = data
+                    continue
+                data, carry = data[:cut], data[cut:]
+            else:
+                data, carry = carry, b""
+                if not data:
+                    break
+
+            pos = 0
+            search = 0
+            while True:
+                marker = data.find(b">", search)
+                if marker < 0:
+                    break
+                line_start = data.rfind(b"\n", 0, marker) + 1
+                line_end = data.find(b"\n", marker)
+                if line_end < 0:
+                    line_end = len(data)
+                search = line_end + 1
+                if data[line_start:marker].strip():
+                    # '>' inside a sequence line, not a header
+                    search = marker + 1
+                    continue
+                if in_record:
+                    outfile.write(data[pos:line_start].translate(None, _WHITESPACE))
+                    outfile.write(b"\n")
+                outfile.write(data[line_start:line_end].strip() + b"\n")
+                in_record = True
+                pos = search
+            if in_record:
+                outfile.write(data[pos:].translate(None, _WHITESPACE))
+        if in_record:
+            outfile.write(b"\n")
+
+def decompress_fasta(input_file, output_file, chunk_size=CHUNK_SIZE):
+    """Write a compressed FASTA file decompressed, unchanged otherwise"""
+    with open_fasta(input_file) as infile, open(output_file, 'wb') as outfile:
+        shutil.copyfileobj(infile, outfile, chunk_size)
+
+@lru_cache(maxsize=None)
+def kmc_usage(kmc_exe):
+    """Return the usage text KMC prints without arguments ('' if it cannot be run)"""
+    try:
+        result = subprocess.run([kmc_exe], capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return ""
+    return result.stdout + result.stderr
+
+def kmc_supports_multiline(kmc_exe):
+    """Return True if the KMC usage text lists the multi-line FASTA input mode (-fm)"""
+    usage = kmc_usage(kmc_exe)
+    return "-fm" in usage or re.search(r"-f<[a-z/]*\bm\b", usage) is not None
+
+def kmc_compressions(kmc_exe):
+    """Return the compression extensions KMC reads itself ('.gz' if its usage mentions gzipped input)"""
+    return ('.gz',) if "gzip" in kmc_usage(kmc_exe).lower() else ()
+
+def resolve_mode(mode, kmc_exe):
+    """Turn 'auto' into a concrete mode and fall back where a mode is unavailable"""
+    if mode not in MODES:
+        raise ValueError(f"Unknown normalization mode {mode!r}, expected one of {', '.join(MODES)}")
+    if mode == 'auto':
+        return 'kmc' if kmc_supports_multiline(kmc_exe) else 'buffered'
+    if mode == 'pipe' and not hasattr(os, 'mkfifo'):
+        return 'buffered'
+    return mode
+
+class Normalizer:
+    """Prepares the KMC input of each file of a batch for one normalization mode
+
+    In buffered mode files are normalized in a process pool, at most ahead
+    files beyond the latest one requested, so normalization of the next
+    files overlaps with counting of the current ones. native_compressions
+    are the compression extensions KMC reads itself.
+    """
+
+    def __init__(self, mode, work_dir, fasta_files=(), workers=1, ahead=None, native_compressions=()):
+        self.mode = mode
+        self.native_compressions = tuple(native_compressions)
+        self.work_dir = Path(work_dir) / "normalized_fasta"
+        self.fasta_files = list(fasta_files)
+        self.ahead = ahead if ahead is not None else 2 * max(1, workers)
+        self._positions = {fasta_file: n for n, fasta_file in enumerate(self.fasta_files)}
+        self._futures = {}
+        self._submitted = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        if mode in ('buffered', 'pipe'):
+            self.work_dir.mkdir(parents=True, exist_ok=True)
+        if mode == 'buffered':
+            self._executor = ProcessPoolExecutor(max_workers=max(1, workers))
+
+    @property
+    def input_flag(self):
+        """KMC input format flag for the files this normalizer hands out"""
+        return "-fm" if self.mode == 'kmc' else "-fa"
+
+    def _submit_until(self, position):
+        with self._lock:
+            while self._submitted < min(position + 1, len(self.fasta_files)):
+                fasta_file = self.fasta_files[self._submitted]
+                output_file = self.work_dir / plain_name(fasta_file)
+                self._futures[fasta_file] = (output_file, self._executor.submit(normalize_fasta, fasta_file, output_file))
+                self._submitted += 1
+
+    def _buffered(self, fasta_file):
+        position = self._positions.get(fasta_file)
+        if position is None:
+            # Not part of the planned batch, normalize it right here
+            output_file = self.work_dir / plain_name(fasta_file)
+            normalize_fasta(fasta_file, output_file)
+            return output_file
+        self._submit_until(position + self.ahead)
+        with self._lock:
+            output_file, future = self._futures.pop(fasta_file)
+        future.result()
+        return output_file
+
+    @contextmanager
+    def prepare(self, fasta_file, log=None):
+        """Yield the path KMC should read for fasta_file, removing temporary files afterwards"""
+        if self.mode in ('kmc', 'off'):
+            if compression(fasta_file) in (None, *self.native_compressions):
+                yield fasta_file
+            else:
+                if log:
+                    log(f"  Streaming decompressed FASTA to KMC through a named pipe...")
+                with self._piped(fasta_file, decompress_fasta) as input_file:
+                    yield input_file
+            return
+
+        if self.mode == 'buffered':
+            if log:
+                log(f"  Normalizing FASTA format...")
+            try:
+                input_file = self._buffered(fasta_file)
+            except Exception as e:
+                raise NormalizationError(str(e))
+            if log:
+                log(f"  ✓ FASTA normalized")
+            try:
+                yield input_file
+            finally:
+                _remove(input_file)
+            return
+
+        if log:
+            log(f"  Streaming normalized FASTA to KMC through a named pipe...")
+        with self._piped(fasta_file, normalize_fasta) as input_file:
+            yield input_file
+
+    @contextmanager
+    def _piped(self, fasta_file, convert):
+        """Yield a named pipe that a thread fills with convert(fasta_file, pipe) while KMC reads it"""
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        if not hasattr(os, 'mkfifo'):
+            # No named pipes here, write the converted file instead
+            output_file = self.work_dir / f"{plain_name(fasta_file)}.{threading.get_ident()}"
+            try:
+                convert(fasta_file, output_file)
+            except Exception as e:
+                _remove(output_file)
+                raise NormalizationError(str(e))
+            try:
+                yield output_file
+            finally:
+                _remove(output_file)
+            return
+
+        fifo = self.work_dir / f"{plain_name(fasta_file)}.{threading.get_ident()}.fifo"
+        _remove(fifo)
+        os.mkfifo(fifo)
+        failure = []
+
+        def feed():
+            try:
+                convert(fasta_file, fifo)
+            except BrokenPipeError:
+                pass  # KMC stopped reading, its own error is reported
+            except Exception as e:
+                failure.append(e)
+
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+        try:
+            yield fifo
+        finally:
+            if writer.is_alive():
+                # KMC exited without draining the pipe; open the read end so the writer returns
+                try:
+                    reader = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+                    os.close(reader)
+                except OSError:
+                    pass
+            writer.join()
+            _remove(fifo)
+        if failure:
+            raise NormalizationError(str(failure[0]))
+
+    def close(self):
+        """Stop the process pool and delete the normalized files that were not used"""
+        if self._executor is not None:
+            for _, future in self._futures.values():
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
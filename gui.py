@@ -1,14 +1,27 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, scrolledtext
-import subprocess
 import os
+import queue
+import threading
+import time
 from pathlib import Path
 
+from cancellation import CancelToken
+from cli import run_kmc_batch
+from fasta_inputs import find_fasta_files
+from fasta_normalize import MODES as NORMALIZE_MODES
+
+# How often queued log messages from the batch thread are shown
+LOG_POLL_MS = 50
+
 class KMCBatchGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("KMC Batch Processing GUI")
         self.root.geometry("700x600")
+        self.events = queue.Queue()
+        self.cancel_token = None
+        self.worker = None
         
         # KMC executable path
         tk.Label(root, text="KMC Executable:").grid(row=0, column=0, sticky='w', padx=5, pady=5)
@@ -59,15 +72,41 @@ class KMCBatchGUI:
         self.t_entry.insert(0, "4")
         self.t_entry.grid(row=0, column=5, padx=5)
         
-        # Run button
-        self.run_button = tk.Button(root, text="Run KMC Batch Processing", command=self.run_batch, bg='green', fg='white', font=('Arial', 12, 'bold'))
-        self.run_button.grid(row=6, column=0, columnspan=3, pady=10)
+        tk.Label(params_frame, text="Jobs:").grid(row=0, column=6, padx=5)
+        self.jobs_entry = tk.Entry(params_frame, width=10)
+        self.jobs_entry.insert(0, "1")
+        self.jobs_entry.grid(row=0, column=7, padx=5)
+        
+        tk.Label(params_frame, text="Normalize:").grid(row=1, column=0, padx=5, pady=5)
+        self.normalize_var = tk.StringVar(value='auto')
+        tk.OptionMenu(params_frame, self.normalize_var, *NORMALIZE_MODES).grid(row=1, column=1, padx=5, pady=5, sticky='w')
+        
+        self.recursive_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(params_frame, text="Search subfolders", variable=self.recursive_var).grid(
+            row=1, column=2, columnspan=2, padx=5, pady=5, sticky='w')
+        
+        # Each file's KMC database and dump stay in output_folder/<file> unless unticked
+        self.keep_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(params_frame, text="Keep per-file KMC outputs", variable=self.keep_var).grid(
+            row=1, column=4, columnspan=3, padx=5, pady=5, sticky='w')
+        
+        # Run and cancel buttons
+        buttons_frame = tk.Frame(root)
+        buttons_frame.grid(row=6, column=0, columnspan=3, pady=10)
+        self.run_button = tk.Button(buttons_frame, text="Run KMC Batch Processing", command=self.run_batch, bg='green', fg='white', font=('Arial', 12, 'bold'))
+        self.run_button.grid(row=0, column=0, padx=5)
+        self.cancel_button = tk.Button(buttons_frame, text="Cancel", command=self.cancel_batch, state='disabled', font=('Arial', 12, 'bold'))
+        self.cancel_button.grid(row=0, column=1, padx=5)
         
         # Progress log
         tk.Label(root, text="Progress Log:").grid(row=7, column=0, sticky='w', padx=5)
+        self.progress_label = tk.Label(root, text="")
+        self.progress_label.grid(row=7, column=1, columnspan=2, sticky='e', padx=5)
         self.log_text = scrolledtext.ScrolledText(root, width=80, height=15)
         self.log_text.grid(row=8, column=0, columnspan=3, padx=5, pady=5)
         
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
     def browse_kmc_exe(self):
         filename = filedialog.askopenfilename(title="Select KMC executable", filetypes=[("Executable", "*.exe"), ("All files", "*.*")])
         if filename:
@@ -99,44 +138,78 @@ class KMCBatchGUI:
             self.work_dir_entry.insert(0, folder)
     
     def log(self, message):
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.root.update()
+        """Thread-safe: queue a message for the log pump"""
+        self.events.put(('log', message))
+    
+    def pump_events(self):
+        """Show queued messages in one update, then reschedule itself while the batch runs"""
+        lines = []
+        finished = None
+        while True:
+            try:
+                kind, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'log':
+                lines.append(value)
+            elif kind == 'progress':
+                self.show_progress(*value)
+            else:
+                finished = value
+        if lines:
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            self.log_text.see(tk.END)
+        if finished is None:
+            self.root.after(LOG_POLL_MS, self.pump_events)
+        else:
+            self.batch_finished(finished)
     
-    def normalize_fasta(self, input_file, output_file):
-        """Convert multi-line FASTA to single-line format for KMC compatibility"""
+    def progress(self, done, total):
+        """Thread-safe: queue a files-finished update for the readout"""
+        self.events.put(('progress', (done, total)))
+    
+    def show_progress(self, done, total):
+        elapsed = time.monotonic() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        text = f"{done}/{total} files, {rate:.2f} files/s"
+        if 0 < done < total and rate > 0:
+            remaining = int((total - done) / rate)
+            text += f", ETA {remaining // 3600:d}:{remaining // 60 % 60:02d}:{remaining % 60:02d}"
+        self.progress_label.config(text=text)
+    
+    def batch_worker(self, *args, **kwargs):
         try:
-            with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
-                current_header = None
-                current_sequence = []
-                
-                for line in infile:
-                    line = line.strip()
-                    if not line:  # Skip empty lines
-                        continue
-                    
-                    if line.startswith('>'):
-                        # Write previous sequence if exists
-                        if current_header:
-                            outfile.write(current_header + '\n')
-                            outfile.write(''.join(current_sequence) + '\n')
-                        
-                        # Start new sequence
-                        current_header = line
-                        current_sequence = []
-                    else:
-                        # Accumulate sequence lines
-                        current_sequence.append(line)
-                
-                # Write last sequence
-                if current_header:
-                    outfile.write(current_header + '\n')
-                    outfile.write(''.join(current_sequence) + '\n')
-            
-            return True
+            success = run_kmc_batch(*args, **kwargs)
         except Exception as e:
-            self.log(f"  ✗ ERROR normalizing FASTA: {str(e)}")
-            return False
+            self.log(f"ERROR: {str(e)}")
+            success = False
+        self.events.put(('done', success))
+    
+    def batch_finished(self, success):
+        cancelled = self.cancel_token.is_set()
+        self.worker = None
+        self.run_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+        if cancelled:
+            messagebox.showinfo("Cancelled", "Batch processing was cancelled.")
+        elif success:
+            messagebox.showinfo("Complete", "Batch processing finished!")
+        else:
+            messagebox.showwarning("Complete", "Batch processing finished with errors.\nSee the progress log for details.")
+    
+    def cancel_batch(self):
+        if self.worker is None:
+            return
+        self.cancel_button.config(state='disabled')
+        self.log("\nCancelling: stopping the running KMC process...")
+        self.cancel_token.cancel()
+    
+    def on_close(self):
+        if self.worker is not None:
+            if not messagebox.askyesno("Quit", "A batch is running. Cancel it and quit?"):
+                return
+            self.cancel_token.cancel()
+        self.root.destroy()
     
     def run_batch(self):
         # Validate inputs
@@ -148,186 +221,48 @@ class KMCBatchGUI:
         k = self.k_entry.get()
         m = self.m_entry.get()
         t = self.t_entry.get()
+        jobs = self.jobs_entry.get()
         
-        if not all([kmc_exe, kmc_tools_exe, input_folder, output_folder, work_dir, k, m, t]):
+        if not all([kmc_exe, kmc_tools_exe, input_folder, output_folder, work_dir, k, m, t, jobs]):
             messagebox.showerror("Error", "Please fill in all fields!")
             return
         
+        try:
+            k, m, t, jobs = int(k), int(m), int(t), int(jobs)
+        except ValueError:
+            messagebox.showerror("Error", "k-mer length, RAM, threads and jobs must be whole numbers!")
+            return
+        
         # Get all FASTA files
-        fasta_files = []
-        for ext in ['*.fasta', '*.fa', '*.fna']:
-            fasta_files.extend(Path(input_folder).glob(ext))
+        fasta_files = find_fasta_files(input_folder, recursive=self.recursive_var.get())
         
         if not fasta_files:
             messagebox.showerror("Error", "No FASTA files found in input folder!")
             return
         
         self.log_text.delete(1.0, tk.END)
-        self.log(f"Found {len(fasta_files)} FASTA files to process")
-        self.log("=" * 60)
         
         # Disable run button during processing
         self.run_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
         
-        # Create a normalized_fasta subfolder in working directory
-        normalized_dir = Path(work_dir) / "normalized_fasta"
-        normalized_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Process each file
-        processed_dbs = []
-        errors = []
-        
-        for i, fasta_file in enumerate(fasta_files, 1):
-            file_name = fasta_file.stem
-            self.log(f"\n[{i}/{len(fasta_files)}] Processing: {fasta_file.name}")
-            
-            # Normalize FASTA file first
-            normalized_file = normalized_dir / fasta_file.name
-            self.log(f"  Normalizing FASTA format...")
-            if not self.normalize_fasta(fasta_file, normalized_file):
-                errors.append(f"Failed to normalize {fasta_file.name}")
-                continue
-            self.log(f"  ✓ FASTA normalized")
-            
-            # Create output subfolder
-            file_output_dir = Path(output_folder) / file_name
-            file_output_dir.mkdir(parents=True, exist_ok=True)
-            
-            output_db = str(file_output_dir / file_name)
-            
-            # Run KMC with normalized file
-            self.log(f"  Running KMC...")
-            kmc_cmd = [
-                kmc_exe,
-                f"-k{k}", f"-m{m}", f"-t{t}",
-                "-fa", str(normalized_file), output_db, work_dir
-            ]
-            
-            try:
-                result = subprocess.run(kmc_cmd, check=True, capture_output=True, text=True)
-                self.log(f"  ✓ KMC completed")
-                
-                # Run kmc_tools dump
-                self.log(f"  Running kmc_tools dump...")
-                dump_file = str(file_output_dir / f"{file_name}_dump.txt")
-                dump_cmd = [kmc_tools_exe, "transform", output_db, "dump", dump_file]
-                
-                subprocess.run(dump_cmd, check=True, capture_output=True, text=True)
-                self.log(f"  ✓ Dump completed: {file_name}_dump.txt")
-                
-                processed_dbs.append(output_db)
-                
-            except subprocess.CalledProcessError as e:
-                error_msg = f"  ✗ ERROR processing {fasta_file.name}: {str(e)}"
-                if e.stderr:
-                    error_msg += f"\n    stderr: {e.stderr}"
-                self.log(error_msg)
-                errors.append(error_msg)
+        Path(output_folder).mkdir(parents=True, exist_ok=True)
+        Path(work_dir).mkdir(parents=True, exist_ok=True)
         
-        # Create overlap_merge
-        if processed_dbs:
-            self.log("\n" + "=" * 60)
-            self.log("Creating overlap_merge (union of all databases)...")
-            
-            overlap_dir = Path(output_folder) / "overlap_merge"
-            overlap_dir.mkdir(parents=True, exist_ok=True)
-            overlap_db = str(overlap_dir / "overlap_merge")
-            
-            try:
-                # Build union command
-                union_cmd = [kmc_tools_exe, "simple"] + processed_dbs
-                for i in range(len(processed_dbs) - 1):
-                    union_cmd.append("union")
-                union_cmd.append(overlap_db)
-                
-                subprocess.run(union_cmd, check=True, capture_output=True, text=True)
-                self.log("  ✓ Union completed")
-                
-                # Dump merged database
-                overlap_dump = str(overlap_dir / "overlap_merge_dump.txt")
-                dump_cmd = [kmc_tools_exe, "transform", overlap_db, "dump", overlap_dump]
-                subprocess.run(dump_cmd, check=True, capture_output=True, text=True)
-                self.log(f"  ✓ Dump completed: overlap_merge_dump.txt")
-                
-            except subprocess.CalledProcessError as e:
-                error_msg = f"  ✗ ERROR creating overlap_merge: {str(e)}"
-                self.log(error_msg)
-                errors.append(error_msg)
-        
-        # Create combination_raw (concatenated dumps)
-        self.log("\nCreating combination_raw (concatenated text dumps)...")
-        combo_dir = Path(output_folder) / "combination_raw"
-        combo_dir.mkdir(parents=True, exist_ok=True)
-        combo_file = combo_dir / "combination_raw.txt"
-        
-        try:
-            with open(combo_file, 'w') as outfile:
-                for db_path in processed_dbs:
-                    db_dir = Path(db_path).parent
-                    dump_file = db_dir / f"{Path(db_path).name}_dump.txt"
-                    if dump_file.exists():
-                        with open(dump_file, 'r') as infile:
-                            outfile.write(f"# === {dump_file.parent.name} ===\n")
-                            outfile.write(infile.read())
-                            outfile.write("\n")
-            self.log(f"  ✓ Concatenation completed: combination_raw.txt")
-        except Exception as e:
-            error_msg = f"  ✗ ERROR creating combination_raw: {str(e)}"
-            self.log(error_msg)
-            errors.append(error_msg)
-        
-        # Create binary_existence (count files where each k-mer appears)
-        self.log("\nCreating binary_existence (presence/absence across files)...")
-        binary_dir = Path(output_folder) / "binary_existence"
-        binary_dir.mkdir(parents=True, exist_ok=True)
-        binary_file = binary_dir / "binary_existence.txt"
-        
-        try:
-            kmer_file_count = {}  # k-mer -> count of files it appears in
-            
-            for db_path in processed_dbs:
-                db_dir = Path(db_path).parent
-                dump_file = db_dir / f"{Path(db_path).name}_dump.txt"
-                if dump_file.exists():
-                    kmers_in_this_file = set()
-                    with open(dump_file, 'r') as infile:
-                        for line in infile:
-                            line = line.strip()
-                            if line and not line.startswith('#'):
-                                parts = line.split()
-                                if len(parts) >= 1:
-                                    kmer = parts[0]
-                                    kmers_in_this_file.add(kmer)
-                    
-                    # Add 1 to count for each unique k-mer seen in this file
-                    for kmer in kmers_in_this_file:
-                        kmer_file_count[kmer] = kmer_file_count.get(kmer, 0) + 1
-            
-            # Write results sorted by k-mer
-            with open(binary_file, 'w') as outfile:
-                outfile.write("# k-mer\tfile_count\n")
-                for kmer in sorted(kmer_file_count.keys()):
-                    outfile.write(f"{kmer}\t{kmer_file_count[kmer]}\n")
-            
-            self.log(f"  ✓ Binary existence completed: binary_existence.txt")
-            self.log(f"  Total unique k-mers across all files: {len(kmer_file_count)}")
-        except Exception as e:
-            error_msg = f"  ✗ ERROR creating binary_existence: {str(e)}"
-            self.log(error_msg)
-            errors.append(error_msg)
-        
-        # Summary
-        self.log("\n" + "=" * 60)
-        self.log(f"PROCESSING COMPLETE!")
-        self.log(f"Successfully processed: {len(processed_dbs)}/{len(fasta_files)} files")
-        if errors:
-            self.log(f"Errors encountered: {len(errors)}")
-            self.log("\nError details:")
-            for error in errors:
-                self.log(error)
-        
-        self.run_button.config(state='normal')
-        messagebox.showinfo("Complete", f"Batch processing finished!\nProcessed: {len(processed_dbs)}/{len(fasta_files)} files")
+        # Run the batch on a worker thread; the Tk main loop only drains its messages
+        self.cancel_token = CancelToken()
+        self.started = time.monotonic()
+        self.progress_label.config(text="")
+        self.worker = threading.Thread(
+            target=self.batch_worker,
+            args=(kmc_exe, kmc_tools_exe, input_folder, output_folder, work_dir, k, m, t),
+            kwargs={'jobs': jobs, 'normalize': self.normalize_var.get(), 'recursive': self.recursive_var.get(),
+                    'keep_intermediates': self.keep_var.get(), 'cancel': self.cancel_token,
+                    'progress': self.progress, 'log': self.log},
+            daemon=True
+        )
+        self.worker.start()
+        self.root.after(LOG_POLL_MS, self.pump_events)
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,73 @@
+"""
+Incremental updates for KMC Batch Processing
+Keeps track of the inputs already folded into an output folder
+
+Every finished run writes manifest.json next to its outputs with the
+FASTA files that made it into them. A run with --append compares the
+input folder against it, counts only the new files into a staging
+folder and then folds that small result into the existing outputs
+(see cli.append_outputs), so the update costs scale with the new data.
+
+Files that failed are not in the manifest, so they stay new. The run
+report records them as failed_files; --retry-failed appends just those.
+"""
+
+import json
+import time
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+STAGING_NAME = "append_staging"
+REPORT_NAME = "run_report.json"
+
+def load_manifest(output_folder):
+    """Return the manifest of an output folder, or None if it has none"""
+    manifest_file = Path(output_folder) / MANIFEST_NAME
+    if not manifest_file.exists():
+        return None
+    with open(manifest_file, 'r') as infile:
+        manifest = json.load(infile)
+    if manifest.get('manifest_version') != MANIFEST_VERSION:
+        raise ValueError(f"{manifest_file} has an unsupported version: {manifest.get('manifest_version')}")
+    return manifest
+
+def save_manifest(output_folder, k, names, previous=None, options=None):
+    """Write manifest.json listing names plus the files of a previous manifest
+
+    options records the counting and filtering settings the outputs were
+    built with, which an append has to repeat.
+    """
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    files = dict(previous['files']) if previous else {}
+    for name in names:
+        files.setdefault(name, {'added': now})
+    manifest = {
+        'manifest_version': MANIFEST_VERSION,
+        'k': int(k),
+        'updated': now,
+        'options': options or {},
+        'files': dict(sorted(files.items())),
+    }
+    manifest_file = Path(output_folder) / MANIFEST_NAME
+    tmp_file = manifest_file.with_suffix('.json.tmp')
+    with open(tmp_file, 'w') as outfile:
+        json.dump(manifest, outfile, indent=2)
+    tmp_file.replace(manifest_file)
+
+def new_inputs(fasta_files, manifest):
+    """Return the files that are not listed in manifest, in input order"""
+    included = set(manifest['files']) if manifest else set()
+    return [fasta_file for fasta_file in fasta_files if Path(fasta_file).name not in included]
+
+def last_failures(output_folder):
+    """Return the names of the files that failed in the last run into output_folder
+
+    Returns None if there is no run report or it does not record failures.
+    """
+    report_file = Path(output_folder) / REPORT_NAME
+    if not report_file.exists():
+        return None
+    with open(report_file, 'r') as infile:
+        failed = json.load(infile).get('run', {}).get('failed_files')
+    return None if failed is None else set(failed)
@@ -0,0 +1,268 @@
+"""
+Native reader and writer for KMC databases (.kmc_pre / .kmc_suf)
+Lets the aggregation stages read k-mers without kmc_tools text dumps
+
+Supported layout (KMC 2.x / 3.x, version marker 0x200):
+
+  <db>.kmc_pre
+    "KMCP"
+    LUT            n_bins * 4^lut_prefix_length uint64; record index in the
+                   suffix file where each (bin, prefix) range starts
+    guard          uint64, total number of records
+    signature map  (4^signature_len + 1) uint32, signature -> bin
+    header         kmer_length, mode, counter_size, lut_prefix_length,
+                   signature_len, min_count, max_count (uint32 each),
+                   total_kmers (uint64), strand flag (uint8, 0 = canonical
+                   k-mers from both strands), 27 reserved bytes,
+                   version (uint32, 0x200)
+    header size    uint32
+    "KMCP"
+
+  <db>.kmc_suf
+    "KMCS"
+    records        suffix ((kmer_length - lut_prefix_length) / 4 bytes, 2 bits
+                   per base, first base in the high bits) followed by the
+                   counter (counter_size bytes, little-endian)
+    "KMCS"
+
+A k-mer is its LUT prefix followed by its suffix bases (A=0, C=1, G=2,
+T=3), so packed integers sort in the same order as the ACGT strings.
+Records are sorted within each bin; bins hold k-mers by signature, so a
+sorted scan merges the bins prefix range by prefix range.
+"""
+
+import struct
+from pathlib import Path
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    np = None
+    HAVE_NUMPY = False
+
+KMC_VERSION = 0x200
+BATCH_RECORDS = 1 << 20  # approximate records per sorted batch
+
+_BASES = "ACGT"
+_HEADER = struct.Struct("<7IQB27xI")
+
+def kmer_to_int(kmer):
+    """Pack an ACGT string into an integer, 2 bits per base"""
+    value = 0
+    for base in kmer:
+        value = (value << 2) | _BASES.index(base)
+    return value
+
+def int_to_kmer(value, k):
+    """Unpack a 2-bit packed integer into an ACGT string of length k"""
+    return "".join(_BASES[(value >> (2 * (k - 1 - j))) & 3] for j in range(k))
+
+def db_exists(db_path):
+    """Return True if both files of a KMC database exist"""
+    return Path(f"{db_path}.kmc_pre").exists() and Path(f"{db_path}.kmc_suf").exists()
+
+def read_kmer_count(db_path):
+    """Return the number of k-mers in a KMC database, reading only the header"""
+    with open(f"{db_path}.kmc_pre", 'rb') as pre:
+        pre.seek(-12, 2)
+        version, header_size = struct.unpack("<II", pre.read(8))
+        if version != KMC_VERSION:
+            raise ValueError(f"{db_path}: unsupported KMC database version {version:#x}")
+        pre.seek(-8 - header_size, 2)
+        return _HEADER.unpack(pre.read(_HEADER.size))[7]
+
+class KMCDatabase:
+    """Read-only, streaming view of a KMC database"""
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        pre = Path(f"{self.db_path}.kmc_pre").read_bytes()
+        if len(pre) < 12 or pre[:4] != b"KMCP" or pre[-4:] != b"KMCP":
+            raise ValueError(f"{self.db_path}.kmc_pre is not a KMC database")
+        version, header_size = struct.unpack_from("<II", pre, len(pre) - 12)
+        if version != KMC_VERSION:
+            raise ValueError(f"{self.db_path}: unsupported KMC database version {version:#x}")
+        header_start = len(pre) - 8 - header_size
+        (self.kmer_length, self.mode, self.counter_size, self.lut_prefix_length,
+         self.signature_len, self.min_count, self.max_count, self.total_kmers,
+         strand_flag, _) = _HEADER.unpack_from(pre, header_start)
+        if self.mode != 0:
+            raise ValueError(f"{self.db_path}: quality-aware KMC databases are not supported")
+        self.both_strands = strand_flag == 0
+
+        signature_map_size = 4 ** self.signature_len + 1
+        lut_end = header_start - 4 * signature_map_size
+        self.single_lut_size = 4 ** self.lut_prefix_length
+        self.n_bins = (lut_end - 4 - 8) // (8 * self.single_lut_size)
+        # Flat LUT with the guard at the end: entry (b * L + p) starts the
+        # range of prefix p in bin b, entry (b * L + p + 1) ends it
+        lut_count = self.n_bins * self.single_lut_size + 1
+        self._lut = struct.unpack_from(f"<{lut_count}Q", pre, 4)
+        if self._lut[-1] != self.total_kmers:
+            raise ValueError(f"{self.db_path}.kmc_pre is corrupt (LUT does not match k-mer count)")
+
+        self.suffix_bytes = (self.kmer_length - self.lut_prefix_length) // 4
+        self.record_size = self.suffix_bytes + self.counter_size
+
+    def __len__(self):
+        return self.total_kmers
+
+    def _prefix_chunks(self, batch_records):
+        """Split the prefix space into ranges of roughly batch_records records"""
+        n_chunks = max(1, min(self.single_lut_size, self.total_kmers // max(1, batch_records)))
+        bounds = [self.single_lut_size * i // n_chunks for i in range(n_chunks + 1)]
+        return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+    def _read_chunk(self, suf, lo, hi):
+        """Yield (first_prefix, prefix_sizes, raw_records) for each bin in a prefix range"""
+        L = self.single_lut_size
+        for b in range(self.n_bins):
+            start = self._lut[b * L + lo]
+            end = self._lut[b * L + hi]
+            if end == start:
+                continue
+            suf.seek(4 + start * self.record_size)
+            raw = suf.read((end - start) * self.record_size)
+            sizes = [self._lut[b * L + p + 1] - self._lut[b * L + p] for p in range(lo, hi)]
+            yield lo, sizes, raw
+
+    def iter_records(self, batch_records=BATCH_RECORDS):
+        """Yield (packed k-mer, count) pairs in sorted k-mer order (pure Python)"""
+        shift = 2 * (self.kmer_length - self.lut_prefix_length)
+        ss, rs = self.suffix_bytes, self.record_size
+        with open(f"{self.db_path}.kmc_suf", 'rb') as suf:
+            for lo, hi in self._prefix_chunks(batch_records):
+                records = []
+                for first, sizes, raw in self._read_chunk(suf, lo, hi):
+                    pos = 0
+                    for offset, size in enumerate(sizes):
+                        high = (first + offset) << shift
+                        for _ in range(size):
+                            records.append((
+                                high | int.from_bytes(raw[pos:pos + ss], 'big'),
+                                int.from_bytes(raw[pos + ss:pos + rs], 'little'),
+                            ))
+                            pos += rs
+                records.sort()
+                yield from records
+
+    def iter_batches(self, batch_records=BATCH_RECORDS):
+        """Yield sorted (kmers uint64, counts uint32) NumPy batches (needs NumPy and k <= 32)"""
+        if not HAVE_NUMPY:
+            raise RuntimeError("NumPy is required for batched KMC database reads")
+        if self.kmer_length > 32:
+            raise ValueError("packed uint64 batches support k <= 32")
+        shift = np.uint64(2 * (self.kmer_length - self.lut_prefix_length))
+        ss = self.suffix_bytes
+        with open(f"{self.db_path}.kmc_suf", 'rb') as suf:
+            for lo, hi in self._prefix_chunks(batch_records):
+                kmer_parts, count_parts = [], []
+                for first, sizes, raw in self._read_chunk(suf, lo, hi):
+                    records = np.frombuffer(raw, dtype=np.uint8).reshape(-1, self.record_size)
+                    prefixes = np.repeat(np.arange(first, first + len(sizes), dtype=np.uint64),
+                                         np.asarray(sizes, dtype=np.int64))
+                    kmers = prefixes << shift
+                    for j in range(ss):
+                        kmers |= records[:, j].astype(np.uint64) << np.uint64(8 * (ss - 1 - j))
+                    counts = np.zeros(len(records), dtype=np.uint32)
+                    for j in range(self.counter_size):
+                        counts |= records[:, ss + j].astype(np.uint32) << np.uint32(8 * j)
+                    kmer_parts.append(kmers)
+                    count_parts.append(counts)
+                if not kmer_parts:
+                    continue
+                kmers = np.concatenate(kmer_parts)
+                counts = np.concatenate(count_parts)
+                order = np.argsort(kmers, kind='stable')
+                yield kmers[order], counts[order]
+
+    def read_kmers(self):
+        """Return every k-mer as one sorted uint64 array (needs NumPy and k <= 32)"""
+        parts = [kmers for kmers, _ in self.iter_batches()]
+        if not parts:
+            return np.zeros(0, dtype=np.uint64)
+        return np.concatenate(parts)
+
+    def iter_kmer_strings(self):
+        """Yield every k-mer as an ACGT string in sorted order"""
+        for kmer, _ in self.iter_records():
+            yield int_to_kmer(kmer, self.kmer_length)
+
+    def write_dump(self, outfile):
+        """Write 'kmer<TAB>count' lines in sorted order to an open text file, return the row count"""
+        total = 0
+        if HAVE_NUMPY and self.kmer_length <= 32:
+            from kmer_numpy import format_kmer_counts
+            for kmers, counts in self.iter_batches():
+                outfile.write(format_kmer_counts(kmers, counts, self.kmer_length).decode('ascii'))
+                total += len(kmers)
+        else:
+            for kmer, count in self.iter_records():
+                outfile.write(f"{int_to_kmer(kmer, self.kmer_length)}\t{count}\n")
+                total += 1
+        return total
+
+def _minimizer(kmer, k, m):
+    """Smallest packed m-mer of a packed k-mer (used to pick a bin)"""
+    mask = (1 << (2 * m)) - 1
+    return min((kmer >> (2 * i)) & mask for i in range(k - m + 1))
+
+def write_kmc_db(db_path, records, k, counter_size=None, lut_prefix_length=None,
+                 signature_len=9, n_bins=1, min_count=1, max_count=1000000000,
+                 both_strands=True):
+    """Write (k-mer, count) records as a KMC database readable by KMCDatabase
+
+    K-mers may be ACGT strings or packed integers. With n_bins > 1 records
+    are spread over bins by minimizer, like KMC does. Mainly used to build
+    small databases without the KMC binary.
+    """
+    records = [(kmer_to_int(kmer) if isinstance(kmer, str) else kmer, count)
+               for kmer, count in records]
+    if lut_prefix_length is None:
+        lut_prefix_length = k % 4 + 4 if k % 4 + 4 <= k else k % 4
+    if (k - lut_prefix_length) % 4:
+        raise ValueError("kmer_length - lut_prefix_length must be a multiple of 4")
+    if counter_size is None:
+        largest = max((count for _, count in records), default=1)
+        counter_size = max(1, (largest.bit_length() + 7) // 8)
+    signature_len = min(signature_len, k)
+    n_bins = max(1, n_bins)
+
+    # Assign bins by signature and sort each bin
+    bins = [[] for _ in range(n_bins)]
+    for kmer, count in records:
+        b = _minimizer(kmer, k, signature_len) % n_bins if n_bins > 1 else 0
+        bins[b].append((kmer, count))
+
+    L = 4 ** lut_prefix_length
+    suffix_bits = 2 * (k - lut_prefix_length)
+    suffix_bytes = suffix_bits // 8
+    lut = []
+    position = 0
+    with open(f"{db_path}.kmc_suf", 'wb') as suf:
+        suf.write(b"KMCS")
+        for bin_records in bins:
+            bin_records.sort()
+            sizes = [0] * L
+            for kmer, count in bin_records:
+                sizes[kmer >> suffix_bits] += 1
+                suffix = kmer & ((1 << suffix_bits) - 1)
+                suf.write(suffix.to_bytes(suffix_bytes, 'big') + count.to_bytes(counter_size, 'little'))
+            for size in sizes:
+                lut.append(position)
+                position += size
+        suf.write(b"KMCS")
+    lut.append(position)
+
+    signature_map = [s % n_bins for s in range(4 ** signature_len)] + [0]
+    header = _HEADER.pack(k, 0, counter_size, lut_prefix_length, signature_len,
+                          min_count, max_count, position, 0 if both_strands else 1, KMC_VERSION)
+    with open(f"{db_path}.kmc_pre", 'wb') as pre:
+        pre.write(b"KMCP")
+        pre.write(struct.pack(f"<{len(lut)}Q", *lut))
+        pre.write(struct.pack(f"<{len(signature_map)}I", *signature_map))
+        pre.write(header)
+        pre.write(struct.pack("<I", len(header)))
+        pre.write(b"KMCP")
+    return position
@@ -0,0 +1,250 @@
+"""
+Tree reductions over KMC databases for KMC Batch Processing
+Combines many databases with kmc_tools in log(N) rounds of bounded fan-out
+
+tree_reduce unions or intersects databases bottom-up. subtract_others
+removes from each database everything found in the others: the unions
+of the tree's subtrees are built bottom-up, then walked top-down so that
+each node's "everything outside me" database is the union of its
+parent's and its siblings', never more than fan_out inputs per call.
+"""
+
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# kmc_tools complex operators for the associative set operations
+OPERATORS = {'union': '+', 'intersect': '*'}
+
+def copy_db(src_db, dst_db):
+    """Copy the .kmc_pre/.kmc_suf files of a database"""
+    for ext in ('.kmc_pre', '.kmc_suf'):
+        shutil.copyfile(f"{src_db}{ext}", f"{dst_db}{ext}")
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def remove_db(db_path):
+    """Delete the files of a database, ignoring missing ones"""
+    for ext in ('.kmc_pre', '.kmc_suf'):
+        _remove(f"{db_path}{ext}")
+
+def combine_command(kmc_tools_exe, dbs, operation, output_db, ops_file, threads=None):
+    """Build the kmc_tools command applying operation to all dbs
+
+    Two inputs use 'kmc_tools simple'; more inputs are described in
+    ops_file for 'kmc_tools complex', which avoids long argument lists.
+    """
+    cmd = [kmc_tools_exe]
+    if threads:
+        cmd.append(f"-t{threads}")
+    if len(dbs) == 2:
+        return cmd + ["simple", str(dbs[0]), str(dbs[1]), operation, str(output_db)]
+    names = [f"db{i}" for i in range(len(dbs))]
+    with open(ops_file, 'w') as ops:
+        ops.write("INPUT:\n")
+        for name, db in zip(names, dbs):
+            ops.write(f"{name} = {db}\n")
+        ops.write("OUTPUT:\n")
+        ops.write(f"{output_db} = {f' {OPERATORS[operation]} '.join(names)}\n")
+    return cmd + ["complex", str(ops_file)]
+
+def combine(kmc_tools_exe, dbs, operation, output_db, work_dir, threads=None, run=subprocess.run):
+    """Apply one associative operation to a batch of databases"""
+    if len(dbs) == 1:
+        copy_db(dbs[0], output_db)
+        return
+    ops_file = Path(work_dir) / f"{Path(output_db).name}.ops"
+    cmd = combine_command(kmc_tools_exe, dbs, operation, output_db, ops_file, threads)
+    try:
+        run(cmd, check=True, capture_output=True, text=True)
+    finally:
+        _remove(ops_file)
+
+def tree_reduce(kmc_tools_exe, dbs, operation, output_db, work_dir, fan_out=16, jobs=1, threads=None,
+                name="reduce", run=subprocess.run, log=None):
+    """Reduce dbs with union or intersect in rounds of at most fan_out inputs
+
+    Batches of a round are independent and run up to jobs at a time, each
+    kmc_tools call getting threads // jobs threads. Intermediate databases
+    go to work_dir and are deleted as soon as the next round has consumed
+    them; the input databases are never touched. Returns the number of
+    rounds. Raises subprocess.CalledProcessError for the first failed
+    batch in input order.
+    """
+    if operation not in OPERATORS:
+        raise ValueError(f"tree_reduce supports {sorted(OPERATORS)}, not {operation!r}")
+    if not dbs:
+        raise ValueError("tree_reduce needs at least one database")
+    fan_out = max(2, fan_out)
+    jobs = max(1, jobs)
+    batch_threads = max(1, threads // jobs) if threads else None
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    current = [str(db) for db in dbs]
+    inputs = set(current)
+    intermediates = []  # databases of the previous round that this module created
+    created = []  # databases of the running round
+    rounds = 0
+    try:
+        while True:
+            rounds += 1
+            final = len(current) <= fan_out
+            batches = [current[n:n + fan_out] for n in range(0, len(current), fan_out)]
+            outputs = []
+            tasks = []
+            for b, batch in enumerate(batches):
+                if final:
+                    out = str(output_db)
+                elif len(batch) == 1:
+                    # A leftover single database moves up a round unchanged
+                    outputs.append(batch[0])
+                    continue
+                else:
+                    out = str(work_dir / f"{name}_L{rounds}_{b}")
+                outputs.append(out)
+                tasks.append((batch, out))
+            if log:
+                log(f"  Round {rounds}: {len(current)} databases -> {len(outputs)}")
+            created = [] if final else [out for _, out in tasks]
+
+            with ThreadPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+                futures = [
+                    executor.submit(combine, kmc_tools_exe, batch, operation, out, work_dir, batch_threads, run)
+                    for batch, out in tasks
+                ]
+                for future in futures:
+                    future.result()
+
+            # The previous round's intermediates have been consumed
+            for db in intermediates:
+                if db not in outputs:
+                    remove_db(db)
+            intermediates = [] if final else [db for db in outputs if db not in inputs]
+            created = []
+            current = outputs
+            if final:
+                return rounds
+    finally:
+        for db in intermediates + created:
+            remove_db(db)
+
+def _unite(kmc_tools_exe, dbs, output_db, work_dir, threads, run):
+    """Return a database holding the union of dbs, output_db if one had to be built"""
+    if not dbs:
+        return None
+    if len(dbs) == 1:
+        return dbs[0]
+    combine(kmc_tools_exe, dbs, 'union', output_db, work_dir, threads, run)
+    return output_db
+
+def _subtract(kmc_tools_exe, target, outside, output_db, work_dir, threads, run):
+    if outside is None:
+        copy_db(target, output_db)
+    else:
+        combine(kmc_tools_exe, [target, outside], 'kmers_subtract', output_db, work_dir, threads, run)
+
+def subtract_others(kmc_tools_exe, dbs, targets, work_dir, fan_out=16, jobs=1, threads=None,
+                    name="subtract", run=subprocess.run, log=None):
+    """Subtract from the targets of each database the k-mers of all other databases
+
+    targets[i] is a list of (target_db, output_db) pairs; each output_db
+    gets the k-mers of target_db that occur in none of dbs except dbs[i]
+    (with target_db = dbs[i] these are the k-mers unique to it). The union
+    of the other databases is built as a balanced tree with at most
+    fan_out inputs per kmc_tools call, sibling work running up to jobs at
+    a time. Only the unions along the current path are kept on disk.
+    Returns the depth of the tree. Raises subprocess.CalledProcessError
+    for the first failed call.
+    """
+    if len(targets) != len(dbs):
+        raise ValueError("subtract_others needs one list of targets per database")
+    if not dbs:
+        return 0
+    fan_out = max(2, fan_out)
+    jobs = max(1, jobs)
+    batch_threads = max(1, threads // jobs) if threads else None
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    created = set()
+
+    def release(*paths):
+        for path in paths:
+            if path in created:
+                remove_db(path)
+                created.discard(path)
+
+    def run_all(calls):
+        with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(calls)))) as executor:
+            futures = [executor.submit(call, *arguments) for call, *arguments in calls]
+            for future in futures:
+                future.result()
+
+    # Bottom-up: the union of every subtree
+    level = [{'db': str(db), 'leaf': i, 'children': None} for i, db in enumerate(dbs)]
+    depth = 1
+    while len(level) > fan_out:
+        batches = [level[n:n + fan_out] for n in range(0, len(level), fan_out)]
+        parents = []
+        calls = []
+        for b, batch in enumerate(batches):
+            if len(batch) == 1:
+                # A leftover subtree moves up a level unchanged
+                parents.append(batch[0])
+                continue
+            out = str(work_dir / f"{name}_U{depth}_{b}")
+            created.add(out)
+            parents.append({'db': out, 'leaf': None, 'children': batch})
+            calls.append((combine, kmc_tools_exe, [child['db'] for child in batch], 'union', out, work_dir,
+                          batch_threads, run))
+        if log:
+            log(f"  Union level {depth}: {len(level)} databases -> {len(parents)}")
+        run_all(calls)
+        level = parents
+        depth += 1
+
+    def leaf_task(leaf, inputs, out):
+        outside = _unite(kmc_tools_exe, inputs, out, work_dir, batch_threads, run)
+        try:
+            for target, output_db in targets[leaf['leaf']]:
+                _subtract(kmc_tools_exe, str(target), outside, str(output_db), work_dir, batch_threads, run)
+        finally:
+            if outside == out:
+                remove_db(out)
+
+    def outside_task(inputs, out, results, n):
+        results[n] = _unite(kmc_tools_exe, inputs, out, work_dir, batch_threads, run)
+
+    # Top-down: what lies outside each node is its parent's outside plus its siblings
+    def descend(children, outside, path):
+        calls = []
+        outsides = [None] * len(children)
+        for n, child in enumerate(children):
+            inputs = ([outside] if outside else []) + [other['db'] for other in children if other is not child]
+            out = str(work_dir / f"{name}_O{path}_{n}")
+            if child['children'] is None:
+                calls.append((leaf_task, child, inputs, out))
+            else:
+                created.add(out)
+                calls.append((outside_task, inputs, out, outsides, n))
+        run_all(calls)
+        # The subtree unions have been consumed by their siblings (unless one stands in as an outside)
+        release(*[child['db'] for child in children if child['db'] not in outsides])
+        for n, child in enumerate(children):
+            if child['children'] is not None:
+                descend(child['children'], outsides[n], f"{path}_{n}")
+                release(str(work_dir / f"{name}_O{path}_{n}"))
+        release(*[child['db'] for child in children])
+
+    try:
+        descend(level, None, "")
+        return depth
+    finally:
+        for path in list(created):
+            remove_db(path)
@@ -0,0 +1,306 @@
+"""
+Sorted k-mer lookup index for KMC Batch Processing
+Fixed-width, memory-mapped table of the binary_existence k-mers and file counts
+
+File layout (all integers little-endian unless noted):
+
+  magic       8 bytes, b"KMCIDX01"
+  k           uint32
+  key_bytes   uint32, 8 * ceil(k / 32)
+  n_rows      uint64
+  meta_size   uint32, size of the JSON object that follows
+  meta        UTF-8 JSON: source file and the presence matrix the rows
+              point into (null if there is none)
+  padding     zero bytes up to a multiple of 64
+  keys        n_rows * key_bytes; k-mer i packed 2 bits per base
+              (A=0 C=1 G=2 T=3) as a big-endian unsigned integer, so the
+              keys sort bytewise in k-mer order
+  padding     zero bytes up to a multiple of 64
+  counts      n_rows * uint32, the file count of k-mer i
+
+Row i is line i + 1 of binary_existence.txt (after the header line), which
+is also row i of presence_matrix.bin: the row number is the pointer into
+the matrix. Lookups binary-search the memory-mapped keys, so only the
+pages touched by the search are read and the index is never loaded into
+memory. With NumPy and k <= 32 batches of queries are searched with
+numpy.searchsorted.
+"""
+
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+from presence_matrix import PresenceMatrix
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    np = None
+    HAVE_NUMPY = False
+
+MAGIC = b"KMCIDX01"
+INDEX_NAME = "binary_existence.idx"
+_FIXED = struct.Struct("<8sIIQI")
+_ALIGN = 64
+_COUNT = struct.Struct("<I")
+WRITE_ROWS = 65536  # rows buffered by the builder before they are written
+QUERY_BATCH = 1 << 20  # query k-mers looked up at a time
+ABSENT = -1  # find/find_many row of a k-mer the index does not have
+INVALID = -2  # find/find_many row of a query that is not a k-mer of the index (length, bases)
+
+_TO_DIGITS = str.maketrans("ACGTacgt", "01230123")
+_COMPLEMENT = str.maketrans("ACGTacgt", "TGCAtgca")
+_VALID = frozenset("ACGTacgt")
+
+def key_width(k):
+    """Bytes per packed k-mer key"""
+    return 8 * ((k + 31) // 32)
+
+def encode_kmer(kmer, key_bytes):
+    """Pack an ACGT string into its big-endian index key, None if it has other characters"""
+    if not kmer or not _VALID.issuperset(kmer):
+        return None
+    return int(kmer.translate(_TO_DIGITS), 4).to_bytes(key_bytes, 'big')
+
+def decode_key(key, k):
+    """Unpack an index key into an ACGT string of length k"""
+    value = int.from_bytes(key, 'big')
+    return "".join("ACGT"[(value >> (2 * (k - 1 - j))) & 3] for j in range(k))
+
+def canonical_kmer(kmer):
+    """Return the smaller of a k-mer and its reverse complement, as KMC counts them"""
+    kmer = kmer.upper()
+    reverse = kmer.translate(_COMPLEMENT)[::-1]
+    return min(kmer, reverse)
+
+def _padding(size):
+    return b"\0" * (-size % _ALIGN)
+
+def build_index(binary_file, index_file, presence_file=None):
+    """Write the lookup index of a binary_existence.txt, return the number of rows
+
+    binary_file must be sorted by k-mer, as every engine writes it. If
+    presence_file is given its row count must match, and the index records
+    it as the matrix its rows point into. The index is written next to
+    index_file and renamed into place once complete.
+    """
+    binary_file = Path(binary_file)
+    index_file = Path(index_file)
+    k = None
+    with open(binary_file, 'r') as infile:
+        for line in infile:
+            if line.strip() and not line.startswith('#'):
+                k = len(line.split()[0])
+                break
+    k = k or 0
+    key_bytes = key_width(k)
+    meta = {
+        'source': binary_file.name,
+        'presence_matrix': None,
+    }
+    if presence_file is not None:
+        meta['presence_matrix'] = os.path.relpath(presence_file, index_file.parent)
+    meta = json.dumps(meta).encode('utf-8')
+    header_size = _FIXED.size + len(meta)
+
+    tmp_file = index_file.with_name(index_file.name + ".tmp")
+    counts_file = index_file.with_name(index_file.name + ".counts.tmp")
+    n_rows = 0
+    try:
+        with open(tmp_file, 'wb') as keys_out, open(counts_file, 'wb') as counts_out:
+            keys_out.write(_FIXED.pack(MAGIC, k, key_bytes, 0, len(meta)))
+            keys_out.write(meta + _padding(header_size))
+            keys = []
+            counts = []
+            previous = b""
+            with open(binary_file, 'r') as infile:
+                for line in infile:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    kmer, count = line.split()
+                    key = encode_kmer(kmer, key_bytes) if len(kmer) == k else None
+                    if key is None:
+                        raise ValueError(f"{binary_file} line {n_rows + 2}: not a {k}-mer of A/C/G/T: {kmer}")
+                    if key <= previous:
+                        raise ValueError(f"{binary_file} is not sorted by k-mer at {kmer}")
+                    previous = key
+                    keys.append(key)
+                    counts.append(_COUNT.pack(int(count)))
+                    n_rows += 1
+                    if len(keys) >= WRITE_ROWS:
+                        keys_out.write(b"".join(keys))
+                        counts_out.write(b"".join(counts))
+                        keys.clear()
+                        counts.clear()
+            keys_out.write(b"".join(keys))
+            counts_out.write(b"".join(counts))
+
+        if presence_file is not None:
+            matrix_rows = len(PresenceMatrix(presence_file))
+            if matrix_rows != n_rows:
+                raise ValueError(f"{presence_file} has {matrix_rows} rows, {binary_file} has {n_rows} k-mers")
+
+        with open(tmp_file, 'r+b') as outfile:
+            outfile.seek(0, os.SEEK_END)
+            outfile.write(_padding(outfile.tell()))
+            with open(counts_file, 'rb') as infile:
+                while True:
+                    data = infile.read(16 * 1024 * 1024)
+                    if not data:
+                        break
+                    outfile.write(data)
+            outfile.seek(_FIXED.size - 12)
+            outfile.write(struct.pack("<Q", n_rows))
+        os.replace(tmp_file, index_file)
+    finally:
+        for path in (tmp_file, counts_file):
+            if path.exists():
+                os.remove(path)
+    return n_rows
+
+class KmerIndex:
+    """Read-only lookups in an index file written by build_index"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._file = open(self.path, 'rb')
+        magic, self.k, self.key_bytes, self.n_rows, meta_size = _FIXED.unpack(self._file.read(_FIXED.size))
+        if magic != MAGIC:
+            self._file.close()
+            raise ValueError(f"{self.path} is not a k-mer index file")
+        self.meta = json.loads(self._file.read(meta_size).decode('utf-8'))
+        header_size = _FIXED.size + meta_size
+        self.keys_offset = header_size + (-header_size % _ALIGN)
+        keys_end = self.keys_offset + self.n_rows * self.key_bytes
+        self.counts_offset = keys_end + (-keys_end % _ALIGN)
+        if os.path.getsize(self.path) < self.counts_offset + 4 * self.n_rows:
+            self._file.close()
+            raise ValueError(f"{self.path} is truncated")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._keys = None
+
+    def __len__(self):
+        return self.n_rows
+
+    def close(self):
+        """Release the memory map and the file"""
+        self._keys = None
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def key(self, row):
+        """Return the packed key of a row"""
+        start = self.keys_offset + row * self.key_bytes
+        return self._map[start:start + self.key_bytes]
+
+    def count(self, row):
+        """Return the file count of a row"""
+        return _COUNT.unpack_from(self._map, self.counts_offset + 4 * row)[0]
+
+    def kmer(self, row):
+        """Return the k-mer of a row"""
+        return decode_key(self.key(row), self.k)
+
+    def _lower_bound(self, key, lo=0):
+        """First row whose key is >= key, searching rows [lo, n_rows)"""
+        hi = self.n_rows
+        data = self._map
+        width = self.key_bytes
+        base = self.keys_offset
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * width
+            if data[start:start + width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def encode(self, kmer, canonical=True):
+        """Return the key of a query k-mer, None if it is not a valid k-mer for this index"""
+        if len(kmer) != self.k:
+            return None
+        if canonical and _VALID.issuperset(kmer):
+            kmer = canonical_kmer(kmer)
+        return encode_kmer(kmer, self.key_bytes)
+
+    def find(self, kmer, canonical=True):
+        """Return the row of a k-mer, ABSENT if it is not in the index, INVALID if it is not a k-mer
+
+        With canonical the k-mer is looked up as KMC counts it (the smaller
+        of it and its reverse complement).
+        """
+        key = self.encode(kmer, canonical)
+        if key is None:
+            return INVALID
+        row = self._lower_bound(key)
+        return row if row < self.n_rows and self.key(row) == key else ABSENT
+
+    def lookup(self, kmer, canonical=True):
+        """Return the number of files containing a k-mer (0 if absent)"""
+        row = self.find(kmer, canonical)
+        return self.count(row) if row >= 0 else 0
+
+    def find_many(self, kmers, canonical=True):
+        """Return the row of each k-mer (ABSENT or INVALID as find does), in query order
+
+        Queries are searched in sorted order so consecutive searches touch
+        neighbouring pages; with NumPy and k <= 32 the whole batch is a
+        single numpy.searchsorted over the memory-mapped keys.
+        """
+        keys = [self.encode(kmer, canonical) for kmer in kmers]
+        rows = [ABSENT if key is not None else INVALID for key in keys]
+        valid = [i for i, key in enumerate(keys) if key is not None]
+        if not valid or not self.n_rows:
+            return rows
+        if HAVE_NUMPY and self.key_bytes == 8:
+            if self._keys is None:
+                self._keys = np.frombuffer(self._map, dtype='>u8', count=self.n_rows, offset=self.keys_offset)
+            wanted = np.array([int.from_bytes(keys[i], 'big') for i in valid], dtype=np.uint64)
+            order = np.argsort(wanted, kind='stable')
+            positions = np.searchsorted(self._keys, wanted[order])
+            found = positions < self.n_rows
+            found[found] = self._keys[positions[found]] == wanted[order][found]
+            for j, position, hit in zip(order.tolist(), positions.tolist(), found.tolist()):
+                if hit:
+                    rows[valid[j]] = position
+            return rows
+        lo = 0
+        for i in sorted(valid, key=keys.__getitem__):
+            lo = self._lower_bound(keys[i], lo)
+            if lo < self.n_rows and self.key(lo) == keys[i]:
+                rows[i] = lo
+        return rows
+
+    def prefix_range(self, prefix):
+        """Return the rows [start, stop) of the k-mers starting with prefix (as given, not canonical)
+
+        Raises ValueError if prefix is not 1 to k bases of A/C/G/T.
+        """
+        if not prefix or len(prefix) > self.k or not _VALID.issuperset(prefix):
+            raise ValueError(f"not a prefix of 1 to {self.k} A/C/G/T bases: {prefix}")
+        bases = prefix.upper()
+        rest = self.k - len(bases)
+        low = encode_kmer(bases + "A" * rest, self.key_bytes)
+        high = encode_kmer(bases + "T" * rest, self.key_bytes)
+        start = self._lower_bound(low)
+        stop = self._lower_bound(high, start)
+        if stop < self.n_rows and self.key(stop) == high:
+            stop += 1
+        return start, stop
+
+    def presence_matrix(self):
+        """Return the PresenceMatrix the rows point into, or None if the index has none"""
+        name = self.meta.get('presence_matrix')
+        if not name:
+            return None
+        return PresenceMatrix(Path(self.path).parent / name)
@@ -0,0 +1,366 @@
+"""
+Run instrumentation for KMC Batch Processing
+Per-stage wall/CPU time, child-process usage, I/O volume and k-mer rates
+
+Every stage is timed with RunMetrics.stage(). Child processes started
+through run_child() are reaped with os.wait4, so the CPU time and peak
+RSS of each KMC/kmc_tools call are attributed to the stage that started
+it. The collected data is written as a JSON run report and, optionally,
+as a Chrome trace-event timeline (chrome://tracing or ui.perfetto.dev).
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPORT_VERSION = 1
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_RSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+_thread_time = getattr(time, 'thread_time', time.process_time)
+
+_REAP_POLL = 0.05  # seconds between checks while a child with a timeout runs
+# Exit status given to a child whose real status was lost; not negative,
+# which would read as "killed by a signal", and never 0
+LOST_STATUS = 255
+
+class ChildProcess(subprocess.Popen):
+    """Popen that records the resource usage of the child once run_child reaps it"""
+
+    rusage = None
+    own_group = False  # started in a process group of its own
+    status_lost = False  # reaped elsewhere, so its exit status is unknown
+
+def _drain(process, input):
+    """Feed input to the child and read its pipes to EOF on helper threads
+
+    Returns (threads, outputs); outputs[name] is filled in when the
+    thread of that pipe finishes.
+    """
+    outputs = {}
+    threads = []
+
+    def read(name, pipe):
+        with pipe:
+            outputs[name] = pipe.read()
+
+    def write(pipe):
+        try:
+            with pipe:
+                if input:
+                    pipe.write(input)
+        except BrokenPipeError:
+            pass  # the child exited without reading everything, like communicate()
+
+    for name in ('stdout', 'stderr'):
+        if getattr(process, name) is not None:
+            threads.append(threading.Thread(target=read, args=(name, getattr(process, name)), daemon=True))
+    if process.stdin is not None:
+        threads.append(threading.Thread(target=write, args=(process.stdin,), daemon=True))
+    for thread in threads:
+        thread.start()
+    return threads, outputs
+
+def _reap(process, deadline=None):
+    """Wait for the child with os.wait4 and keep its rusage; False if deadline passed first"""
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return True
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError:
+            # Already reaped elsewhere (e.g. SIGCHLD ignored): without a status the
+            # run cannot be trusted, so it counts as a failure
+            if process.returncode is None:
+                process.status_lost = True
+                process.returncode = LOST_STATUS
+            return True
+        if pid == process.pid:
+            process.rusage = rusage
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(_REAP_POLL)
+
+def _communicate(process, input, timeout):
+    """Like Popen.communicate, but the child is reaped with os.wait4 so its rusage is kept
+
+    When timeout (seconds) runs out the child is stopped with stop_child
+    and reaped, then subprocess.TimeoutExpired is raised with its output.
+    """
+    if not hasattr(os, 'wait4'):  # Windows: no rusage
+        try:
+            return process.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            stop_child(process)
+            stdout, stderr = process.communicate()
+            raise subprocess.TimeoutExpired(process.args, timeout, stdout, stderr)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    threads, outputs = _drain(process, input)
+    for thread in threads:
+        thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+    # The pipes are drained before the child is reaped, so it never blocks on a full pipe
+    timed_out = any(thread.is_alive() for thread in threads) or not _reap(process, deadline)
+    if timed_out:
+        stop_child(process)
+        for thread in threads:
+            thread.join()
+        _reap(process)
+        raise subprocess.TimeoutExpired(process.args, timeout, outputs.get('stdout'), outputs.get('stderr'))
+    return outputs.get('stdout'), outputs.get('stderr')
+
+def stop_child(process, force=True):
+    """Kill (or with force=False terminate) a child, with its whole process group if it has one"""
+    if process.own_group:
+        try:
+            os.killpg(process.pid, signal.SIGKILL if force else signal.SIGTERM)
+        except OSError:
+            pass
+    elif force:
+        process.kill()
+    else:
+        process.terminate()
+
+def run_child(cmd, check=False, capture_output=False, text=False, input=None, started=None, timeout=None,
+              **kwargs):
+    """subprocess.run replacement whose result carries the child's rusage (or None)
+
+    started(process) is called right after the child is launched. With
+    timeout (seconds) the child gets a process group of its own, which is
+    killed as a whole when the time is up (subprocess.TimeoutExpired).
+    """
+    if capture_output:
+        kwargs['stdout'] = subprocess.PIPE
+        kwargs['stderr'] = subprocess.PIPE
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    own_group = timeout is not None and hasattr(os, 'killpg')
+    if own_group:
+        kwargs['start_new_session'] = True
+    process = ChildProcess(cmd, universal_newlines=text, **kwargs)
+    process.own_group = own_group
+    try:
+        if started is not None:
+            started(process)
+        stdout, stderr = _communicate(process, input, timeout)
+    except subprocess.TimeoutExpired as e:
+        error = subprocess.TimeoutExpired(cmd, timeout, e.output, e.stderr)
+        error.rusage = process.rusage
+        raise error
+    except BaseException:
+        if process.returncode is None:
+            stop_child(process)
+            _reap(process)
+        raise
+    if process.status_lost and stderr is not None:
+        note = "Exit status lost (the process was reaped elsewhere), counted as a failure\n"
+        stderr += note if isinstance(stderr, str) else note.encode()
+    result = subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+    result.rusage = process.rusage
+    if check and process.returncode:
+        error = subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        error.rusage = process.rusage
+        raise error
+    return result
+
+def file_size(*paths):
+    """Return the total size of the existing files among paths"""
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+class StageRecord:
+    """Measurements of one stage, for one file or for the whole batch"""
+
+    def __init__(self, name, file, start):
+        self.name = name
+        self.file = file
+        self.thread = threading.current_thread().name
+        self.start = start
+        self.wall = 0.0
+        self.cpu = 0.0  # CPU time of the Python thread running the stage
+        self.child_cpu = 0.0
+        self.child_peak_rss = 0
+        self.children = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.kmers = 0
+        self.ok = True
+
+    def add_io(self, read=0, written=0):
+        self.bytes_read += read
+        self.bytes_written += written
+
+    def to_dict(self):
+        return {
+            'stage': self.name,
+            'file': self.file,
+            'start_s': round(self.start, 6),
+            'wall_s': round(self.wall, 6),
+            'cpu_s': round(self.cpu, 6),
+            'child_cpu_s': round(self.child_cpu, 6),
+            'child_peak_rss_bytes': self.child_peak_rss,
+            'child_processes': self.children,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'kmers': self.kmers,
+            'kmers_per_s': round(self.kmers / self.wall, 1) if self.wall > 0 else None,
+            'ok': self.ok,
+        }
+
+class RunMetrics:
+    """Collects stage records for one batch run"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._origin = time.perf_counter()
+        self._cpu_origin = time.process_time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.records = []
+        self.info = {}
+
+    def now(self):
+        """Seconds since the run started"""
+        return time.perf_counter() - self._origin
+
+    @contextmanager
+    def stage(self, name, file=None):
+        """Time a stage; child processes run through measure_run() inside it are attributed to it"""
+        record = StageRecord(name, file, self.now())
+        previous = getattr(self._local, 'record', None)
+        self._local.record = record
+        cpu_start = _thread_time()
+        try:
+            yield record
+        except BaseException:
+            record.ok = False
+            raise
+        finally:
+            record.cpu = _thread_time() - cpu_start
+            record.wall = self.now() - record.start
+            self._local.record = previous
+            with self._lock:
+                self.records.append(record)
+
+    def add_child(self, rusage, record=None):
+        """Attribute the resource usage of a finished child process to a stage"""
+        record = record or getattr(self._local, 'record', None)
+        if record is None or rusage is None:
+            return
+        with self._lock:
+            record.children += 1
+            record.child_cpu += rusage.ru_utime + rusage.ru_stime
+            record.child_peak_rss = max(record.child_peak_rss, rusage.ru_maxrss * _RSS_SCALE)
+
+    def measure_run(self, run, record=None):
+        """Wrap a subprocess.run-like callable so each child's usage lands in a stage
+
+        Without record the stage active on the calling thread is used; pass
+        one for commands that run on helper threads.
+        """
+        def measured(cmd, *args, **kwargs):
+            try:
+                result = run(cmd, *args, **kwargs)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                self.add_child(getattr(e, 'rusage', None), record)
+                raise
+            self.add_child(getattr(result, 'rusage', None), record)
+            return result
+        return measured
+
+    def summary(self):
+        """Totals per stage name"""
+        stages = {}
+        for record in self.records:
+            entry = stages.setdefault(record.name, {
+                'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'child_cpu_s': 0.0,
+                'child_peak_rss_bytes': 0, 'bytes_read': 0, 'bytes_written': 0, 'kmers': 0,
+            })
+            entry['count'] += 1
+            entry['wall_s'] += record.wall
+            entry['cpu_s'] += record.cpu
+            entry['child_cpu_s'] += record.child_cpu
+            entry['child_peak_rss_bytes'] = max(entry['child_peak_rss_bytes'], record.child_peak_rss)
+            entry['bytes_read'] += record.bytes_read
+            entry['bytes_written'] += record.bytes_written
+            entry['kmers'] += record.kmers
+        for entry in stages.values():
+            entry['kmers_per_s'] = round(entry['kmers'] / entry['wall_s'], 1) if entry['wall_s'] > 0 else None
+            for key in ('wall_s', 'cpu_s', 'child_cpu_s'):
+                entry[key] = round(entry[key], 6)
+        return stages
+
+    def report(self):
+        """Return the whole run as a JSON-serializable dictionary"""
+        totals = {
+            'wall_s': round(self.now(), 6),
+            'cpu_s': round(time.process_time() - self._cpu_origin, 6),
+        }
+        if resource is not None:
+            own = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            totals['peak_rss_bytes'] = own.ru_maxrss * _RSS_SCALE
+            totals['child_cpu_s'] = round(children.ru_utime + children.ru_stime, 6)
+            totals['child_peak_rss_bytes'] = children.ru_maxrss * _RSS_SCALE
+        files = {}
+        for record in self.records:
+            if record.file is not None:
+                files.setdefault(record.file, []).append(record.to_dict())
+        return {
+            'report_version': REPORT_VERSION,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+            'run': self.info,
+            'totals': totals,
+            'stages': self.summary(),
+            'files': files,
+            'records': [record.to_dict() for record in sorted(self.records, key=lambda r: r.start)],
+        }
+
+    def write_report(self, report_file):
+        """Write the JSON run report"""
+        with open(report_file, 'w') as outfile:
+            json.dump(self.report(), outfile, indent=2)
+
+    def write_trace(self, trace_file):
+        """Write the stages as Chrome trace events, one row per thread"""
+        threads = {}
+        events = []
+        for record in sorted(self.records, key=lambda r: r.start):
+            tid = threads.setdefault(record.thread, len(threads) + 1)
+            args = record.to_dict()
+            events.append({
+                'name': record.name if record.file is None else f"{record.name} {record.file}",
+                'cat': record.name,
+                'ph': 'X',
+                'ts': int(record.start * 1e6),
+                'dur': int(record.wall * 1e6),
+                'pid': 1,
+                'tid': tid,
+                'args': args,
+            })
+        for name, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+        with open(trace_file, 'w') as outfile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, outfile)
+
+@contextmanager
+def null_stage(name, file=None):
+    """Stand-in for RunMetrics.stage when no metrics are collected"""
+    yield StageRecord(name, file, 0.0)
@@ -0,0 +1,185 @@
+"""
+Partitioned binary_existence for KMC Batch Processing
+Spreads the final aggregation over all CPU cores
+
+  1. route   every k-mer of every file is written to one of P bucket files
+             chosen by its leading bases, so all k-mers of bucket p sort
+             before those of bucket p + 1
+  2. count   the buckets are counted independently in a process pool
+  3. concat  the bucket results are concatenated in bucket order, which is
+             already the global k-mer order
+
+Routing is split over the same pool: each worker routes a share of the
+files into its own set of bucket files. A worker only ever holds one
+bucket's distinct k-mers in memory; a bucket larger than max_bucket_bytes
+(skewed prefixes) is split again by a longer prefix before it is counted.
+
+Each input must list a k-mer at most once, as KMC databases and dumps do.
+"""
+
+import math
+import os
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+
+from aggregate import filter_file_counts, read_dump_kmers
+from kmc_db import KMCDatabase, read_kmer_count
+
+DEFAULT_MAX_BUCKET_BYTES = 256 * 1024 * 1024
+MAX_PARTITIONS = 4096
+FLUSH_LINES = 65536  # buffered k-mers per bucket before they are appended to disk
+
+def prefix_length(partitions):
+    """Number of leading bases needed to tell partitions buckets apart"""
+    return max(1, math.ceil(math.log(max(partitions, 2), 4)))
+
+def bucket_table(partitions):
+    """Return (prefix length, {prefix: bucket}) mapping prefixes to buckets in sorted order"""
+    length = prefix_length(partitions)
+    prefixes = ["".join(p) for p in product("ACGT", repeat=length)]
+    return length, {prefix: i * partitions // len(prefixes) for i, prefix in enumerate(prefixes)}
+
+def _read_source(source, kind):
+    if kind == 'kmc_db':
+        return KMCDatabase(source).iter_kmer_strings()
+    return read_dump_kmers(source)
+
+def _route(task):
+    """Write the k-mers of some sources into this worker's bucket files"""
+    sources, kind, bucket_dir, worker, partitions = task
+    length, table = bucket_table(partitions)
+    buffers = [[] for _ in range(partitions)]
+
+    def flush(bucket):
+        with open(Path(bucket_dir) / f"w{worker}_b{bucket}.txt", 'a') as outfile:
+            outfile.write("\n".join(buffers[bucket]))
+            outfile.write("\n")
+        buffers[bucket] = []
+
+    for source in sources:
+        for kmer in _read_source(source, kind):
+            bucket = table[kmer[:length]]
+            buffers[bucket].append(kmer)
+            if len(buffers[bucket]) >= FLUSH_LINES:
+                flush(bucket)
+    for bucket in range(partitions):
+        if buffers[bucket]:
+            flush(bucket)
+
+def _count_files(files, outfile, max_bytes, start, min_files=None, max_files=None):
+    """Count lines of files and write 'kmer<TAB>count' sorted, splitting oversized input by prefix
+
+    Returns the number of k-mers written, those within [min_files, max_files].
+    """
+    size = sum(os.path.getsize(f) for f in files)
+    if size <= max_bytes:
+        counts = Counter()
+        for path in files:
+            with open(path, 'r') as infile:
+                counts.update(infile)
+        written = 0
+        for line, count in filter_file_counts(((line, counts[line]) for line in sorted(counts)),
+                                              min_files, max_files):
+            outfile.write(f"{line[:-1]}\t{count}\n")
+            written += 1
+        return written
+
+    # Split by the next bases; equal-length prefixes keep the global order
+    extra = max(1, math.ceil(math.log(size / max_bytes, 4)))
+    end = start + extra
+    split_dir = Path(tempfile.mkdtemp(prefix="split_", dir=Path(files[0]).parent))
+    try:
+        buffers = {}
+        for path in files:
+            with open(path, 'r') as infile:
+                for line in infile:
+                    key = line[:end]
+                    buffer = buffers.setdefault(key, [])
+                    buffer.append(line)
+                    if len(buffer) >= FLUSH_LINES:
+                        with open(split_dir / f"{key.strip()}.txt", 'a') as part:
+                            part.writelines(buffer)
+                        buffer.clear()
+        for key, buffer in buffers.items():
+            if buffer:
+                with open(split_dir / f"{key.strip()}.txt", 'a') as part:
+                    part.writelines(buffer)
+        if len(buffers) == 1:
+            # Nothing left to split on (one k-mer in many files), count it as is
+            max_bytes = float('inf')
+        total = 0
+        for key in sorted(buffers):
+            total += _count_files([split_dir / f"{key.strip()}.txt"], outfile, max_bytes, end, min_files, max_files)
+        return total
+    finally:
+        shutil.rmtree(split_dir, ignore_errors=True)
+
+def _count_bucket(task):
+    """Count one bucket across the route files of every worker, return the k-mers written"""
+    bucket_dir, bucket, routers, out_file, max_bytes, start, min_files, max_files = task
+    files = [Path(bucket_dir) / f"w{w}_b{bucket}.txt" for w in range(routers)]
+    files = [f for f in files if f.exists()]
+    with open(out_file, 'w') as outfile:
+        if not files:
+            return 0
+        total = _count_files(files, outfile, max_bytes, start, min_files, max_files)
+    for f in files:
+        os.remove(f)
+    return total
+
+def estimate_bytes(sources, kind, k=None):
+    """Approximate size of the routed k-mers of sources"""
+    if kind == 'kmc_db':
+        return sum(read_kmer_count(source) for source in sources) * ((k or 31) + 1)
+    return sum(os.path.getsize(source) for source in sources)
+
+def choose_partitions(sources, kind, workers, max_bucket_bytes, k=None):
+    """Enough buckets for every worker and to keep each bucket under max_bucket_bytes"""
+    needed = math.ceil(estimate_bytes(sources, kind, k) / max(1, max_bucket_bytes))
+    return max(1, min(MAX_PARTITIONS, max(2 * workers, needed)))
+
+def binary_existence_partitioned(sources, binary_file, kind='dump', partitions=None, workers=None,
+                                 tmp_dir=None, max_bucket_bytes=DEFAULT_MAX_BUCKET_BYTES, k=None,
+                                 min_files=None, max_files=None):
+    """Count files per k-mer with prefix buckets counted in parallel, return the number of k-mers
+
+    sources are KMC text dumps (kind='dump') or database paths
+    (kind='kmc_db'). partitions defaults to enough buckets to keep each
+    under max_bucket_bytes and every worker busy; workers defaults to the
+    CPU count. Buckets are kept in a temporary folder under tmp_dir.
+    Only k-mers found in min_files to max_files files are written.
+    """
+    workers = max(1, workers or os.cpu_count() or 1)
+    max_bucket_bytes = max(1, max_bucket_bytes)
+    if not partitions:
+        partitions = choose_partitions(sources, kind, workers, max_bucket_bytes, k)
+    partitions = max(1, min(MAX_PARTITIONS, partitions))
+    tmp_dir = Path(tmp_dir) if tmp_dir else Path(binary_file).parent
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    bucket_dir = Path(tempfile.mkdtemp(prefix="binary_existence_buckets_", dir=tmp_dir))
+    length = prefix_length(partitions)
+    try:
+        routers = max(1, min(workers, len(sources)))
+        shares = [[str(s) for s in sources[w::routers]] for w in range(routers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            route_tasks = [(share, kind, str(bucket_dir), w, partitions) for w, share in enumerate(shares)]
+            list(executor.map(_route, route_tasks))
+            count_tasks = [
+                (str(bucket_dir), b, routers, str(bucket_dir / f"counts_{b}.txt"), max_bucket_bytes, length,
+                 min_files, max_files)
+                for b in range(partitions)
+            ]
+            totals = list(executor.map(_count_bucket, count_tasks))
+
+        with open(binary_file, 'wb') as outfile:
+            outfile.write(b"# k-mer\tfile_count\n")
+            for b in range(partitions):
+                with open(bucket_dir / f"counts_{b}.txt", 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile, 16 * 1024 * 1024)
+        return sum(totals)
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
@@ -0,0 +1,145 @@
+"""
+Streaming stage pipeline for KMC Batch Processing
+Runs per-file work through stages connected by bounded queues
+
+Each stage has its own worker threads, so file i+1 can be counted while
+file i is dumped and file i-1 is folded into the aggregation. Bounded
+queues keep fast stages from running far ahead of slow ones. Per-stage
+statistics (busy, idle and blocked time, queue depth) show where the
+batch actually spends its time.
+"""
+
+import heapq
+import queue
+import threading
+import time
+
+DEFAULT_QUEUE_SIZE = 2
+
+_DONE = object()
+
+class Stage:
+    """One pipeline step: func(item) -> item, run by a number of worker threads
+
+    An ordered stage sees items in submission order even when upstream
+    stages finish them out of order.
+    """
+
+    def __init__(self, name, func, workers=1, ordered=False):
+        self.name = name
+        self.func = func
+        self.workers = 1 if ordered else max(1, workers)
+        self.ordered = ordered
+        self.items = 0
+        self.busy = 0.0  # seconds spent in func
+        self.idle = 0.0  # seconds waiting for input
+        self.blocked = 0.0  # seconds waiting for room downstream
+        self.max_depth = 0  # deepest input queue seen
+        self._depth_total = 0
+        self._lock = threading.Lock()
+
+    def mean_depth(self):
+        """Average input queue depth seen when items were taken"""
+        return self._depth_total / self.items if self.items else 0.0
+
+    def report(self):
+        """Return the stage statistics as a dictionary"""
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'items': self.items,
+            'busy_s': round(self.busy, 3),
+            'idle_s': round(self.idle, 3),
+            'blocked_s': round(self.blocked, 3),
+            'max_queue_depth': self.max_depth,
+            'mean_queue_depth': round(self.mean_depth(), 2),
+        }
+
+class Pipeline:
+    """Chain of stages fed from an iterable of items"""
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.error = None
+
+    def run(self, items):
+        """Push every item through all stages and wait for the last one
+
+        Exceptions raised by a stage function are re-raised here after the
+        pipeline has drained; the failing item is passed on unchanged so
+        ordered stages are not stalled.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        queues.append(None)  # output of the last stage is discarded
+        threads = []
+        for n, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker, args=(stage, queues[n], queues[n + 1], remaining),
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        for index, item in enumerate(items):
+            queues[0].put((index, item))
+        queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _worker(self, stage, inbox, outbox, remaining):
+        reorder = []  # ordered stages: heap of items that arrived early
+        next_index = 0
+        while True:
+            started = time.perf_counter()
+            entry = inbox.get()
+            waited = time.perf_counter() - started
+            if entry is _DONE:
+                with stage._lock:
+                    stage.idle += waited
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    for index, _, item in sorted(reorder):
+                        self._call(stage, (index, item), outbox)
+                    if outbox is not None:
+                        outbox.put(_DONE)
+                else:
+                    # Let the other workers of this stage see the end marker too
+                    inbox.put(_DONE)
+                return
+            with stage._lock:
+                stage.idle += waited
+                depth = inbox.qsize()
+                stage.max_depth = max(stage.max_depth, depth + 1)
+                stage._depth_total += depth + 1
+            if not stage.ordered:
+                self._call(stage, entry, outbox)
+                continue
+            index, item = entry
+            heapq.heappush(reorder, (index, id(item), item))
+            while reorder and reorder[0][0] == next_index:
+                _, _, ready = heapq.heappop(reorder)
+                self._call(stage, (next_index, ready), outbox)
+                next_index += 1
+
+    def _call(self, stage, entry, outbox):
+        index, item = entry
+        started = time.perf_counter()
+        try:
+            item = stage.func(item)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+        finished = time.perf_counter()
+        with stage._lock:
+            stage.items += 1
+            stage.busy += finished - started
+        if outbox is not None:
+            outbox.put((index, item))
+            with stage._lock:
+                stage.blocked += time.perf_counter() - finished
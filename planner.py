@@ -0,0 +1,359 @@
+"""
+Run planning for KMC Batch Processing
+Estimates runtime, peak RAM and disk of a batch without running KMC
+
+The estimate is built from the input sizes and a calibration model: a
+handful of ratios (seconds per input byte for counting, k-mers per input
+byte, database and dump bytes per k-mer, union size over the sum of the
+per-file k-mers, seconds and RAM per k-mer for each aggregation engine,
+...). Each ratio is kept as a numerator and denominator summed over real
+runs: every finished run folds its run_report.json into the calibration
+file, with older runs weighted down by DECAY, so the model follows the
+machine and data it is used on. Ratios no run has measured yet fall back
+to DEFAULTS.
+
+With sample_files, that many inputs (spread over the size range) are
+read: their sequence length is counted exactly and a prefix of up to
+SAMPLE_BASES bases is split into canonical k-mers, giving the share of
+k-mer positions that survive the counter bounds. Both are extrapolated to
+the other files in place of the calibrated k-mers per byte.
+"""
+
+import json
+import math
+import os
+import time
+from collections import Counter
+from pathlib import Path
+
+from fasta_inputs import compression, open_fasta
+from scheduling import count_bases
+
+CALIBRATION_NAME = "kmc_calibration.json"
+CALIBRATION_VERSION = 1
+DECAY = 0.7  # weight of the earlier runs each time a run is added
+SAMPLE_BASES = 500000
+KMC_DEFAULT_MIN_COUNT = 2
+SAFETY = 1.5  # margin of the suggested allocation over the estimate
+ENGINES = ('memory', 'stream', 'numpy', 'partitioned')
+PYTHON_BASE_BYTES = 200 * 1024 ** 2
+
+# Ratios used until a run has measured them (per engine: '<name>.<engine>')
+DEFAULTS = {
+    'count_s_per_byte': 1e-7,
+    'kmers_per_byte': 1.0,
+    'db_bytes_per_kmer': 8.0,
+    'dump_s_per_kmer': 2e-7,
+    'dump_extra_bytes_per_kmer': 4.0,  # dump line length beyond k
+    'union_ratio': 0.5,
+    'merge_s_per_kmer': 1e-7,
+    'merge_rss_per_kmer': 16.0,
+    'combination_s_per_byte': 5e-9,
+    'binary_extra_bytes_per_kmer': 4.0,  # binary_existence line length beyond k
+    'binary_s_per_kmer.memory': 5e-7,
+    'binary_s_per_kmer.stream': 1e-6,
+    'binary_s_per_kmer.numpy': 1e-7,
+    'binary_s_per_kmer.partitioned': 3e-7,
+    'binary_rss_per_kmer.memory': 150.0,
+    'binary_rss_per_kmer.numpy': 24.0,
+    'abundance_s_per_kmer': 1e-7,
+}
+
+_COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+class Calibration:
+    """Ratios of numerator and denominator sums over the recorded runs"""
+
+    def __init__(self, sums=None, runs=0):
+        self.sums = sums or {}
+        self.runs = runs
+
+    @classmethod
+    def load(cls, path):
+        """Read a calibration file; a missing one gives an empty calibration"""
+        if path is None or not Path(path).exists():
+            return cls()
+        with open(path, 'r') as infile:
+            data = json.load(infile)
+        if data.get('calibration_version') != CALIBRATION_VERSION:
+            raise ValueError(f"{path} has an unsupported version: {data.get('calibration_version')}")
+        return cls({name: tuple(pair) for name, pair in data['sums'].items()}, data.get('runs', 0))
+
+    def save(self, path):
+        """Write the calibration file, replacing it in one step"""
+        data = {
+            'calibration_version': CALIBRATION_VERSION,
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'runs': self.runs,
+            'sums': {name: list(pair) for name, pair in sorted(self.sums.items())},
+        }
+        tmp_file = Path(f"{path}.tmp")
+        with open(tmp_file, 'w') as outfile:
+            json.dump(data, outfile, indent=2)
+        tmp_file.replace(path)
+
+    def ratio(self, name):
+        """Calibrated value of a ratio, or its default"""
+        numerator, denominator = self.sums.get(name, (0.0, 0.0))
+        return numerator / denominator if denominator > 0 else DEFAULTS[name]
+
+    def calibrated(self, name):
+        """Whether some recorded run measured the ratio"""
+        return self.sums.get(name, (0.0, 0.0))[1] > 0
+
+    def add_report(self, report):
+        """Fold the measurements of one run report into the sums"""
+        self.sums = {name: (n * DECAY, d * DECAY) for name, (n, d) in self.sums.items()}
+        self.runs += 1
+        for name, numerator, denominator in report_ratios(report):
+            if denominator > 0 and numerator >= 0:
+                n, d = self.sums.get(name, (0.0, 0.0))
+                self.sums[name] = (n + numerator, d + denominator)
+
+def report_ratios(report):
+    """Yield (ratio name, numerator, denominator) measured by a run report"""
+    run = report.get('run', {})
+    k = run.get('k') or 0
+    engine = run.get('aggregation')
+    stages = report.get('stages', {})
+    count = {'wall': 0.0, 'read': 0, 'written': 0, 'kmers': 0}
+    dump = {'wall': 0.0, 'written': 0, 'kmers': 0}
+    for records in report.get('files', {}).values():
+        for record in records:
+            # Only files KMC actually counted; cache hits and reused results ran no child
+            if not record.get('ok') or not record.get('child_processes'):
+                continue
+            if record['stage'] == 'count':
+                count['wall'] += record['wall_s']
+                count['read'] += record['bytes_read']
+                count['written'] += record['bytes_written']
+                count['kmers'] += record['kmers']
+            elif record['stage'] == 'dump':
+                dump['wall'] += record['wall_s']
+                dump['written'] += record['bytes_written']
+                dump['kmers'] += record['kmers']
+    yield 'count_s_per_byte', count['wall'], count['read']
+    yield 'kmers_per_byte', count['kmers'], count['read']
+    yield 'db_bytes_per_kmer', count['written'], count['kmers']
+    yield 'dump_s_per_kmer', dump['wall'], dump['kmers']
+    yield 'dump_extra_bytes_per_kmer', dump['written'] - k * dump['kmers'], dump['kmers']
+
+    file_kmers = stages.get('count', {}).get('kmers', 0)
+    overlap = stages.get('overlap_merge', {})
+    union = overlap.get('kmers', 0)
+    if overlap and file_kmers:
+        yield 'union_ratio', union, file_kmers
+        yield 'merge_s_per_kmer', overlap['wall_s'], file_kmers
+        yield 'merge_rss_per_kmer', overlap['child_peak_rss_bytes'], union
+    combination = stages.get('combination_raw', {})
+    if combination.get('bytes_written'):
+        yield 'combination_s_per_byte', combination['wall_s'], combination['bytes_written']
+    binary = stages.get('binary_existence', {})
+    if binary and engine in ENGINES and file_kmers:
+        # With --pipeline part of the counting is done while the files are folded in
+        wall = binary['wall_s'] + stages.get('aggregate', {}).get('wall_s', 0.0)
+        yield f'binary_s_per_kmer.{engine}', wall, file_kmers
+        if binary.get('kmers'):
+            yield 'binary_extra_bytes_per_kmer', binary['bytes_written'] - k * binary['kmers'], binary['kmers']
+        peak = report.get('totals', {}).get('peak_rss_bytes')
+        if engine in ('memory', 'numpy') and peak and union:
+            yield f'binary_rss_per_kmer.{engine}', max(0, peak - PYTHON_BASE_BYTES), union
+    abundance = stages.get('abundance_matrix', {})
+    if abundance.get('kmers'):
+        yield 'abundance_s_per_kmer', abundance['wall_s'], abundance['kmers']
+
+def update_calibration(path, report):
+    """Add a run report to the calibration file at path (created if needed)"""
+    calibration = Calibration.load(path)
+    calibration.add_report(report)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    calibration.save(path)
+    return calibration
+
+def _canonical_kmers(sequence, k):
+    for start in range(len(sequence) - k + 1):
+        kmer = sequence[start:start + k]
+        if kmer.strip("ACGT"):
+            continue
+        reverse = kmer.translate(_COMPLEMENT)[::-1]
+        yield kmer if kmer <= reverse else reverse
+
+def sample_kmers(fasta_file, k, min_count=None, max_count=None, sample_bases=SAMPLE_BASES):
+    """Return the share of k-mer positions in a prefix of fasta_file kept by the counter bounds"""
+    counts = Counter()
+    sequence = []
+    taken = 0
+
+    def flush():
+        counts.update(_canonical_kmers("".join(sequence).upper(), k))
+        sequence.clear()
+
+    with open_fasta(fasta_file) as infile:
+        for line in infile:
+            if line.startswith(b'>'):
+                flush()
+                continue
+            line = line.strip().decode('ascii', 'replace')
+            sequence.append(line)
+            taken += len(line)
+            if taken >= sample_bases:
+                break
+    flush()
+    positions = sum(counts.values())
+    if not positions:
+        return 0.0
+    low = min_count if min_count is not None else KMC_DEFAULT_MIN_COUNT
+    kept = sum(1 for count in counts.values() if count >= low and (max_count is None or count <= max_count))
+    return kept / positions
+
+def sample_inputs(fasta_files, sizes, k, count, min_count=None, max_count=None):
+    """Measure count inputs spread over the size range, return {file: (bases, kept k-mer share)}"""
+    ranked = sorted(fasta_files, key=lambda f: sizes[f])
+    count = min(count, len(ranked))
+    if count <= 0:
+        return {}
+    picks = sorted({round(i * (len(ranked) - 1) / max(1, count - 1)) for i in range(count)})
+    return {ranked[i]: (count_bases(ranked[i]), sample_kmers(ranked[i], k, min_count, max_count))
+            for i in picks}
+
+def estimate_plan(fasta_files, calibration, k, ram_gb, threads, workers, aggregation='memory',
+                  native_db=False, presence_matrix=False, abundance_matrix=False, partitions_bytes=None, samples=None,
+                  min_count=None, max_count=None):
+    """Estimate time (s), RAM (bytes) and disk (bytes) of a batch over fasta_files
+
+    workers is the number of files counted at the same time. samples is
+    the result of sample_inputs; without it the k-mers of a file come
+    from the calibrated k-mers per input byte. Returns a dictionary with
+    'files', 'stages' {name: seconds}, 'ram' {name: bytes}, 'disk'
+    {name: bytes} and the totals.
+    """
+    k = int(k)
+    used = set()
+
+    def c(name):
+        used.add(name)
+        return calibration.ratio(name)
+
+    sizes = {f: os.path.getsize(f) for f in fasta_files}
+    samples = samples or {}
+
+    # K-mers per file, from the samples where there are some
+    kmers = {}
+    if samples:
+        share = sum(s for _, s in samples.values()) / len(samples)
+        ratios = {}
+        for f, (bases, _) in samples.items():
+            ratios.setdefault(bool(compression(f)), []).append(bases / max(1, sizes[f]))
+        every = [r for values in ratios.values() for r in values]
+        for f in fasta_files:
+            if f in samples:
+                bases, kept = samples[f]
+            else:
+                per_byte = ratios.get(bool(compression(f)), every)
+                bases, kept = sizes[f] * sum(per_byte) / len(per_byte), share
+            kmers[f] = max(0, bases - k + 1) * kept
+    else:
+        kmers = {f: sizes[f] * c('kmers_per_byte') for f in fasta_files}
+
+    total_bytes = sum(sizes.values())
+    total_kmers = sum(kmers.values())
+    largest_kmers = max(kmers.values(), default=0)
+    union = min(total_kmers, max(largest_kmers, total_kmers * c('union_ratio')))
+    dump_line = k + c('dump_extra_bytes_per_kmer')
+
+    per_file = [sizes[f] * c('count_s_per_byte') + (0 if native_db else kmers[f] * c('dump_s_per_kmer'))
+                for f in fasta_files]
+    stages = {
+        'count_and_dump': max(sum(per_file) / max(1, workers), max(per_file, default=0)),
+        'overlap_merge': total_kmers * c('merge_s_per_kmer'),
+        'combination_raw': total_kmers * dump_line * c('combination_s_per_byte'),
+        'binary_existence': total_kmers * c(f'binary_s_per_kmer.{aggregation}'),
+    }
+    if abundance_matrix:
+        stages['abundance_matrix'] = total_kmers * c('abundance_s_per_kmer')
+
+    if aggregation in ('memory', 'numpy'):
+        binary_ram = union * c(f'binary_rss_per_kmer.{aggregation}')
+    elif aggregation == 'partitioned':
+        binary_ram = 3 * (partitions_bytes or 256 * 1024 ** 2) * max(1, workers)
+    else:
+        binary_ram = len(fasta_files) * 1024 ** 2  # one read buffer per merged file
+    ram = {
+        'kmc': ram_gb * 1024 ** 3,
+        'overlap_merge': union * c('merge_rss_per_kmer'),
+        'binary_existence': binary_ram + PYTHON_BASE_BYTES,
+    }
+
+    dumps = 0 if native_db else total_kmers * dump_line
+    disk = {
+        'databases': total_kmers * c('db_bytes_per_kmer'),
+        'dumps': dumps,
+        'kmc_temp': 2 * max(sizes.values(), default=0) * max(1, workers),
+        'overlap_merge': union * (c('db_bytes_per_kmer') + dump_line),
+        'combination_raw': total_kmers * dump_line,
+        'binary_existence': union * (k + c('binary_extra_bytes_per_kmer')),
+    }
+    if presence_matrix:
+        disk['presence_matrix'] = union * math.ceil(len(fasta_files) / 8)
+    if abundance_matrix:
+        # 8-byte k-mers, int32 column ids and uint8 counts
+        disk['abundance_matrix'] = union * 8 + total_kmers * 5
+    if aggregation == 'partitioned':
+        disk['partition_buckets'] = total_kmers * (k + 1)
+    outputs = ('overlap_merge', 'combination_raw', 'binary_existence', 'presence_matrix', 'abundance_matrix')
+    return {
+        'files': len(fasta_files),
+        'input_bytes': total_bytes,
+        'sampled_files': len(samples),
+        'kmers': total_kmers,
+        'union_kmers': union,
+        'stages': stages,
+        'ram': ram,
+        'disk': disk,
+        'total_s': sum(stages.values()),
+        'peak_ram_bytes': max(ram.values()),
+        # Per-file databases and dumps live until the outputs are written
+        'peak_disk_bytes': sum(disk.values()),
+        'output_bytes': sum(size for name, size in disk.items() if name in outputs),
+        'calibrated_runs': calibration.runs,
+        'defaults_used': sorted(name for name in used if not calibration.calibrated(name)),
+    }
+
+def _size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return f"{n:.1f} {unit}" if unit != 'B' else f"{n:.0f} B"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+def _duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f} s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f} min"
+    return f"{seconds / 3600:.1f} h"
+
+def format_plan(plan):
+    """Return the plan as lines of text, ending with a suggested allocation"""
+    lines = [
+        f"Inputs: {plan['files']} files, {_size(plan['input_bytes'])}"
+        + (f", {plan['sampled_files']} sampled" if plan['sampled_files'] else ""),
+        f"Estimated k-mers: {plan['kmers']:,.0f} over all files, {plan['union_kmers']:,.0f} distinct",
+        "",
+        "Runtime:",
+    ]
+    lines += [f"  {name:<17} {_duration(seconds)}" for name, seconds in plan['stages'].items()]
+    lines += [f"  {'total':<17} {_duration(plan['total_s'])}", "", "Peak RAM:"]
+    lines += [f"  {name:<17} {_size(size)}" for name, size in plan['ram'].items()]
+    lines += ["", "Disk (output and work folders):"]
+    lines += [f"  {name:<17} {_size(size)}" for name, size in plan['disk'].items()]
+    lines += [f"  {'peak':<17} {_size(plan['peak_disk_bytes'])} (final outputs {_size(plan['output_bytes'])})", ""]
+    if plan['calibrated_runs']:
+        lines.append(f"Calibrated from {plan['calibrated_runs']} earlier runs")
+    else:
+        lines.append("No earlier runs recorded yet, using default rates")
+    if plan['defaults_used']:
+        lines.append(f"  Defaults for: {', '.join(plan['defaults_used'])}")
+    lines.append(f"Suggested allocation (x{SAFETY:g} margin): time {_duration(plan['total_s'] * SAFETY)}, "
+                 f"memory {_size(plan['peak_ram_bytes'] * SAFETY)}, scratch {_size(plan['peak_disk_bytes'] * SAFETY)}")
+    return lines
@@ -0,0 +1,141 @@
+"""
+Packed k-mer x file presence/absence matrix for KMC Batch Processing
+One bit per file per k-mer, row-aligned with binary_existence.txt
+
+File layout (all integers little-endian):
+
+  magic       8 bytes, b"KMCPRES1"
+  n_files     uint32
+  row_bytes   uint32, ceil(n_files / 8)
+  n_rows      uint64, patched when the writer is closed
+  names_size  uint32, size of the JSON list of file names that follows
+  names       UTF-8 JSON list, file order of the columns (processed_dbs order)
+  padding     zero bytes up to a multiple of 64
+  rows        n_rows * row_bytes; file j of row i is bit (j % 8) of byte
+              (j // 8), least significant bit first
+
+Row i describes the k-mer on line i + 1 of binary_existence.txt (after
+the header line). The rows can be opened with numpy.memmap without
+loading the matrix into memory.
+"""
+
+import json
+import struct
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    np = None
+    HAVE_NUMPY = False
+
+MAGIC = b"KMCPRES1"
+_FIXED = struct.Struct("<8sIIQI")
+_ALIGN = 64
+
+class PresenceMatrixWriter:
+    """Append presence rows to a matrix file as k-mers stream through"""
+
+    def __init__(self, path, file_names):
+        self.path = str(path)
+        self.file_names = [str(name) for name in file_names]
+        self.n_files = len(self.file_names)
+        self.row_bytes = (self.n_files + 7) // 8
+        self.n_rows = 0
+        names = json.dumps(self.file_names).encode('utf-8')
+        header_size = _FIXED.size + len(names)
+        padding = -header_size % _ALIGN
+        self._file = open(self.path, 'wb')
+        self._file.write(_FIXED.pack(MAGIC, self.n_files, self.row_bytes, 0, len(names)))
+        self._file.write(names + b"\0" * padding)
+
+    def add_mask(self, mask):
+        """Append one row given as an integer bitset (bit j = file j)"""
+        self._file.write(mask.to_bytes(self.row_bytes, 'little'))
+        self.n_rows += 1
+
+    def add_files(self, file_indices):
+        """Append one row given the indices of the files containing the k-mer"""
+        mask = 0
+        for j in file_indices:
+            mask |= 1 << j
+        self.add_mask(mask)
+
+    def close(self):
+        """Record the final row count in the header and close the file"""
+        if self._file.closed:
+            return
+        self._file.seek(_FIXED.size - 12)
+        self._file.write(struct.pack("<Q", self.n_rows))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class PresenceMatrix:
+    """Read-only access to a presence matrix file"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, 'rb') as infile:
+            magic, self.n_files, self.row_bytes, self.n_rows, names_size = _FIXED.unpack(infile.read(_FIXED.size))
+            if magic != MAGIC:
+                raise ValueError(f"{self.path} is not a presence matrix file")
+            self.file_names = json.loads(infile.read(names_size).decode('utf-8'))
+        header_size = _FIXED.size + names_size
+        self.data_offset = header_size + (-header_size % _ALIGN)
+
+    def __len__(self):
+        return self.n_rows
+
+    def memmap(self):
+        """Return the packed rows as a read-only (n_rows, row_bytes) uint8 numpy.memmap"""
+        if not HAVE_NUMPY:
+            raise RuntimeError("NumPy is required to memory-map a presence matrix")
+        if self.n_rows == 0:
+            return np.zeros((0, self.row_bytes), dtype=np.uint8)
+        return np.memmap(self.path, dtype=np.uint8, mode='r', offset=self.data_offset,
+                         shape=(self.n_rows, self.row_bytes))
+
+    def row_mask(self, row):
+        """Return row as an integer bitset (bit j = file j), reading only that row"""
+        if not 0 <= row < self.n_rows:
+            raise IndexError(row)
+        with open(self.path, 'rb') as infile:
+            infile.seek(self.data_offset + row * self.row_bytes)
+            return int.from_bytes(infile.read(self.row_bytes), 'little')
+
+    def iter_masks(self, batch_rows=65536):
+        """Yield every row as an integer bitset, in order, reading batch_rows rows at a time"""
+        with open(self.path, 'rb') as infile:
+            infile.seek(self.data_offset)
+            remaining = self.n_rows
+            row_bytes = self.row_bytes
+            while remaining > 0:
+                rows = min(batch_rows, remaining)
+                data = infile.read(rows * row_bytes)
+                if len(data) < rows * row_bytes:
+                    raise ValueError(f"{self.path} is truncated")
+                for offset in range(0, len(data), row_bytes):
+                    yield int.from_bytes(data[offset:offset + row_bytes], 'little')
+                remaining -= rows
+
+    def row_files(self, row):
+        """Return the names of the files that contain the k-mer of a row"""
+        mask = self.row_mask(row)
+        return [name for j, name in enumerate(self.file_names) if mask >> j & 1]
+
+    def column(self, file):
+        """Return a boolean array over rows for one file (by name or index)"""
+        j = self.file_names.index(file) if isinstance(file, str) else file
+        rows = self.memmap()
+        return (rows[:, j // 8] >> (j % 8)) & 1 == 1
+
+    def to_dense(self, start=0, stop=None):
+        """Unpack rows [start, stop) into a (rows, n_files) boolean array"""
+        rows = self.memmap()[start:stop]
+        bits = np.unpackbits(rows, axis=1, bitorder='little')[:, :self.n_files]
+        return bits.astype(bool)
@@ -0,0 +1,145 @@
+"""
+Persistent result cache for KMC Batch Processing
+Reuses per-file KMC databases and dumps across runs, keyed by input content
+
+Each entry lives in <cache_dir>/<key[:2]>/<key>/ and holds the database
+(db.kmc_pre, db.kmc_suf) plus the dump variants produced so far
+(dump.txt, dump_sorted.txt). The key is a SHA-256 over the FASTA content
+and every parameter that changes the counted k-mers (k, counter options,
+KMC version). index.json records entry sizes and last use; when the
+total size exceeds the cap, least recently used entries are evicted.
+
+Entries share their files with the run's outputs through hard links, so
+a path that may be linked is unlinked before it is rewritten, never
+truncated in place (count_fasta_file, dump_database).
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+DB_EXTENSIONS = ('.kmc_pre', '.kmc_suf')
+DUMP_NAMES = {'dump': 'dump.txt', 'dump_sorted': 'dump_sorted.txt'}
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def tool_version(exe):
+    """Return the version string printed by a KMC executable, or a fingerprint of the binary"""
+    try:
+        result = subprocess.run([exe], capture_output=True, text=True, timeout=30)
+        match = re.search(r"ver\.?\s*([0-9][0-9A-Za-z.\-]*)", result.stdout + result.stderr)
+        if match:
+            return match.group(1)
+    except (OSError, subprocess.SubprocessError):
+        pass
+    stat = os.stat(exe)
+    return f"unknown-{stat.st_size}-{int(stat.st_mtime)}"
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst, copying when linking is not possible"""
+    try:
+        os.remove(dst)
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class ResultCache:
+    """Size-capped, LRU-evicted store of per-file KMC results"""
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.index_file = self.cache_dir / "index.json"
+        self._lock = threading.Lock()
+        self._pinned = set()
+        try:
+            with open(self.index_file, 'r') as infile:
+                self._index = json.load(infile)
+        except (OSError, ValueError):
+            self._index = {}
+
+    @staticmethod
+    def make_key(digest, params):
+        """Combine an input digest and counting parameters into a cache key"""
+        payload = json.dumps({'input': digest, 'params': params}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _entry_dir(self, key):
+        return self.cache_dir / key[:2] / key
+
+    def _save_index(self):
+        tmp_file = self.index_file.with_suffix('.json.tmp')
+        with open(tmp_file, 'w') as outfile:
+            json.dump(self._index, outfile)
+        os.replace(tmp_file, self.index_file)
+
+    def restore(self, key, output_db, dump_file=None, dump_kind='dump'):
+        """Link a cached database (and dump, if dump_file is given) into place
+
+        Returns False without touching anything unless every requested file
+        is cached. The entry is pinned for the rest of the run so it cannot
+        be evicted while this batch still needs it.
+        """
+        entry = self._entry_dir(key)
+        with self._lock:
+            if key not in self._index:
+                return False
+            sources = [(entry / f"db{ext}", f"{output_db}{ext}") for ext in DB_EXTENSIONS]
+            if dump_file is not None:
+                sources.append((entry / DUMP_NAMES[dump_kind], dump_file))
+            if not all(src.exists() for src, _ in sources):
+                return False
+            for src, dst in sources:
+                link_or_copy(src, dst)
+            self._index[key]['last_used'] = time.time()
+            self._pinned.add(key)
+            self._save_index()
+            return True
+
+    def store(self, key, output_db, dump_file=None, dump_kind='dump'):
+        """Add a database (and optional dump) to the cache, then enforce the size cap"""
+        entry = self._entry_dir(key)
+        entry.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            for ext in DB_EXTENSIONS:
+                link_or_copy(f"{output_db}{ext}", entry / f"db{ext}")
+            if dump_file is not None and Path(dump_file).exists():
+                link_or_copy(dump_file, entry / DUMP_NAMES[dump_kind])
+            size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+            self._index[key] = {'size': size, 'last_used': time.time()}
+            self._pinned.add(key)
+            self._evict()
+            self._save_index()
+
+    def total_bytes(self):
+        """Return the size of all cached entries in bytes"""
+        return sum(entry['size'] for entry in self._index.values())
+
+    def _evict(self):
+        """Drop least recently used, unpinned entries until the cache fits its cap"""
+        if self.max_bytes is None:
+            return
+        total = self.total_bytes()
+        for key in sorted(self._index, key=lambda key: self._index[key]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key in self._pinned:
+                continue
+            total -= self._index.pop(key)['size']
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
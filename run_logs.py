@@ -0,0 +1,207 @@
+"""
+Child-process logs for KMC Batch Processing
+Streams KMC/kmc_tools output to log files and collects KMC's statistics
+
+Commands asked to capture their output (capture_output=True) write it to
+<output>/logs instead of Python memory: one log per input file
+(<sample>.log) for its counting and dump commands, and batch.log for
+the commands over the whole batch. Each command is preceded by its
+command line and followed by its exit status and duration, both tagged
+with the same command number. A log that grows past max_bytes is
+rotated to .1, .2, ... before the next command.
+When a command fails, the end of its output is attached to the
+CalledProcessError as stderr, so error messages stay the same.
+
+KMC writes a JSON summary of each count with -j<file>
+(<sample>.kmc.json next to the log). write_stats_table() turns the
+summaries of a batch into kmc_stats.tsv and kmc_stats.json, one row per
+input: distinct and total k-mers, reads, super-k-mers, k-mers dropped
+by the count bounds, stage times and temporary disk use.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import itertools
+import threading
+import time
+from pathlib import Path
+
+LOGS_NAME = "logs"
+BATCH_LOG = "batch"
+STATS_NAME = "kmc_stats"
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_BACKUPS = 2
+ERROR_TAIL_BYTES = 4096
+
+# KMC summary key -> statistics column
+STATS_COLUMNS = {
+    '#Unique_k-mers': 'unique_kmers',
+    '#Unique_counted_k-mers': 'unique_counted_kmers',
+    '#Total no. of k-mers': 'total_kmers',
+    '#Total_reads': 'total_reads',
+    '#Total_super-k-mers': 'total_super_kmers',
+    '#k-mers_below_min_threshold': 'below_min_count',
+    '#k-mers_above_max_threshold': 'above_max_count',
+    '1st_stage': 'stage1_s',
+    '2nd_stage': 'stage2_s',
+    'Total': 'total_s',
+    'Tmp_size': 'tmp_size_mb',
+    'Tmp_size_strict_memory': 'tmp_size_strict_memory_mb',
+    'Tmp_total_size': 'tmp_total_size_mb',
+}
+
+def log_file_for(logs_dir, name):
+    """Path of the log of one input (or of the batch)"""
+    return Path(logs_dir) / f"{name}.log"
+
+def stats_file_for(logs_dir, name):
+    """Path of the KMC JSON summary of one input"""
+    return Path(logs_dir) / f"{name}.kmc.json"
+
+def rotate(path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+    """Shift path to path.1 (path.1 to path.2, ...) if it is larger than max_bytes"""
+    path = Path(path)
+    try:
+        if path.stat().st_size < max_bytes:
+            return
+    except OSError:
+        return
+    if backups < 1:
+        path.unlink()
+        return
+    for n in range(backups - 1, 0, -1):
+        older = Path(f"{path}.{n}")
+        if older.exists():
+            os.replace(older, f"{path}.{n + 1}")
+    os.replace(path, f"{path}.1")
+
+def read_tail(path, start=0, size=ERROR_TAIL_BYTES):
+    """Return the last size bytes of path written after offset start, as text"""
+    try:
+        with open(path, 'rb') as infile:
+            end = infile.seek(0, os.SEEK_END)
+            infile.seek(max(start, end - size))
+            return infile.read().decode('utf-8', 'replace').strip()
+    except OSError:
+        return ""
+
+class ChildLogs:
+    """Rotating log files for the commands of one output folder"""
+
+    def __init__(self, logs_dir, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        self.logs_dir = Path(logs_dir)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def wrap(self, run, name=BATCH_LOG):
+        """Wrap a subprocess.run-like callable so captured output goes to <name>.log
+
+        Calls without capture_output are passed through unchanged, so a
+        per-file wrapper can sit on top of the batch one.
+        """
+        log_file = log_file_for(self.logs_dir, name)
+
+        def logged(cmd, *args, **kwargs):
+            if not kwargs.pop('capture_output', False):
+                return run(cmd, *args, **kwargs)
+            with self._lock:
+                self.logs_dir.mkdir(parents=True, exist_ok=True)
+                rotate(log_file, self.max_bytes, self.backups)
+                outfile = open(log_file, 'a')
+                command_id = next(self._ids)
+            with outfile:
+                # Commands of a batch can run concurrently, the id pairs each exit line with its command
+                outfile.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')} #{command_id}] $ "
+                              f"{' '.join(str(arg) for arg in cmd)}\n")
+                outfile.flush()
+                start = outfile.tell()
+                started = time.perf_counter()
+                try:
+                    result = run(cmd, *args, stdout=outfile, stderr=subprocess.STDOUT, **kwargs)
+                except subprocess.CalledProcessError as e:
+                    outfile.write(f"[#{command_id} exit {e.returncode} after {time.perf_counter() - started:.1f} s]\n\n")
+                    e.stderr = read_tail(log_file, start)
+                    raise
+                except subprocess.TimeoutExpired as e:
+                    outfile.write(f"[#{command_id} killed after the {e.timeout:g} s timeout]\n\n")
+                    e.stderr = read_tail(log_file, start)
+                    raise
+                outfile.write(f"[#{command_id} exit {result.returncode} after {time.perf_counter() - started:.1f} s]\n\n")
+            return result
+        return logged
+
+def _number(value):
+    """KMC summary value as a number: 1234, '0.52s' and '12MB' are all accepted"""
+    if isinstance(value, (int, float)):
+        return value
+    text = str(value).strip()
+    for unit in ('MB', 's'):
+        if text.endswith(unit):
+            text = text[:-len(unit)]
+            break
+    try:
+        return float(text) if '.' in text else int(text)
+    except ValueError:
+        return None
+
+def parse_kmc_summary(path):
+    """Return the statistics columns of a KMC -j summary, or None if it is missing or unreadable"""
+    try:
+        with open(path, 'r') as infile:
+            summary = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    fields = dict(summary)
+    fields.update(summary.get('Stats') or {})
+    return {column: _number(fields[key]) for key, column in STATS_COLUMNS.items() if key in fields}
+
+def write_stats_table(output_folder, names, logs_dirs=None):
+    """Write kmc_stats.tsv and kmc_stats.json for the inputs named (sample names)
+
+    The summaries are read from the first of logs_dirs that has one
+    (default: the logs folder of output_folder). Inputs without a summary
+    (reused results, or a KMC without -j) are left out. Returns the number
+    of rows written; nothing is written when there are none.
+    """
+    output_folder = Path(output_folder)
+    logs_dirs = logs_dirs or [output_folder / LOGS_NAME]
+    rows = []
+    for name in sorted(names):
+        for logs_dir in logs_dirs:
+            stats = parse_kmc_summary(stats_file_for(logs_dir, name))
+            if stats is not None:
+                rows.append({'sample': name, **stats})
+                break
+    if not rows:
+        return 0
+    columns = ['sample'] + [column for column in STATS_COLUMNS.values() if any(column in row for row in rows)]
+    tsv_file = output_folder / f"{STATS_NAME}.tsv"
+    with open(tsv_file.with_suffix('.tsv.tmp'), 'w') as outfile:
+        outfile.write("\t".join(columns) + "\n")
+        for row in rows:
+            outfile.write("\t".join("" if row.get(column) is None else str(row[column]) for column in columns) + "\n")
+    tsv_file.with_suffix('.tsv.tmp').replace(tsv_file)
+    json_file = output_folder / f"{STATS_NAME}.json"
+    with open(json_file.with_suffix('.json.tmp'), 'w') as outfile:
+        json.dump({'columns': columns, 'files': rows}, outfile, indent=2)
+    json_file.with_suffix('.json.tmp').replace(json_file)
+    return len(rows)
+
+def merge_logs(src_dir, dst_dir):
+    """Move the logs of src_dir into dst_dir, appending to the logs that already exist there"""
+    src_dir = Path(src_dir)
+    if not src_dir.is_dir():
+        return
+    Path(dst_dir).mkdir(parents=True, exist_ok=True)
+    for src in sorted(src_dir.iterdir()):
+        dst = Path(dst_dir) / src.name
+        if src.suffix == '.log' and dst.exists():
+            with open(src, 'rb') as infile, open(dst, 'ab') as outfile:
+                shutil.copyfileobj(infile, outfile)
+            src.unlink()
+        else:
+            os.replace(src, dst)
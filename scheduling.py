@@ -0,0 +1,146 @@
+"""
+Size-aware scheduling for KMC Batch Processing
+Orders files largest first and sizes each file's share of the RAM/thread budget
+
+Counting time grows with input size, so starting the largest files first
+keeps one big genome from running alone at the end of the batch
+(longest-processing-time-first). Each file then asks for a share of the
+free KMC budget proportional to its size among the files about to start
+next to it, and a shared pool makes sure the shares handed out never
+add up to more than --ram / --threads.
+
+Orders:
+
+  size   largest file (in bytes on disk, compressed or not) first (default)
+  bases  largest number of sequence characters first, from a fast scan
+         that skips headers and line breaks
+  name   input order with an equal split of the budget
+
+A file that is retried after a failure asks for RETRY_GROWTH times the
+RAM and threads of its previous run (escalate), capped at the budget,
+and waits until that much is free.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from fasta_inputs import open_fasta
+from fasta_normalize import CHUNK_SIZE
+
+ORDERS = ('size', 'bases', 'name')
+RETRY_GROWTH = 2
+
+_WHITESPACE = b" \t\r\n\v\f"
+
+def count_bases(fasta_file, chunk_size=CHUNK_SIZE):
+    """Return the number of sequence characters in a FASTA file, without headers and whitespace"""
+    bases = 0
+    in_header = False
+    line_start = True
+    with open_fasta(fasta_file) as infile:
+        while True:
+            data = infile.read(chunk_size)
+            if not data:
+                break
+            pos = 0
+            size = len(data)
+            while pos < size:
+                if in_header:
+                    end = data.find(b'\n', pos)
+                    if end < 0:
+                        break
+                    in_header = False
+                    pos = end + 1
+                    line_start = True
+                elif line_start and data[pos] == 0x3e:  # '>'
+                    in_header = True
+                else:
+                    end = data.find(b'\n>', pos)
+                    stop = size if end < 0 else end + 1
+                    bases += len(data[pos:stop].translate(None, _WHITESPACE))
+                    pos = stop
+                    line_start = data[stop - 1] == 0x0a
+    return bases
+
+def escalate(ram_gb, threads, max_ram_gb, max_threads, growth=RETRY_GROWTH):
+    """Return the (ram_gb, threads) to retry a file with after a run with ram_gb and threads"""
+    return min(max_ram_gb, max(1, int(ram_gb * growth))), min(max_threads, max(1, int(threads * growth)))
+
+def measure_inputs(fasta_files, order='size', workers=1):
+    """Return {file: size} used to rank the files (bytes, or bases for order='bases')"""
+    if order != 'bases':
+        return {fasta_file: os.path.getsize(fasta_file) for fasta_file in fasta_files}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(zip(fasta_files, executor.map(count_bases, fasta_files)))
+
+class Scheduler:
+    """Work order and per-file KMC RAM (GB) / thread shares within a global budget
+
+    With order='name' every file gets ram_gb // workers and
+    threads // workers, as an equal split. Otherwise a file starting while
+    n worker slots are idle takes a part of the free RAM and threads
+    proportional to its size among itself and the n - 1 files after it in
+    the order, leaving at least 1 GB and 1 thread for each of them. What
+    a file takes is returned to the pool when it finishes, so the files
+    running at any moment never exceed the budget.
+    """
+
+    def __init__(self, fasta_files, ram_gb, threads, workers=1, order='size', sizes=None):
+        self.ram_gb = ram_gb
+        self.threads = threads
+        self.workers = max(1, workers)
+        self.mode = order
+        self.sizes = sizes or {}
+        if order == 'name':
+            self.order = list(fasta_files)
+        else:
+            # Stable sort, so equally sized files (and duplicates) keep input order
+            self.order = sorted(fasta_files, key=lambda f: -self.sizes.get(f, 0))
+        self._position = {fasta_file: i for i, fasta_file in enumerate(self.order)}
+        self._condition = threading.Condition()
+        self._free_ram = ram_gb
+        self._free_threads = threads
+        self._running = 0
+
+    def _share(self, fasta_file):
+        # Called with the condition held
+        if self.mode == 'name':
+            return max(1, self.ram_gb // self.workers), max(1, self.threads // self.workers)
+        i = self._position[fasta_file]
+        upcoming = self.order[i + 1:i + self.workers - self._running]
+        others = len(upcoming)
+        size = self.sizes.get(fasta_file, 0)
+        total = size + sum(self.sizes.get(f, 0) for f in upcoming)
+        fraction = size / total if total else 1 / (others + 1)
+        ram = max(1, min(int(self._free_ram * fraction), self._free_ram - others))
+        threads = max(1, min(int(round(self._free_threads * fraction)), self._free_threads - others))
+        return ram, threads
+
+    @contextmanager
+    def allocate(self, fasta_file, at_least=(1, 1)):
+        """Reserve a file's share for the duration of the block, yield (ram_gb, threads)
+
+        Waits until at_least (ram_gb, threads; capped at the budget) is
+        free, and never hands out less than that.
+        """
+        need_ram = max(1, min(at_least[0], self.ram_gb))
+        need_threads = max(1, min(at_least[1], self.threads))
+        with self._condition:
+            self._condition.wait_for(lambda: self._free_ram >= need_ram and self._free_threads >= need_threads)
+            want_ram, want_threads = self._share(fasta_file)
+            want_ram, want_threads = max(want_ram, need_ram), max(want_threads, need_threads)
+            ram = min(want_ram, self._free_ram)
+            threads = min(want_threads, self._free_threads)
+            self._free_ram -= ram
+            self._free_threads -= threads
+            self._running += 1
+        try:
+            yield ram, threads
+        finally:
+            with self._condition:
+                self._free_ram += ram
+                self._free_threads += threads
+                self._running -= 1
+                self._condition.notify_all()
@@ -0,0 +1,173 @@
+"""
+Sharding for KMC Batch Processing
+Splits one FASTA collection over independent runs and merges their outputs
+
+A run with --shard i/N counts the i-th of N partitions of the input list
+(balanced by file size, the same on every node for the same input
+folder) and writes its outputs to <output>/shard_i_of_N together with
+shard.json, which records the files it covered. merge-shards then builds
+the final outputs from the shard folders without recounting anything:
+
+  overlap_merge     union of the shard overlap_merge databases (kmc_tools)
+  combination_raw   the shard blocks copied back into input order (text
+                    or indexed container, as the shards wrote it)
+  binary_existence  k-way merge of the sorted shard files, summing counts
+  presence_matrix   shard matrices side by side, columns in shard order
+                    (only if every shard wrote one)
+"""
+
+import json
+import os
+import re
+from pathlib import Path
+
+from combination import COPY_CHUNK
+
+MANIFEST_NAME = "shard.json"
+MANIFEST_VERSION = 1
+
+_SHARD_DIR = re.compile(r"^shard_(\d+)_of_(\d+)$")
+
+def parse_shard(text):
+    """Parse 'i/N' (1 <= i <= N) into (i, N), raising ValueError otherwise"""
+    try:
+        index, count = (int(part) for part in str(text).split('/'))
+    except ValueError:
+        raise ValueError(f"Shard must look like i/N, got {text!r}")
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+def shard_dir_name(index, count):
+    """Return the output subfolder of one shard"""
+    return f"shard_{index}_of_{count}"
+
+def partition(fasta_files, count, sizes=None):
+    """Split files into count lists of similar total size
+
+    Files are placed largest first on the currently lightest shard (ties go
+    to the lower shard number), so the result only depends on the file
+    names and sizes. Each shard keeps its files in input order.
+    """
+    if sizes is None:
+        sizes = {fasta_file: os.path.getsize(fasta_file) for fasta_file in fasta_files}
+    position = {fasta_file: i for i, fasta_file in enumerate(fasta_files)}
+    loads = [0] * count
+    shards = [[] for _ in range(count)]
+    for fasta_file in sorted(fasta_files, key=lambda f: (-sizes[f], position[f])):
+        lightest = min(range(count), key=lambda n: (loads[n], n))
+        loads[lightest] += sizes[fasta_file]
+        shards[lightest].append(fasta_file)
+    return [sorted(files, key=position.get) for files in shards]
+
+def select_shard(fasta_files, index, count):
+    """Return the files of shard index (1-based) out of count"""
+    return partition(fasta_files, count)[index - 1]
+
+def write_manifest(shard_dir, index, count, k, all_files, inputs, processed, errors=0, cancelled=False,
+                   options=None):
+    """Write shard.json: which inputs the shard covered, its counting options and how the run ended"""
+    manifest = {
+        'manifest_version': MANIFEST_VERSION,
+        'shard': index,
+        'shards': count,
+        'k': int(k),
+        'total_files': len(all_files),
+        'inputs': [Path(f).name for f in inputs],
+        'processed': [Path(db_path).name for db_path in processed],
+        'errors': errors,
+        'cancelled': cancelled,
+        'options': options or {},
+    }
+    with open(Path(shard_dir) / MANIFEST_NAME, 'w') as outfile:
+        json.dump(manifest, outfile, indent=2)
+
+def find_shard_dirs(output_folder):
+    """Return the shard_i_of_N subfolders of output_folder that have a manifest"""
+    found = []
+    for path in Path(output_folder).iterdir():
+        if path.is_dir() and _SHARD_DIR.match(path.name) and (path / MANIFEST_NAME).exists():
+            found.append(path)
+    return found
+
+def load_shards(shard_dirs):
+    """Read and check the manifests of a complete set of shards
+
+    Returns [(shard_dir, manifest)] sorted by shard number. Raises
+    ValueError if shards are missing, duplicated, cancelled, from
+    different runs (shard count, k, input total, counting options) or
+    overlap.
+    """
+    shards = []
+    for shard_dir in shard_dirs:
+        manifest_file = Path(shard_dir) / MANIFEST_NAME
+        try:
+            with open(manifest_file, 'r') as infile:
+                shards.append((Path(shard_dir), json.load(infile)))
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Could not read {manifest_file}: {str(e)}")
+    if not shards:
+        raise ValueError("No shard folders found")
+    shards.sort(key=lambda shard: shard[1]['shard'])
+
+    first = shards[0][1]
+    for key in ('shards', 'k', 'total_files'):
+        values = sorted({manifest[key] for _, manifest in shards})
+        if len(values) > 1:
+            raise ValueError(f"Shards disagree on {key}: {', '.join(str(v) for v in values)}")
+    options = sorted({json.dumps(manifest.get('options') or {}, sort_keys=True) for _, manifest in shards})
+    if len(options) > 1:
+        raise ValueError(f"Shards were counted with different options: {'; '.join(options)}")
+    numbers = [manifest['shard'] for _, manifest in shards]
+    duplicated = sorted({n for n in numbers if numbers.count(n) > 1})
+    if duplicated:
+        raise ValueError(f"Shards given more than once: {', '.join(str(n) for n in duplicated)}")
+    missing = sorted(set(range(1, first['shards'] + 1)) - set(numbers))
+    if missing:
+        raise ValueError(f"Missing shards: {', '.join(str(n) for n in missing)} of {first['shards']}")
+    cancelled = [str(manifest['shard']) for _, manifest in shards if manifest['cancelled']]
+    if cancelled:
+        raise ValueError(f"Shards did not finish (cancelled): {', '.join(cancelled)}")
+    seen = {}
+    for _, manifest in shards:
+        for name in manifest['inputs']:
+            if name in seen:
+                raise ValueError(f"{name} is in shards {seen[name]} and {manifest['shard']}")
+            seen[name] = manifest['shard']
+    return shards
+
+def combination_blocks(combo_file, chunk_size=COPY_CHUNK):
+    """Return [(name, start, end)] byte ranges of the per-file blocks of combination_raw"""
+    marker = b"\n# === "
+    starts = []
+    with open(combo_file, 'rb') as infile:
+        if infile.read(len(marker) - 1) == marker[1:]:
+            starts.append(0)
+        infile.seek(0)
+        offset = 0
+        tail = b""
+        while True:
+            data = infile.read(chunk_size)
+            if not data:
+                break
+            buffer = tail + data
+            base = offset - len(tail)
+            pos = buffer.find(marker)
+            while pos >= 0:
+                starts.append(base + pos + 1)
+                pos = buffer.find(marker, pos + 1)
+            # Keep enough bytes to find a marker split across two reads
+            tail = buffer[-(len(marker) - 1):]
+            offset += len(data)
+        end_of_file = offset
+
+        blocks = []
+        for n, start in enumerate(starts):
+            infile.seek(start)
+            header = infile.readline().decode('utf-8').rstrip('\n')
+            name = header[len("# === "):]
+            if name.endswith(" ==="):
+                name = name[:-len(" ===")]
+            end = starts[n + 1] if n + 1 < len(starts) else end_of_file
+            blocks.append((name, start, end))
+    return blocks
@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules live at the repository root, the fake KMC in benchmarks/
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import fake_kmc
+from make_fasta import generate_collection
+
+@pytest.fixture(scope='session')
+def fake_tools(tmp_path_factory):
+    """(kmc, kmc_tools) launchers of the fake KMC in benchmarks/fake_kmc.py"""
+    return fake_kmc.install(tmp_path_factory.mktemp("bin"))
+
+@pytest.fixture
+def genomes(tmp_path):
+    """Folder of 4 small multi-line FASTA files sharing part of their sequence"""
+    folder = tmp_path / "fasta"
+    generate_collection(folder, genomes=4, length=3000, line_width=60, shared=0.5, seed=1)
+    return folder
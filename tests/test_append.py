@@ -0,0 +1,77 @@
+"""--append and --retry-failed must end with the outputs of one full run"""
+
+import shutil
+
+from abundance_matrix import AbundanceMatrix
+from cli import run_kmc_batch
+from kmer_numpy import HAVE_NUMPY
+from presence_matrix import PresenceMatrix
+
+def run(kmc, kmc_tools, inputs, output, **options):
+    return run_kmc_batch(kmc, kmc_tools, inputs, output, output.parent / "work", 21, 4, 4,
+                         presence_matrix=True, abundance_matrix=HAVE_NUMPY, log=lambda message: None, **options)
+
+def read_outputs(output):
+    binary = output / "binary_existence"
+    matrix = PresenceMatrix(binary / "presence_matrix.bin")
+    outputs = {
+        'overlap_merge': (output / "overlap_merge" / "overlap_merge_dump.txt").read_text(),
+        'binary_existence': (binary / "binary_existence.txt").read_text(),
+        'combination_raw': (output / "combination_raw" / "combination_raw.txt").read_text(),
+        'presence_names': matrix.file_names,
+        'presence_rows': list(matrix.iter_masks()),
+    }
+    if HAVE_NUMPY:
+        abundance = AbundanceMatrix(output / "abundance_matrix")
+        outputs['abundance_names'] = abundance.names
+        outputs['abundance_rows'] = [[array.tolist() for array in abundance.row(name)] for name in abundance.names]
+    return outputs
+
+def by_file(outputs):
+    """The outputs without their file order (retried files are added after the others, as with --append)"""
+    names = outputs['presence_names']
+    blocks = outputs['combination_raw'].split("# === ")[1:]
+    unordered = {
+        'overlap_merge': outputs['overlap_merge'],
+        'binary_existence': outputs['binary_existence'],
+        'combination_raw': sorted(blocks),
+        'presence_rows': [{name for j, name in enumerate(names) if mask >> j & 1}
+                          for mask in outputs['presence_rows']],
+    }
+    if HAVE_NUMPY:
+        unordered['abundance_rows'] = dict(zip(outputs['abundance_names'], outputs['abundance_rows']))
+    return unordered
+
+def test_append_equals_full_run(fake_tools, genomes, tmp_path):
+    assert run(*fake_tools, genomes, tmp_path / "full")
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    fasta_files = sorted(genomes.iterdir())
+    for fasta_file in fasta_files[:2]:
+        shutil.copy(fasta_file, inputs)
+    assert run(*fake_tools, inputs, tmp_path / "appended")
+    for fasta_file in fasta_files[2:]:
+        shutil.copy(fasta_file, inputs)
+    assert run(*fake_tools, inputs, tmp_path / "appended", append=True)
+    assert read_outputs(tmp_path / "appended") == read_outputs(tmp_path / "full")
+
+def test_retry_failed_reruns_only_failed_files(fake_tools, genomes, tmp_path):
+    kmc, kmc_tools = fake_tools
+    assert run(kmc, kmc_tools, genomes, tmp_path / "full")
+    # A kmc that fails on genome_1 while the flag file exists and logs every call
+    flag = tmp_path / "fail"
+    calls = tmp_path / "calls.txt"
+    flaky = tmp_path / "flaky_kmc"
+    flaky.write_text(f'#!/bin/sh\necho "$*" >> "{calls}"\n'
+                     f'case "$*" in *genome_1*) [ -e "{flag}" ] && exit 1;; esac\n'
+                     f'exec "{kmc}" "$@"\n')
+    flaky.chmod(0o755)
+    flag.touch()
+    assert not run(str(flaky), kmc_tools, genomes, tmp_path / "retried")
+    flag.unlink()
+    calls.unlink()
+    assert run(str(flaky), kmc_tools, genomes, tmp_path / "retried", retry_failed=True)
+    counted = calls.read_text()
+    assert "genome_1" in counted
+    assert not any(f"genome_{i}" in counted for i in (0, 2, 3))
+    assert by_file(read_outputs(tmp_path / "retried")) == by_file(read_outputs(tmp_path / "full"))
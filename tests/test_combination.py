@@ -0,0 +1,47 @@
+"""The indexed combination_raw container must hold the blocks of the text format"""
+
+import shutil
+
+from cli import run_kmc_batch
+from combination import CONTAINER_NAME, TEXT_NAME, CombinationContainer
+
+def run(fake_tools, inputs, output, **options):
+    assert run_kmc_batch(*fake_tools, inputs, output, output.parent / "work", 21, 4, 4,
+                         log=lambda message: None, **options)
+    return output / "combination_raw"
+
+def text_blocks(path):
+    """{name: dump lines} of a text combination_raw"""
+    blocks = {}
+    with open(path) as infile:
+        for line in infile:
+            if line.startswith("# === "):
+                lines = blocks[line[len("# === "):-len(" ===\n")]] = []
+            elif line.strip():
+                lines.append(line.rstrip("\n"))
+    return blocks
+
+def container_blocks(path):
+    container = CombinationContainer(path)
+    return {name: [line.decode('ascii') for line in container.iter_lines(name)] for name in container.names()}
+
+def test_indexed_matches_text(fake_tools, genomes, tmp_path):
+    expected = text_blocks(run(fake_tools, genomes, tmp_path / "text") / TEXT_NAME)
+    assert len(expected) == 4 and all(expected.values())
+    container = run(fake_tools, genomes, tmp_path / "indexed", combination_format='indexed') / CONTAINER_NAME
+    assert CombinationContainer(container).names() == list(expected)
+    assert container_blocks(container) == expected
+
+def test_indexed_append(fake_tools, genomes, tmp_path):
+    expected = text_blocks(run(fake_tools, genomes, tmp_path / "text") / TEXT_NAME)
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    fasta_files = sorted(genomes.iterdir())
+    for fasta_file in fasta_files[:2]:
+        shutil.copy(fasta_file, inputs)
+    run(fake_tools, inputs, tmp_path / "indexed", combination_format='indexed')
+    for fasta_file in fasta_files[2:]:
+        shutil.copy(fasta_file, inputs)
+    container = run(fake_tools, inputs, tmp_path / "indexed", append=True) / CONTAINER_NAME
+    assert CombinationContainer(container).names() == list(expected)
+    assert container_blocks(container) == expected
@@ -0,0 +1,38 @@
+"""Every aggregation engine must write the binary_existence of the memory engine"""
+
+import pytest
+
+from cli import run_kmc_batch
+from kmer_numpy import HAVE_NUMPY
+
+def binary_existence(fake_tools, genomes, output, **options):
+    assert run_kmc_batch(*fake_tools, genomes, output, output.parent / "work", 21, 4, 4,
+                         log=lambda message: None, **options)
+    return (output / "binary_existence" / "binary_existence.txt").read_text()
+
+@pytest.fixture
+def expected(fake_tools, genomes, tmp_path):
+    text = binary_existence(fake_tools, genomes, tmp_path / "memory")
+    # Shared and private k-mers, so an engine that miscounts cannot match by accident
+    assert {"1", "4"} <= {line.split()[1] for line in text.splitlines()[1:]}
+    return text
+
+def test_stream_engine(fake_tools, genomes, tmp_path, expected):
+    assert binary_existence(fake_tools, genomes, tmp_path / "stream", aggregation='stream') == expected
+
+@pytest.mark.skipif(not HAVE_NUMPY, reason="NumPy is not installed")
+def test_numpy_engine(fake_tools, genomes, tmp_path, expected):
+    assert binary_existence(fake_tools, genomes, tmp_path / "numpy", aggregation='numpy') == expected
+
+@pytest.mark.parametrize('aggregation', ['memory', 'stream'])
+def test_native_db_reader(fake_tools, genomes, tmp_path, expected, aggregation):
+    # The databases are read with kmc_db.KMCDatabase instead of kmc_tools dumps
+    output = tmp_path / f"native_{aggregation}"
+    assert binary_existence(fake_tools, genomes, output, aggregation=aggregation, native_db=True) == expected
+
+@pytest.mark.parametrize('native_db', [False, True])
+def test_partitioned_engine(fake_tools, genomes, tmp_path, expected, native_db):
+    # Several partitions and workers, and buckets small enough to be split
+    output = tmp_path / f"partitioned_{native_db}"
+    assert binary_existence(fake_tools, genomes, output, aggregation='partitioned', native_db=native_db,
+                            partitions=4, aggregation_workers=2, max_bucket_bytes=4096) == expected
@@ -0,0 +1,68 @@
+"""KMCDatabase must read a KMC 3 database like kmc_tools transform ... dump -s"""
+
+import io
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import kmc_db
+from kmc_db import KMCDatabase, read_kmer_count
+
+# k=11, 4 bins, LUT prefix of 3 bases, canonical counts of kmc3_k11.fa (see data/README.md)
+FIXTURE = Path(__file__).resolve().parent / "data" / "kmc3_k11"
+EXPECTED_DUMP = FIXTURE.with_name("kmc3_k11_dump.txt").read_text()
+
+# A real KMC 3 to check the fixture against (KMC_EXE / KMC_TOOLS_EXE or kmc / kmc_tools on PATH)
+KMC = os.environ.get('KMC_EXE') or shutil.which('kmc')
+KMC_TOOLS = os.environ.get('KMC_TOOLS_EXE') or shutil.which('kmc_tools')
+
+def dump(db):
+    outfile = io.StringIO()
+    rows = db.write_dump(outfile)
+    return rows, outfile.getvalue()
+
+def test_header():
+    db = KMCDatabase(FIXTURE)
+    assert (db.kmer_length, db.counter_size) == (11, 1)
+    assert db.both_strands
+    assert db.n_bins > 1
+    assert len(db) == read_kmer_count(FIXTURE) == EXPECTED_DUMP.count("\n")
+
+def test_sorted_dump():
+    rows, text = dump(KMCDatabase(FIXTURE))
+    assert rows == EXPECTED_DUMP.count("\n")
+    assert text == EXPECTED_DUMP
+
+def test_sorted_dump_without_numpy(monkeypatch):
+    monkeypatch.setattr(kmc_db, 'HAVE_NUMPY', False)
+    rows, text = dump(KMCDatabase(FIXTURE))
+    assert rows == EXPECTED_DUMP.count("\n")
+    assert text == EXPECTED_DUMP
+
+def test_kmer_strings():
+    expected = [line.split("\t")[0] for line in EXPECTED_DUMP.splitlines()]
+    assert list(KMCDatabase(FIXTURE).iter_kmer_strings()) == expected
+
+@pytest.mark.skipif(not kmc_db.HAVE_NUMPY, reason="NumPy is not installed")
+def test_packed_kmers():
+    expected = [kmc_db.kmer_to_int(line.split("\t")[0]) for line in EXPECTED_DUMP.splitlines()]
+    assert KMCDatabase(FIXTURE).read_kmers().tolist() == expected
+
+@pytest.mark.skipif(not (KMC and KMC_TOOLS), reason="KMC and kmc_tools are not installed")
+def test_real_kmc_database(tmp_path):
+    # The commands of data/README.md: the reader must match kmc_tools on a
+    # database real KMC wrote, and the fixture's dump must match it too
+    db = tmp_path / "kmc3_k11"
+    (tmp_path / "kmc_tmp").mkdir()
+    subprocess.run([KMC, "-k11", "-ci1", "-n4", "-fm", str(FIXTURE.with_suffix(".fa")), str(db),
+                    str(tmp_path / "kmc_tmp")], check=True, capture_output=True)
+    subprocess.run([KMC_TOOLS, "transform", str(db), "dump", "-s", str(tmp_path / "dump.txt")],
+                   check=True, capture_output=True)
+    real_dump = (tmp_path / "dump.txt").read_text()
+    assert real_dump == EXPECTED_DUMP
+    rows, text = dump(KMCDatabase(db))
+    assert rows == real_dump.count("\n")
+    assert text == real_dump
@@ -0,0 +1,72 @@
+"""The query command must tell invalid queries from absent k-mers and read --file to the end"""
+
+import pytest
+
+import cli
+import kmer_index
+from aggregate import write_kmer_counts
+from kmer_index import ABSENT, INDEX_NAME, INVALID, KmerIndex, build_index
+
+# Sorted 5-mers (each already canonical) and their file counts
+KMERS = [("AAAAA", 3), ("AACGT", 1), ("ACGTA", 2), ("ACGTC", 1), ("CCCCC", 2)]
+
+@pytest.fixture
+def output(tmp_path):
+    binary_dir = tmp_path / "binary_existence"
+    binary_dir.mkdir()
+    write_kmer_counts(KMERS, binary_dir / "binary_existence.txt")
+    build_index(binary_dir / "binary_existence.txt", binary_dir / INDEX_NAME)
+    return tmp_path
+
+def query(output, capsys, *args):
+    with pytest.raises(SystemExit) as exit_info:
+        cli.query_main(["--output", str(output), *args])
+    out, err = capsys.readouterr()
+    return exit_info.value.code, out, err
+
+@pytest.mark.parametrize('numpy', [True, False])
+def test_find_many_marks_invalid_queries(output, monkeypatch, numpy):
+    if numpy and not kmer_index.HAVE_NUMPY:
+        pytest.skip("NumPy is not installed")
+    monkeypatch.setattr(kmer_index, 'HAVE_NUMPY', numpy)
+    with KmerIndex(output / "binary_existence" / INDEX_NAME) as index:
+        rows = index.find_many(["ACGTA", "GGGGG", "ACGTN", "ACGT", "ACGTAC", "TTTTA"])
+    assert rows == [2, 4, INVALID, INVALID, INVALID, ABSENT]
+
+def test_invalid_prefix(output):
+    with KmerIndex(output / "binary_existence" / INDEX_NAME) as index:
+        assert index.prefix_range("ACGT") == (2, 4)
+        for prefix in ("", "ACGTAC", "ACN"):
+            with pytest.raises(ValueError):
+                index.prefix_range(prefix)
+
+def test_query_reports_invalid_kmers(output, capsys):
+    code, out, err = query(output, capsys, "--kmer", "ACGTA", "TTTTA", "ACGTN", "ACG")
+    assert code == 1
+    assert out == "ACGTA\t2\nTTTTA\t0\nACGTN\tinvalid\nACG\tinvalid\n"
+    assert "1 found, 1 absent" in err
+    assert "2 queries are not 5-mers" in err
+
+def test_query_rejects_long_prefix(output, capsys):
+    code, out, err = query(output, capsys, "--prefix", "ACGTAC")
+    assert code == 1
+    assert out == ""
+    assert "ERROR: Prefix ACGTAC" in err
+
+def test_prefix_limit_summary(output, capsys):
+    code, out, err = query(output, capsys, "--prefix", "A", "--limit", "2")
+    assert code == 0
+    assert out == "AAAAA\t3\nAACGT\t1\n"
+    assert "Prefix A: showing 2 of 4 k-mers" in err
+    code, out, err = query(output, capsys, "--prefix", "A")
+    assert "Prefix A: 4 k-mers" in err and "showing" not in err
+
+def test_file_reads_past_blank_batches(output, tmp_path, capsys, monkeypatch):
+    # A whole batch of blank and comment lines must not end the input
+    monkeypatch.setattr(cli, 'QUERY_BATCH', 2)
+    queries = tmp_path / "queries.txt"
+    queries.write_text("AAAAA\n\n# comment\n\n\nCCCCC\nGGGGG\n")
+    code, out, err = query(output, capsys, "--file", str(queries))
+    assert code == 0
+    assert out == "AAAAA\t3\nCCCCC\t2\nGGGGG\t2\n"
+    assert "Looked up 3 k-mers" in err
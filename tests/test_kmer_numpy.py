@@ -0,0 +1,51 @@
+"""The NumPy engine must write the same binary_existence as the memory engine"""
+
+import pytest
+
+from aggregate import binary_existence_memory
+from kmer_numpy import HAVE_NUMPY, binary_existence_numpy
+
+pytestmark = pytest.mark.skipif(not HAVE_NUMPY, reason="NumPy is not installed")
+
+DUMPS = {
+    # sorted, as kmc_tools transform ... dump -s writes them
+    'a_sorted.txt': "AAACG\t3\nACGTA\t1\nCCCCC\t2\nGATTA\t7\n",
+    'b_sorted.txt': "AAACG\t1\nCCCCC\t4\nTTTTT\t1\n",
+    # unsorted (KMC's bin order) with a comment and a blank line
+    'c_unsorted.txt': "# dump\nTTTTT\t2\nAAACG\t1\n\nGATTA\t1\nCATGC\t5\n",
+    'd_unsorted.txt': "GATTA 2\nCCCCC 1\nAAACG 9\n",
+}
+
+def write_dumps(tmp_path):
+    paths = []
+    for name, text in DUMPS.items():
+        path = tmp_path / name
+        path.write_text(text)
+        paths.append(path)
+    return paths
+
+def both_engines(tmp_path, dumps, **filters):
+    memory_file = tmp_path / "memory.txt"
+    numpy_file = tmp_path / "numpy.txt"
+    memory_kmers = binary_existence_memory(dumps, memory_file, **filters)
+    numpy_kmers = binary_existence_numpy(dumps, numpy_file, **filters)
+    return memory_kmers, numpy_kmers, memory_file.read_bytes(), numpy_file.read_bytes()
+
+def test_identical_output(tmp_path):
+    memory_kmers, numpy_kmers, memory, packed = both_engines(tmp_path, write_dumps(tmp_path))
+    assert memory_kmers == numpy_kmers == 6
+    assert memory == packed
+
+def test_identical_output_with_file_filters(tmp_path):
+    dumps = write_dumps(tmp_path)
+    for filters in ({'min_files': 2}, {'max_files': 1}, {'min_files': 2, 'max_files': 3}):
+        memory_kmers, numpy_kmers, memory, packed = both_engines(tmp_path, dumps, **filters)
+        assert memory_kmers == numpy_kmers
+        assert memory == packed
+
+def test_identical_output_for_empty_dumps(tmp_path):
+    empty = tmp_path / "empty.txt"
+    empty.write_text("")
+    memory_kmers, numpy_kmers, memory, packed = both_engines(tmp_path, [empty, empty])
+    assert memory_kmers == numpy_kmers == 0
+    assert memory == packed
@@ -0,0 +1,59 @@
+"""The presence and abundance matrices must read back the per-file counts they were written from"""
+
+import io
+
+import pytest
+
+from abundance_matrix import AbundanceMatrix
+from cli import run_kmc_batch
+from kmc_db import KMCDatabase
+from kmer_numpy import HAVE_NUMPY
+from presence_matrix import PresenceMatrix
+
+def run(fake_tools, genomes, output, **options):
+    """Run a batch keeping the per-file dumps, return the binary_existence k-mers"""
+    assert run_kmc_batch(*fake_tools, genomes, output, output.parent / "work", 21, 4, 4,
+                         keep_intermediates=True, log=lambda message: None, **options)
+    with open(output / "binary_existence" / "binary_existence.txt") as infile:
+        return [line.split()[0] for line in infile if not line.startswith('#')]
+
+def file_counts(output, names):
+    """{file: {k-mer: count}} from the kept dump of each file, or its database with --native-db"""
+    counts = {}
+    for name in names:
+        dump = output / name / f"{name}_dump.txt"
+        if dump.exists():
+            text = dump.read_text()
+        else:
+            outfile = io.StringIO()
+            KMCDatabase(output / name / name).write_dump(outfile)
+            text = outfile.getvalue()
+        counts[name] = {kmer: int(count) for kmer, count in map(str.split, text.splitlines())}
+    return counts
+
+@pytest.mark.parametrize('aggregation', ['memory', 'stream'])
+def test_presence_matrix_round_trip(fake_tools, genomes, tmp_path, aggregation):
+    output = tmp_path / "out"
+    kmers = run(fake_tools, genomes, output, aggregation=aggregation, presence_matrix=True)
+    matrix = PresenceMatrix(output / "binary_existence" / "presence_matrix.bin")
+    assert matrix.file_names == [fasta.stem for fasta in sorted(genomes.iterdir())]
+    assert len(matrix) == len(kmers)
+    counts = file_counts(output, matrix.file_names)
+    for row, kmer in enumerate(kmers):
+        assert matrix.row_files(row) == [name for name in matrix.file_names if kmer in counts[name]]
+
+@pytest.mark.skipif(not HAVE_NUMPY, reason="NumPy is not installed")
+@pytest.mark.parametrize('options', [{}, {'native_db': True}, {'min_files': 2}])
+def test_abundance_matrix_round_trip(fake_tools, genomes, tmp_path, options):
+    output = tmp_path / "out"
+    kmers = run(fake_tools, genomes, output, abundance_matrix=True, **options)
+    matrix = AbundanceMatrix(output / "abundance_matrix")
+    assert matrix.names == [fasta.stem for fasta in sorted(genomes.iterdir())]
+    assert matrix.shape == (4, len(kmers))
+    assert matrix.kmer_strings(range(len(kmers))) == kmers
+    counts = file_counts(output, matrix.names)
+    columns = set(kmers)
+    for name in matrix.names:
+        ids, values = matrix.row(name)
+        expected = sorted((kmer, count) for kmer, count in counts[name].items() if kmer in columns)
+        assert list(zip(matrix.kmer_strings(ids), values.tolist())) == expected
@@ -0,0 +1,24 @@
+"""run_child must report the exit status it saw, and never a success it did not see"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from metrics import LOST_STATUS, run_child
+
+def test_exit_status():
+    assert run_child([sys.executable, "-c", "pass"]).returncode == 0
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_child([sys.executable, "-c", "import sys; sys.exit(3)"], check=True)
+    assert error.value.returncode == 3
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason="run_child reaps with os.wait4 only on POSIX")
+def test_lost_status_is_a_failure():
+    # Reaping the child behind run_child's back loses its exit status
+    reap = lambda process: os.waitpid(process.pid, 0)
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_child([sys.executable, "-c", "pass"], check=True, capture_output=True, text=True, started=reap)
+    assert error.value.returncode == LOST_STATUS
+    assert "Exit status lost" in error.value.stderr
@@ -0,0 +1,21 @@
+"""Cached results must not change when a later run rewrites the per-file outputs"""
+
+from cli import run_kmc_batch
+
+def run(fake_tools, genomes, tmp_path, **options):
+    output = tmp_path / "out"
+    assert run_kmc_batch(*fake_tools, genomes, output, tmp_path / "work", 21, 4, 4,
+                         cache_dir=tmp_path / "cache", keep_intermediates=True, log=lambda message: None, **options)
+    return (output / "binary_existence" / "binary_existence.txt").read_bytes()
+
+def test_rerun_with_other_bounds_keeps_cache_intact(fake_tools, genomes, tmp_path):
+    # The kept per-file databases are hard-linked into the cache; the
+    # min_count=2 run rewrites them and must not touch the cached copies
+    default = run(fake_tools, genomes, tmp_path)
+    bounded = run(fake_tools, genomes, tmp_path, min_count=2)
+    assert bounded != default
+    assert run(fake_tools, genomes, tmp_path) == default
+
+def test_cache_hit_matches_fresh_run(fake_tools, genomes, tmp_path):
+    first = run(fake_tools, genomes, tmp_path)
+    assert run(fake_tools, genomes, tmp_path) == first
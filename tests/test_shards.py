@@ -0,0 +1,58 @@
+"""--shard runs combined with merge-shards must give the outputs of one full run"""
+
+import subprocess
+import sys
+
+import pytest
+
+from abundance_matrix import AbundanceMatrix
+from conftest import ROOT
+from kmer_numpy import HAVE_NUMPY
+from presence_matrix import PresenceMatrix
+
+CLI = ROOT / "cli.py"
+SHARDS = 2
+
+def cli(*args):
+    result = subprocess.run([sys.executable, str(CLI), *map(str, args)], capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+def count(fake_tools, genomes, output, tmp_path, *options):
+    kmc, kmc_tools = fake_tools
+    cli("--kmc", kmc, "--kmc-tools", kmc_tools, "--input", genomes, "--output", output,
+        "--workdir", tmp_path / "work", "--k", 21, "--no-cache", "--presence-matrix", *options)
+
+def read_outputs(output):
+    binary = output / "binary_existence"
+    matrix = PresenceMatrix(binary / "presence_matrix.bin")
+    outputs = {
+        'binary_existence': (binary / "binary_existence.txt").read_bytes(),
+        'combination_raw': (output / "combination_raw" / "combination_raw.txt").read_bytes(),
+        'presence_names': matrix.file_names,
+        'presence_rows': list(matrix.iter_masks()),
+    }
+    if (output / "abundance_matrix").is_dir():
+        abundance = AbundanceMatrix(output / "abundance_matrix")
+        outputs['abundance_names'] = abundance.names
+        outputs['abundance_rows'] = [[array.tolist() for array in abundance.row(name)] for name in abundance.names]
+    return outputs
+
+def sharded_and_full(fake_tools, genomes, tmp_path, *options):
+    full = tmp_path / "full"
+    count(fake_tools, genomes, full, tmp_path, *options)
+    sharded = tmp_path / "sharded"
+    for i in range(1, SHARDS + 1):
+        count(fake_tools, genomes, sharded, tmp_path, "--shard", f"{i}/{SHARDS}", *options)
+    cli("merge-shards", "--kmc-tools", fake_tools[1], "--output", sharded, "--workdir", tmp_path / "work")
+    return read_outputs(sharded), read_outputs(full)
+
+def test_merged_shards_equal_full_run(fake_tools, genomes, tmp_path):
+    merged, full = sharded_and_full(fake_tools, genomes, tmp_path)
+    assert merged == full
+    assert merged['presence_names'] == sorted(merged['presence_names'])
+
+@pytest.mark.skipif(not HAVE_NUMPY, reason="NumPy is not installed")
+def test_merged_abundance_matrix_in_input_order(fake_tools, genomes, tmp_path):
+    merged, full = sharded_and_full(fake_tools, genomes, tmp_path, "--abundance-matrix")
+    assert merged == full
+    assert merged['abundance_names'] == merged['presence_names']